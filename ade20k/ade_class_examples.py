@@ -12,13 +12,17 @@ from utils import *
 
 parser = argparse.ArgumentParser(description=__doc__, 
     usage="""usage: ade_class_examples.py [-h] [--out-dir OUT_DIR] [--num NUM]
-                             [--no-outline]
+                             [--no-outline] [--processes PROCESSES]
+                             [--cache-dir CACHE_DIR] [--no-cache]
                              classname : classname : ...""")
-parser.set_defaults(outline=True)
+parser.set_defaults(outline=True,cache=True)
 parser.add_argument('classnames', type=str, nargs='+', help='names of the classes to show examples of, separated by colons (comma and whitespace can be part of an ADE20k classname).')
 parser.add_argument('--out-dir', type=path_arg, default="examples", help='the folder in which a subfolder for each class will be filled with examples if --num > 1. If --num=1, all images are stored directly here. (default: "examples")')
 parser.add_argument('--num', type=int, default=10, help='the number of examples to extract (default: 10)')
 parser.add_argument('--no-outline', dest="outline", action="store_false", help='dont paint outlines around the classes on the image.')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes painting the outlines. (default: number of cpus)')
+parser.add_argument('--cache-dir', type=path_arg, default=conf.thumbnail_cache_path, help='the folder to cache images with outlines in. (default from configuration)')
+parser.add_argument('--no-cache', dest="cache", action="store_false", help='paint all outlines again, without using the cache.')
 args = parser.parse_args()
 
 args.classnames = colon_separated(args.classnames)
@@ -29,32 +33,30 @@ if not os.path.exists(args.out_dir):
     os.makedirs(args.out_dir)
     
 total_img_count = 0
-for i,cname in enumerate(args.classnames):
-    print(f"[{i:4d}/{len(args.classnames)}] ",end="")
-    try:
-        class_id = utils.AdeIndex.class_index(ade_index,cname)
-    except ValueError:
-        print("No class of name",cname,"skipping.")
-        continue
-    print(f"{cname} (#{class_id})")
-    iterr = utils.AdeIndex.images_with_class(ade_index,class_id,count=args.num)
-    if args.num > 1: 
-        iterr = tqdm(iterr)
-        class_folder_path = os.path.join(args.out_dir,cname)
-        if not os.path.exists(class_folder_path):
-            os.makedirs(class_folder_path)
-    else:
-        class_folder_path = args.out_dir
-    
-    for img_id in iterr: 
-        img, img_data = utils.AdeIndex.load_img(ade_index,img_id,True)
-        out_name = img_data['filename']
-        if args.num == 1: out_name = f"{cname}_" + out_name
-        total_img_count += 1
-        if args.outline:
-            img = utils.Images.class_outlines(img,img_data,[[class_id,None,(255,0,0),4]])
-            cv2.imwrite(os.path.join(class_folder_path,out_name),img)
+with utils.ThumbnailRenderer(ade_index,args.cache_dir if args.cache else None,args.processes) as renderer:
+    for i,cname in enumerate(args.classnames):
+        print(f"[{i:4d}/{len(args.classnames)}] ",end="")
+        try:
+            class_id = utils.AdeIndex.class_index(ade_index,cname)
+        except ValueError:
+            print("No class of name",cname,"skipping.")
+            continue
+        print(f"{cname} (#{class_id})")
+        iterr = utils.AdeIndex.images_with_class(ade_index,class_id,count=args.num)
+        if args.num > 1: 
+            iterr = tqdm(iterr)
+            class_folder_path = os.path.join(args.out_dir,cname)
+            if not os.path.exists(class_folder_path):
+                os.makedirs(class_folder_path)
         else:
-            img = utils.AdeIndex.load_img(ade_index,img_id,False)
-            cv2.imwrite(os.path.join(class_folder_path,out_name),img)
-print(f"Stored {total_img_count} images in {args.out_dir}")
\ No newline at end of file
+            class_folder_path = args.out_dir
+        
+        for img_id in iterr: 
+            out_name = ade_index['filename'][img_id]
+            if args.num == 1: out_name = f"{cname}_" + out_name
+            total_img_count += 1
+            if args.outline:
+                renderer.render(img_id,os.path.join(class_folder_path,out_name),[[class_id,None,(255,0,0),4]],legend=True)
+            else:
+                shutil.copyfile(utils.AdeIndex.img_path(ade_index,img_id),os.path.join(class_folder_path,out_name))
+print(f"Stored {total_img_count} images in {args.out_dir}")
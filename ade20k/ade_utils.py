@@ -7,19 +7,28 @@ including the configuration of filters. The contents are:
 -   adeindex  (static): Utilities for querying the index pkl file
 -   imgdata (static): Utilities for querying the json of a single image
 -   ade_stats (static): Utilities for querying the new stats file generated from ADE20k
+-   sampling (static): Stratified sampling of images for estimating counts
 -   plots (static): Plotting utils
+-   thumbnails : A ContextManager class rendering cached outline thumbnails in a process pool
 -   html : A ContextManager class to open and write a html summary
 """
 
+import hashlib
+import html
 import json
 import os
 import pickle
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
 from typing import Dict, List
 
 import chardet
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from PIL import Image
 
 from utils import conf as general_conf, project_root_folder
@@ -165,11 +174,11 @@ class AdeTargetClass(object):
             elif obj['parts']['ispartof'] == []:
                 if -1 in parents: 
                     result.append(obj)
-            #check parent class
+            #check parent class, a parent missing in the annotation never matches
             else: 
                #print(" has parent",end="")
                 parent = ImgData.find_obj_by_id(img_data,obj['parts']['ispartof'])
-                if parent['name_ndx'] in parents: 
+                if parent is not None and parent['name_ndx'] in parents: 
                     #print(" and its good!")
                     result.append(obj)
         
@@ -185,6 +194,15 @@ class AdeConfiguration(object):
     
     Also creates a global class-mask of length num_classes with a 1 at each ADE20k-class present in 
     at least one target_class.
+    
+    The synonyms and parent constraints of all content_classes are compiled into lookup arrays, with
+    one bit per content class (in the order of content_classes), which full_match uses to match all
+    content classes in a single pass over the objects of an image:
+    
+        free_bits : for each ADE20k-class, the content classes it is a synonym of without parent constraint
+        constrained_bits : for each ADE20k-class, the content classes it is a synonym of with parent constraint
+        parent_keys, parent_bits : sorted keys of (child, parent) ADE20k-class pairs and the content 
+                                   classes accepting each pair
     """
     @staticmethod
     def load(ade_index : dict, filepath : str = general_conf.annotate_filers_conf):
@@ -228,10 +246,123 @@ class AdeConfiguration(object):
                     else: print("!!! Only one 'remains' class per scene possible. Duplicate for",cl.scene,"found !!!")
                 
                 continue
-            mask = np.logical_and(mask,cl.mask)
+            mask = np.logical_or(mask,cl.mask)
             self.content_classes.append(cl)
         self.content_classes.sort(key=lambda cl: cl.z_index)
         self.class_mask = mask
+        self.class_indices = np.flatnonzero(mask)
+        self.compile()
+        
+    @staticmethod
+    def pair_key(child, parent):
+        """Integer key of a (child, parent) pair of ADE20k-class indices. parent may be -1 for NONE
+        and -2 for a missing parent object, which never matches a constraint."""
+        return child * (num_classes + 2) + parent + 2
+        
+    def compile(self):
+        """(Re)build the lookup arrays used by full_match from content_classes."""
+        if len(self.content_classes) > 64:
+            raise ValueError(f"At most 64 content classes can be compiled, got {len(self.content_classes)}")
+        self.free_bits = np.zeros((num_classes), dtype=np.uint64)
+        self.constrained_bits = np.zeros((num_classes), dtype=np.uint64)
+        self.class_shifts = np.arange(len(self.content_classes), dtype=np.uint64)
+        self._scene_bits = {}
+        pairs = {}
+        for k, cl in enumerate(self.content_classes):
+            bit = np.uint64(1) << np.uint64(k)
+            for syn, parents in cl.synonyms.items():
+                if len(parents) == 0:
+                    self.free_bits[syn] |= bit
+                    continue
+                self.constrained_bits[syn] |= bit
+                for par in parents:
+                    key = AdeConfiguration.pair_key(syn, par)
+                    pairs[key] = pairs.get(key, 0) | (1 << k)
+        keys = sorted(pairs.keys())
+        self.parent_keys = np.array(keys, dtype=np.int64)
+        self.parent_bits = np.array([pairs[key] for key in keys], dtype=np.uint64)
+        
+    def scene_bits(self, scene : str):
+        """Bits of all content classes whose scene constraint accepts the given scene."""
+        if not scene in self._scene_bits:
+            bits = 0
+            for k, cl in enumerate(self.content_classes):
+                if not cl.scene or cl.scene == scene:
+                    bits |= 1 << k
+            self._scene_bits[scene] = np.uint64(bits)
+        return self._scene_bits[scene]
+        
+    def full_match(self, img_data : dict) -> List[List[dict]]:
+        """Find all object instances matching each of the content classes fully, including the 
+        scene constraint, in a single pass over the objects of the image. Equivalent to calling
+        full_match of each content class whose scene matches. Objects whose parent object is
+        missing in the annotation only match synonyms without parent constraint.
+
+        Args:
+            img_data (dict): Data loaded from annotations json of one image
+
+        Returns:
+            List[List[dict]]: For each class in content_classes, the list of matching object 
+            descriptions from img_data. Empty lists if none found.
+        """
+        matches = [[] for _ in self.content_classes]
+        if len(img_data['object']) == 0:
+            return matches
+        names, parents = ImgData.object_arrays(img_data)
+        
+        bits = self.free_bits[names]
+        constrained = self.constrained_bits[names]
+        if len(self.parent_keys) > 0 and constrained.any():
+            keys = AdeConfiguration.pair_key(names, parents)
+            pos = np.minimum(np.searchsorted(self.parent_keys, keys), len(self.parent_keys)-1)
+            hit = self.parent_keys[pos] == keys
+            bits = bits | (constrained & np.where(hit, self.parent_bits[pos], np.uint64(0)))
+        bits = bits & self.scene_bits(img_data['scene'][0])
+        
+        obj_indices = np.flatnonzero(bits)
+        if len(obj_indices) == 0:
+            return matches
+        matched = ((bits[obj_indices, None] >> self.class_shifts) & np.uint64(1)).astype(bool)
+        for k in np.flatnonzero(matched.any(axis=0)):
+            matches[k] = [img_data['object'][i] for i in obj_indices[matched[:, k]]]
+        return matches
+        
+    def prefilter(self, ade_index, img_indices=None):
+        """Bulk check which images contain at least one synonym of any content class, using the
+        global class-mask. Images failing it can be rejected without looking at them any further.
+
+        Args:
+            ade_index (dict): ADE20k index
+            img_indices (np.array, optional): Indices of the images to check. Defaults to all images.
+
+        Returns:
+            np.array: Boolean array, True for each image that contains a synonym.
+        """
+        presence = ade_index['objectPresence'][self.class_indices]
+        if img_indices is not None:
+            presence = presence[:, img_indices]
+        return np.asarray(presence > 0).any(axis=0)
+    
+    def syn_match_counts(self, ade_index, img_indices=None):
+        """Number of matched target classes for many images at once. Same as calling syn_match 
+        for each image.
+
+        Args:
+            ade_index (dict): ADE20k index
+            img_indices (np.array, optional): Indices of the images to check. Defaults to all images.
+
+        Returns:
+            np.array: Count of matched / 'activated' target classes per image.
+        """
+        presence = ade_index['objectPresence'][self.class_indices]
+        if img_indices is not None:
+            presence = presence[:, img_indices]
+        presence = np.asarray(presence > 0)
+        row_of = {class_id: row for row, class_id in enumerate(self.class_indices)}
+        counts = np.zeros((presence.shape[1]), dtype=int)
+        for cl in self.content_classes:
+            counts += presence[[row_of[syn] for syn in cl.synonyms]].any(axis=0)
+        return counts
         
     def syn_match(self,ade_index,img_index,classes=False):
         """Return the number of matched target classes in the given image
@@ -257,6 +388,57 @@ class AdeConfiguration(object):
 
 class Images(object):
     """Utils for dealing with image data."""
+    @staticmethod
+    def reduction(shape, target_size):
+        """Largest JPEG decoding reduction (8, 4, 2 or 1), at which an image of the given shape is 
+        still at least as large as target_size.
+
+        Args:
+            shape (tuple): Shape of the full image (height, width, ...)
+            target_size (tuple): Minimum (height, width). Either may be None to not constrain it.
+
+        Returns:
+            int: Reduction factor
+        """
+        h, w = shape[:2]
+        th, tw = target_size
+        for r in [8, 4, 2]:
+            if -(-h // r) >= (th or 0) and -(-w // r) >= (tw or 0):
+                return r
+        return 1
+    
+    @staticmethod
+    def imread(path : str, target_size : tuple = None, pillow : bool = False):
+        """Read an image with cv2 or PIL. If target_size is given, the image is decoded at a reduced
+        resolution (1/2, 1/4 or 1/8, in the DCT domain for jpg files), as long as it is still at least 
+        that large. This is much faster than decoding the full image and resizing it afterwards.
+
+        Args:
+            path (str): Path of the image
+            target_size (tuple, optional): Minimum (height, width) needed. Either may be None to not
+                constrain it. Defaults to None (full resolution).
+            pillow (bool, optional): Whether to return a PIL image. Defaults to False.
+
+        Returns:
+            cv2 image or PIL image
+        """
+        if pillow:
+            img = Image.open(path)
+            if target_size is not None:
+                r = Images.reduction((img.size[1], img.size[0]), target_size)
+                if r > 1: img.draft(img.mode, (-(-img.size[0] // r), -(-img.size[1] // r)))
+            return img
+        if target_size is None:
+            return cv2.imread(path)
+        # Only the header is read here
+        with Image.open(path) as header:
+            r = Images.reduction((header.size[1], header.size[0]), target_size)
+        return cv2.imread(path, {
+            1: cv2.IMREAD_COLOR,
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8}[r])
+
     @staticmethod
     def instance_outline(img, instance_data, color, thickness=None, lineType=None, shift=None, point_scaling=1.0):
         """Draws the outline of a single object instance on top of the image.
@@ -273,17 +455,15 @@ class Images(object):
         Returns:
             cv2 image: img with outline on top
         """
-        points = np.array([
-            [instance_data['polygon']['x'][i], instance_data['polygon']['y'][i]]
-            for i in range(len(instance_data['polygon']['x']))]) * point_scaling
-        points = points.reshape((-1, 1, 2)).astype(np.int32)
+        points = (ImgData.polygon(instance_data) * point_scaling).reshape((-1, 1, 2)).astype(np.int32)
         return cv2.polylines(img, [points], True, color, thickness=thickness, lineType=lineType, shift=shift)
 
     @staticmethod
     def class_outlines(img, img_data, classes_colors, legend=True, add_info=False, highlight_instances=[],scaling=1.0):
         """Create image with outlines of class instances of given classes. The given classes are painted
         in that order. The color is in RGB, image is expected as loaded from cv2 (with BGR, conversion
-        is done here)
+        is done here). The image may be decoded at a reduced resolution (see Images.imread), it is 
+        resized to the size in the annotation times scaling.
 
         Args:
             in_folder (str): Folder containing the jpg and json file
@@ -293,6 +473,7 @@ class Images(object):
             add_info (bool): Whether to return additional info
             highlight_instances (List[dict]): List of instances to highlight. Each item needs attributes
             'id' 'color' and 'thickness'.
+            scaling (float): Size of the result relative to the size in the annotation
 
         Returns (add_info=False):
             cv2 image: Photograph with outlines
@@ -304,42 +485,56 @@ class Images(object):
         """
 
         font = cv2.FONT_HERSHEY_SIMPLEX
-        legend_y = img.shape[0]-2
         counts = {}
         
-        #size = (int(img.shape[0] * scaling),int(img.shape[1]*scaling))
-        img = cv2.resize(img,[0,0],fx=scaling,fy=scaling,interpolation=cv2.INTER_AREA)
+        # The polygons are in the coordinates of the annotation, the image might be smaller
+        height, width = img_data['imsize'][:2]
+        size = (max(1,int(round(width*scaling))), max(1,int(round(height*scaling))))
+        if (img.shape[1], img.shape[0]) != size:
+            img = cv2.resize(img,size,interpolation=cv2.INTER_AREA)
+        legend_y = img.shape[0]-2
 
+        # Collect the polygons of each (color, thickness) group first and draw each group with a
+        # single polylines call. Highlights are drawn first, then the classes in the given order.
+        highlight_groups = {}
         for inst in highlight_instances:
             col = (inst['color'][2], inst['color'][1], inst['color'][0])
-            img = Images.instance_outline(img, ImgData.find_obj_by_id(
-                img_data, inst['id']), col, inst['thickness'],point_scaling=scaling)
+            highlight_groups.setdefault((col, inst['thickness']), []).append(
+                ImgData.polygon(ImgData.find_obj_by_id(img_data, inst['id'])))
 
+        names, _ = ImgData.object_arrays(img_data)
+        class_groups = {}
+        legend_items = []
         for classname, partof, col, thickness in classes_colors:
             # bgr <-> rgb
             col = (col[2], col[1], col[0])
-            count = 0
             # Find instances matching classname and optionally the parent's class
-            for o in img_data['object']:
-                if o['name_ndx'] != classname:
-                    continue
-                if partof and type(o['parts']['ispartof']) == int:
-                    parent_id = o['parts']['ispartof']
-                    parent = ImgData.find_obj_by_id(img_data, parent_id)
-                    if parent['name'] != partof:
-                        continue
-                count += 1
-                img = Images.instance_outline(img, o, col, thickness,point_scaling=scaling)
+            indices = np.flatnonzero(names == classname)
+            if partof:
+                indices = [i for i in indices if type(img_data['object'][i]['parts']['ispartof']) != int or 
+                    ImgData.find_obj_by_id(img_data, img_data['object'][i]['parts']['ispartof'])['name'] == partof]
+            count = len(indices)
+            class_groups.setdefault((col, thickness), []).extend(
+                ImgData.polygon(img_data['object'][i]) for i in indices)
 
             if not classname in counts:
                 counts[classname] = count
             else:
                 counts[classname] = max(count, counts[classname])
 
-            if legend:
-                text = f"{count:2}x #{classname}"
-                if partof:
-                    text = text + " from " + partof
+            text = f"{count:2}x #{classname}"
+            if partof:
+                text = text + " from " + partof
+            legend_items.append((text, col))
+        
+        for groups in [highlight_groups, class_groups]:
+            for (col, thickness), polygons in groups.items():
+                points = [(p * scaling).reshape((-1, 1, 2)).astype(np.int32) for p in polygons if len(p) > 0]
+                if len(points) > 0:
+                    img = cv2.polylines(img, points, True, col, thickness=thickness)
+
+        if legend:
+            for text, col in legend_items:
                 pos = (0, legend_y)
                 cv2.putText(img, text, pos, font, 0.5,
                             (255, 255, 255, 0.5), 6, cv2.LINE_AA)
@@ -352,7 +547,7 @@ class Images(object):
     
     @staticmethod
     def annotate(conf : AdeConfiguration, filename : str, folder : str, img_data : dict = None,
-     detection_thres : int = 2, stats = False,color = False, skip_zero_index = True):
+     detection_thres : int = 2, stats = False,color = False, skip_zero_index = True, mask_cache : dict = None):
         """Find matches of target classes for the given image and return a new segmentation image
         with the colors from conf. Returns None, if no matches were found (can be used to do the 
         matching as well). If color = False, the pixels are the class indices, incremented by one if 
@@ -368,6 +563,8 @@ class Images(object):
             stats (bool): Whether to also return the list of matches
             color (bool): Whether to fill the pixels with the colors instead of the class indices
             skip_zero_index (bool): Whether to increment class indices by one for color=False
+            mask_cache (dict, optional): Dict of instance masks by object id, loaded masks are put
+                there and reused. Pass the same dict to annotate an image with multiple configurations.
 
         Returns:
             None, if the number of found matches is below the detection threshold
@@ -379,15 +576,8 @@ class Images(object):
             img_data = ImgData.load(folder,filename)
         
         # Look for all matches first. If none, abort.
-        matches = []
-        classes = 0
-        for t_class in conf.content_classes:
-            if not t_class.scene_match(img_data): 
-                matches.append([])
-            else:
-                match = t_class.full_match(img_data)
-                matches.append(match)
-                if len(match) > 0: classes += 1
+        matches = conf.full_match(img_data)
+        classes = sum(len(match) > 0 for match in matches)
         
         if classes < detection_thres: return None
         
@@ -413,14 +603,105 @@ class Images(object):
             mask = zero_mask
             for obj in match:
                 obj_id = obj['id']
-                newmask = cv2.imread(
-                        os.path.join(masks_folder,f"instance_{obj_id:03}_{filename}.png"),
-                        cv2.IMREAD_GRAYSCALE
-                    )
+                if mask_cache is not None and obj_id in mask_cache:
+                    newmask = mask_cache[obj_id]
+                else:
+                    newmask = cv2.imread(
+                            os.path.join(masks_folder,f"instance_{obj_id:03}_{filename}.png"),
+                            cv2.IMREAD_GRAYSCALE
+                        )
+                    if mask_cache is not None: mask_cache[obj_id] = newmask
                 mask = cv2.bitwise_or(mask,newmask)
             img[mask > 0] = t_class.cv2color if color else t_class.id+1
         if stats: return img, matches
         else: return img
+
+    @staticmethod
+    def export_shape(shape, max_side : int = None):
+        """Compute the size an image of the given shape is resized to for export, such that its
+        longer side is at most max_side. Smaller images keep their size.
+
+        Args:
+            shape (tuple): Shape of the image (height, width, ...)
+            max_side (int, optional): Maximum length of the longer side. None disables resizing.
+
+        Returns:
+            tuple: (height, width) of the exported image
+        """
+        h, w = shape[:2]
+        if max_side is None or max(h, w) <= max_side:
+            return (h, w)
+        fac = max_side / max(h, w)
+        return (max(1, int(round(h * fac))), max(1, int(round(w * fac))))
+
+    @staticmethod
+    def export_annotation(ann, max_side : int):
+        """Resize an annotation (class indices) with nearest-neighbor for export, so that the 
+        longer side is at most max_side. Small enough annotations are returned unchanged."""
+        h, w = Images.export_shape(ann.shape, max_side)
+        if (h, w) == ann.shape[:2]:
+            return ann
+        return cv2.resize(ann, (w, h), interpolation=cv2.INTER_NEAREST)
+
+    @staticmethod
+    def resize_export(img_path : str, ann, max_side : int, jpeg_quality : int = 95):
+        """Load a training image and resize it together with its annotation for export, so that 
+        the longer side is at most max_side. The image is resized with area interpolation, the 
+        annotation (class indices) with nearest-neighbor. Images that are small enough are passed
+        through without re-encoding.
+
+        Args:
+            img_path (str): Path of the training image (.jpg)
+            ann (np.array): Annotation with class indices, same size as the image. May be None.
+            max_side (int): Maximum length of the longer side
+            jpeg_quality (int, optional): Quality of the re-encoded jpg. Defaults to 95.
+
+        Returns:
+            bytes: The encoded jpg to write
+            np.array: The (resized) annotation
+            dict: Sizes in bytes and decode times in seconds of the original and exported image
+                  ('bytes_original', 'bytes_written', 'decode_original', 'decode_written'), and the
+                  counters 'images' and 'resized'. Can be summed up key-wise over many images.
+        """
+        with open(img_path, "rb") as f:
+            raw = f.read()
+        t = time.perf_counter()
+        img = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+        decode_original = time.perf_counter() - t
+        
+        h, w = Images.export_shape(img.shape, max_side)
+        if (h, w) == img.shape[:2]:
+            jpg = raw
+            decode_written = decode_original
+        else:
+            img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+            if ann is not None: ann = Images.export_annotation(ann, max_side)
+            jpg = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+            t = time.perf_counter()
+            cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            decode_written = time.perf_counter() - t
+        
+        return jpg, ann, {
+            'images': 1,
+            'resized': int(jpg is not raw),
+            'bytes_original': len(raw),
+            'bytes_written': len(jpg),
+            'decode_original': decode_original,
+            'decode_written': decode_written
+        }
+    
+    @staticmethod
+    def export_report(export_stats : dict):
+        """Returns a short summary string of export stats as returned by resize_export, summed up
+        over all exported images."""
+        if export_stats.get('images', 0) == 0:
+            return "No images exported."
+        mb = 1024*1024
+        return (f"Exported {export_stats['images']} images ({export_stats['resized']} resized): "
+            f"{export_stats['bytes_original']/mb:.1f} MB -> {export_stats['bytes_written']/mb:.1f} MB "
+            f"({100*(1-export_stats['bytes_written']/export_stats['bytes_original']):.1f}% saved), "
+            f"decode time {1000*export_stats['decode_original']/export_stats['images']:.1f} ms -> "
+            f"{1000*export_stats['decode_written']/export_stats['images']:.1f} ms per image")
  
   
 class AdeIndex(object):
@@ -497,7 +778,7 @@ class AdeIndex(object):
         return os.path.join(project_root_folder,ade_index['folder'][img_index],ade_index['filename'][img_index][:-4])
         
     @staticmethod
-    def load_img(ade_index, img_index, load_imgdata=False, load_training_image=True, pillow=False):
+    def load_img(ade_index, img_index, load_imgdata=False, load_training_image=True, pillow=False, target_size=None):
         """Loads, for the given index, the training image from .jpg and/or the imgdata from .json
 
         Args:
@@ -505,6 +786,8 @@ class AdeIndex(object):
             img_index (int): Index of the image
             load_imgdata (bool, optional): Whether to load the annotations. Defaults to False.
             load_training_image (bool, optional): Whether to load the annotations. Defaults to True.
+            target_size (tuple, optional): Minimum (height, width) of the training image, which is
+                decoded at a reduced resolution if possible, see Images.imread. Defaults to None.
 
         Returns:
             cv2 image or (image, dict) or dict: image and/or annotations.
@@ -513,10 +796,7 @@ class AdeIndex(object):
         filename = ade_index['filename'][img_index][:-4]
         foldername = ade_index['folder'][img_index]
         if load_training_image:
-            if pillow:
-                img = Image.open(AdeIndex.img_path(ade_index,img_index))
-            else:
-                img = cv2.imread(AdeIndex.img_path(ade_index,img_index))
+            img = Images.imread(AdeIndex.img_path(ade_index,img_index),target_size,pillow)
         if load_imgdata:
             img_data = ImgData.load(foldername, filename)
             if load_training_image: return (img, img_data)
@@ -760,6 +1040,44 @@ class ImgData(object):
         print(f"!!! no object with id {index}")
         return None
 
+    @staticmethod
+    def object_arrays(img_data):
+        """Class index of every object and of its parent object as arrays, in the order of the 
+        'object' list. Computed once and cached in img_data.
+
+        Args:
+            img_data (dict): Image annotation data
+
+        Returns:
+            np.array: Class index of each object
+            np.array: Class index of the parent of each object. -1 if it has no parent, -2 if the
+                      parent object is missing in the annotation.
+        """
+        if '_object_arrays' in img_data:
+            return img_data['_object_arrays']
+        class_by_id = {}
+        for obj in img_data['object']:
+            class_by_id.setdefault(obj['id'], obj['name_ndx'])
+        names = np.array([obj['name_ndx'] for obj in img_data['object']], dtype=np.int64)
+        parents = np.array([
+            class_by_id.get(obj['parts']['ispartof'], -2) if type(obj['parts']['ispartof']) == int else -1
+            for obj in img_data['object']], dtype=np.int64)
+        img_data['_object_arrays'] = (names, parents)
+        return names, parents
+
+    @staticmethod
+    def polygon(obj):
+        """Outline polygon of an object instance as array of shape (n, 2) with x, y columns. Computed 
+        once and cached in the object."""
+        if '_polygon' not in obj:
+            obj['_polygon'] = np.column_stack((obj['polygon']['x'], obj['polygon']['y'])).astype(np.float64)
+        return obj['_polygon']
+
+    @staticmethod
+    def is_portrait(img_data):
+        """Whether the image is higher than wide, without loading it."""
+        return img_data['imsize'][0] > img_data['imsize'][1]
+
     @staticmethod
     def objects_of_class(img_data, class_id):
         """Iterator over all objects of given class in image
@@ -802,40 +1120,321 @@ class AdeStats(object):
         return classes
 
 
+class Sampling(object):
+    """Stratified random sampling of images, to estimate counts over the whole dataset with 
+    confidence intervals from a small sample of images, instead of loading all of them."""
+
+    @staticmethod
+    def strata(ade_index, syn_counts, img_indices, sample_size : int, min_expected : int = 2):
+        """Assign each of the given images to a stratum by its scene and its number of synonym 
+        matches. Strata expected to get less than min_expected samples are merged across scenes
+        first and then across synonym-match counts.
+
+        Args:
+            ade_index (dict): ADE20k index
+            syn_counts (np.array): Number of synonym matches of each image
+            img_indices (np.array): Indices of the images to stratify
+            sample_size (int): Planned total sample size
+            min_expected (int, optional): Minimum expected number of samples per stratum. Defaults to 2.
+
+        Returns:
+            np.array: Stratum index (0 .. number of strata - 1) of each image
+        """
+        keys = [(str(ade_index['scene'][i]).strip(" /"), int(c)) for i,c in zip(img_indices, syn_counts)]
+        fac = sample_size / max(len(keys), 1)
+        for merged in [lambda key: ("other", key[1]), lambda key: ("other", -1)]:
+            sizes = {}
+            for key in keys:
+                sizes[key] = sizes.get(key, 0) + 1
+            keys = [merged(key) if sizes[key] * fac < min_expected else key for key in keys]
+        ids = {key: i for i,key in enumerate(sorted(set(keys), key=str))}
+        return np.array([ids[key] for key in keys], dtype=int)
+    
+    @staticmethod
+    def sample(strata, sample_size : int, seed : int = None):
+        """Draw a stratified random sample without replacement. The sample size of each stratum 
+        is proportional to its size, but at least one.
+
+        Args:
+            strata (np.array): Stratum index of each item, as returned by strata()
+            sample_size (int): Total number of items to sample (approximately)
+            seed (int, optional): Seed for the random generator. Defaults to None.
+
+        Returns:
+            np.array: Positions of the sampled items in strata
+        """
+        rng = np.random.default_rng(seed)
+        sizes = np.bincount(strata)
+        alloc = np.minimum(sizes, np.maximum(1, np.round(sizes * sample_size / len(strata)))).astype(int)
+        return np.concatenate([
+            rng.choice(np.flatnonzero(strata == h), alloc[h], replace=False)
+            for h in range(len(sizes)) if sizes[h] > 0])
+    
+    @staticmethod
+    def estimate_totals(values, sample_strata, strata_sizes, z : float = 1.96):
+        """Estimate the totals of per-image values over all stratified images from a sample.
+
+        Args:
+            values (np.array): Values of the sampled images, of shape (samples, k)
+            sample_strata (np.array): Stratum index of each sampled image
+            strata_sizes (np.array): Number of images in each stratum
+            z (float, optional): z-value of the confidence interval. Defaults to 1.96 (95%).
+
+        Returns:
+            np.array: Estimated totals (k)
+            np.array: Half-widths of the confidence intervals of the totals (k)
+        """
+        values = np.asarray(values, dtype=float).reshape((len(sample_strata), -1))
+        total = np.zeros(values.shape[1])
+        var = np.zeros(values.shape[1])
+        # Fallback for strata with only one sample
+        pooled_var = values.var(axis=0, ddof=1) if len(values) > 1 else np.zeros(values.shape[1])
+        for h, size in enumerate(strata_sizes):
+            these = values[sample_strata == h]
+            if len(these) == 0: continue
+            total += size * these.mean(axis=0)
+            s2 = these.var(axis=0, ddof=1) if len(these) > 1 else pooled_var
+            var += size**2 * (1 - len(these)/size) * s2 / len(these)
+        return total, z * np.sqrt(var)
+    
+    @staticmethod
+    def fmt(estimate, halfwidth):
+        """Format an estimate with its confidence interval."""
+        return f"{estimate:.0f} ± {halfwidth:.0f}"
+
+
+def _plot_parent_stats(job):
+    """Worker of Plots.parent_stats_batch: draw one parent and scene bar plot and save it. The 
+    figure is created once per process and reused as template for all plots."""
+    global _parent_stats_figure
+    (title_parents, parent_labels, parent_counts, title_scenes, scene_labels, scene_counts), save_path = job
+    if _parent_stats_figure is None:
+        fig = Figure(figsize=[14,6])
+        FigureCanvasAgg(fig)
+        _parent_stats_figure = (fig, fig.subplots(1,2,gridspec_kw={'width_ratios': [3, 1]}))
+    fig, ax = _parent_stats_figure
+    for a in ax: a.cla()
+    
+    ticks = np.arange(len(parent_labels))
+    ax[0].set_title(title_parents)
+    ax[0].bar(ticks, parent_counts)
+    ax[0].set_xticks(ticks)
+    ax[0].set_xticklabels(parent_labels,rotation="vertical",fontsize=7)
+    
+    ticks = np.arange(len(scene_labels))
+    ax[1].set_title(title_scenes)
+    ax[1].bar(ticks, scene_counts)
+    ax[1].set_xticks(ticks)
+    ax[1].set_xticklabels(scene_labels,rotation="vertical")
+    
+    fig.tight_layout()
+    fig.savefig(save_path)
+
+_parent_stats_figure = None
+
+
 class Plots(object):
+    """Plots of the ADE20k stats. Figures are drawn with the Agg backend without pyplot, so they
+    never accumulate and can be rendered in parallel."""
 
     @staticmethod
-    def parent_stats(ade_index, ade_stats : dict, class_id : int, save_path : str):
+    def parent_stats_data(ade_index, ade_stats : dict, class_id : int):
+        """Titles, labels and counts of the parent and scene occurrence plots of a class.
+
+        Args:
+            ade_index (dict): ADE20k index
+            ade_stats (dict): ADE20k stats
+            class_id (int): Index of the class
+
+        Returns:
+            tuple: (parents title, parent labels, parent counts, scenes title, scene labels, scene counts)
+        """
         def trim(st):
             l = 20
             if len(st) > l+2:
                 return st[:l] + ".."
             return st
-            
-        fig, ax = plt.subplots(1,2,figsize=[14,6],gridspec_kw={'width_ratios': [3, 1]})
         
         parents = ade_stats['classes'][class_id]['parents']
         parents = sorted(parents.items(),key=lambda item: item[1],reverse=True)
-        parents = dict(parents)
-        
-        ticklabels = ["NONE" if idd == -1 else trim(AdeIndex.classname(ade_index, idd))
-                for idd in parents.keys()]
-        ticks = np.arange(len(ticklabels))
-        ax[0].set_title("Parent occurrence for "+AdeIndex.classname(ade_index, class_id))
-        ax[0].bar(ticks,
-            parents.values())
-        ax[0].set_xticks(ticks)
-        ax[0].set_xticklabels(ticklabels,rotation="vertical",fontsize=7)
-        
         scenes = ade_stats['classes'][class_id]['scenes']
-        ticklabels = scenes.keys()
-        ticks = np.arange(len(ticklabels))
-        ax[1].set_title("Scene occurrence for "+AdeIndex.classname(ade_index, class_id))
-        ax[1].bar(ticks,
-            scenes.values())
-        ax[1].set_xticks(ticks)
-        ax[1].set_xticklabels(ticklabels,rotation="vertical")
-        
-        plt.tight_layout()
-        plt.savefig(save_path)
+        classname = AdeIndex.classname(ade_index, class_id)
+        return ("Parent occurrence for "+classname,
+            ["NONE" if idd == -1 else trim(AdeIndex.classname(ade_index, idd)) for idd,_ in parents],
+            [count for _,count in parents],
+            "Scene occurrence for "+classname,
+            list(scenes.keys()),
+            list(scenes.values()))
+
+    @staticmethod
+    def parent_stats(ade_index, ade_stats : dict, class_id : int, save_path : str):
+        """Save a bar plot of the parent classes and scenes of a class."""
+        _plot_parent_stats((Plots.parent_stats_data(ade_index, ade_stats, class_id), save_path))
+
+    @staticmethod
+    def parent_stats_batch(ade_index, ade_stats : dict, class_ids : List[int], save_paths : List[str], processes : int = None):
+        """Save the bar plots of the parent classes and scenes of many classes, in a pool of processes.
+
+        Args:
+            ade_index (dict): ADE20k index
+            ade_stats (dict): ADE20k stats
+            class_ids (List[int]): Indices of the classes
+            save_paths (List[str]): Path to save the plot of each class to
+            processes (int, optional): Number of processes. Defaults to the number of cpus.
+        """
+        jobs = [(Plots.parent_stats_data(ade_index, ade_stats, class_id), save_path)
+            for class_id, save_path in zip(class_ids, save_paths)]
+        if len(jobs) == 0: return
+        with Pool(min(processes or os.cpu_count(), len(jobs))) as pool:
+            pool.map(_plot_parent_stats, jobs)
+
+    @staticmethod
+    def bar_chart_svg(title : str, labels : List[str], values : List[float], width : int = 600, height : int = 300):
+        """Simple inline SVG bar chart with vertical labels, for html summaries without image files.
+
+        Args:
+            title (str): Title above the chart
+            labels (List[str]): Label of each bar
+            values (List[float]): Value of each bar
+            width (int, optional): Width in pixels. Defaults to 600.
+            height (int, optional): Height in pixels. Defaults to 300.
 
+        Returns:
+            str: <svg> element
+        """
+        top, bottom, left = 20, 110, 5
+        plot_height = height - top - bottom
+        bar_width = (width - left) / max(len(values), 1)
+        max_value = max(values, default=0) or 1
+        parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-size="9">',
+            f'<text x="{width/2}" y="13" text-anchor="middle" font-size="12">{html.escape(title)}</text>']
+        for i, (label, value) in enumerate(zip(labels, values)):
+            x = left + i * bar_width
+            h = plot_height * value / max_value
+            parts.append(f'<rect x="{x+1:.1f}" y="{top+plot_height-h:.1f}" width="{max(bar_width-2,1):.1f}" '
+                f'height="{h:.1f}" fill="#1f77b4"><title>{html.escape(str(label))}: {value}</title></rect>')
+            parts.append(f'<text transform="translate({x+bar_width/2+3:.1f},{top+plot_height+4}) rotate(90)">'
+                f'{html.escape(str(label))}</text>')
+        parts.append('</svg>')
+        return "".join(parts)
+
+    @staticmethod
+    def parent_stats_html(ade_index, ade_stats : dict, class_id : int):
+        """Inline SVG version of parent_stats, for html summaries.
+
+        Returns:
+            str: html with two <svg> bar charts
+        """
+        title_parents, parent_labels, parent_counts, title_scenes, scene_labels, scene_counts = \
+            Plots.parent_stats_data(ade_index, ade_stats, class_id)
+        return (Plots.bar_chart_svg(title_parents, parent_labels, parent_counts, 
+                    width=max(300, 12*len(parent_counts)))
+            + Plots.bar_chart_svg(title_scenes, scene_labels, scene_counts, width=200))
+
+
+def _render_thumbnail(job):
+    """Worker of ThumbnailRenderer: render one thumbnail and copy it to all destinations."""
+    img_path, folder, name, img_data, height, outline_args, paths = job
+    if img_data is None:
+        img_data = ImgData.load(folder, name)
+    if height is None:
+        img = cv2.imread(img_path)
+        scaling = 1.0
+    else:
+        img = Images.imread(img_path, (height, None))
+        scaling = height / img_data['imsize'][0]
+    img = Images.class_outlines(img, img_data, scaling=scaling, **outline_args)
+    # Write to a temporary file of this job first, so that no half-written thumbnails end up in the
+    # cache, even if several jobs render the same thumbnail
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp.jpg", dir=os.path.dirname(paths[0]) or ".")
+    os.close(fd)
+    try:
+        cv2.imwrite(tmp_path, img)
+        os.replace(tmp_path, paths[0])
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for path in paths[1:]:
+        shutil.copyfile(paths[0], path)
+
+
+class ThumbnailRenderer(object):
+    """ContextManager class rendering images with outlines (see Images.class_outlines) in a pool of
+    processes. render() returns immediately, so that html can be written while the images are
+    rendered, and the context only exits when all of them are done. 
+    
+    Rendered images are cached on disk, keyed by image, outline spec, size and the modification time
+    of the annotation, such that re-runs copy unchanged thumbnails instead of rendering them again.
+    The key also contains renderer_version, which has to be increased when the rendering changes.
+    """
+    renderer_version = 1
+
+    def __init__(self, ade_index, cache_dir : str = general_conf.thumbnail_cache_path, processes : int = None):
+        """Construct
+
+        Args:
+            ade_index (dict): ADE20k index
+            cache_dir (str, optional): Folder of the cache. None disables caching. Defaults to the 
+                folder from the configuration.
+            processes (int, optional): Number of processes. Defaults to the number of cpus.
+        """
+        self.ade_index = ade_index
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.rendered = 0
+        self.cached = 0
+
+    def __enter__(self):
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.pool = Pool(self.processes)
+        self.pending = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.pool.terminate()
+            self.pool.join()
+            return
+        self.pool.close()
+        for i,result in enumerate(self.pending):
+            print(f"\rWaiting for thumbnails... {i+1}/{len(self.pending)}",end="")
+            result.get()
+        self.pool.join()
+        if len(self.pending) > 0: print()
+        print(f"{self.rendered} thumbnails rendered, {self.cached} reused from the cache.")
+
+    def render(self, img_index : int, out_path : str, classes_colors : list, 
+               highlight_instances : List[dict] = [], legend : bool = False, height : int = None,
+               img_data : dict = None):
+        """Render the image with outlines to out_path in the background, or copy it from the cache.
+
+        Args:
+            img_index (int): Index of the image
+            out_path (str): Path of the jpg file to create
+            classes_colors (list): Outlined classes, see Images.class_outlines
+            highlight_instances (List[dict], optional): Highlighted instances, see Images.class_outlines
+            legend (bool, optional): Whether to paint a legend. Defaults to False.
+            height (int, optional): Height of the thumbnail in pixels. Defaults to the full size.
+            img_data (dict, optional): Annotation data, if already loaded. Otherwise it is loaded
+                by the rendering process.
+        """
+        folder = self.ade_index['folder'][img_index]
+        name = os.path.splitext(self.ade_index['filename'][img_index])[0]
+        outline_args = dict(classes_colors=classes_colors, highlight_instances=highlight_instances,
+            legend=legend, add_info=False)
+        paths = [out_path]
+        if self.cache_dir is not None:
+            mtime = os.path.getmtime(os.path.join(project_root_folder, folder, name + ".json"))
+            key = hashlib.sha1(repr((ThumbnailRenderer.renderer_version, name, classes_colors, 
+                highlight_instances, legend, height, mtime)).encode()).hexdigest()
+            cache_path = os.path.join(self.cache_dir, key + ".jpg")
+            if os.path.exists(cache_path):
+                shutil.copyfile(cache_path, out_path)
+                self.cached += 1
+                return
+            paths = [cache_path, out_path]
+        self.rendered += 1
+        self.pending.append(self.pool.apply_async(_render_thumbnail, [(
+            AdeIndex.img_path(self.ade_index, img_index), folder, name, img_data, height, 
+            outline_args, paths)]))
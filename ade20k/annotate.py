@@ -9,12 +9,17 @@ present a folder structure ready for MMSegmentation:
 -   inout (containing both indoor and outdoor images)
 
 Snippets from the generated dataset are also extracted into a separate snippet folder (--snippet-dir), 
-to enable inspection of the results."""
+to enable inspection of the results.
+
+Multiple configurations can be given to --ade-conf, with one --out-dir each, to create multiple variants 
+of the dataset in a single pass over ADE20k. Each image and its instance masks are then only loaded once.
+If there is only one --snippet-dir for multiple configurations, a subfolder is created for each."""
 
 import argparse
 import os
 import pickle
 import shutil
+import time
 import traceback
 
 import cv2
@@ -29,48 +34,73 @@ from utils import *
 
 parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
 parser.set_defaults(overwrite=False,confirm=True,test_run=False)
-parser.add_argument('--out-dir', type=path_arg, default=conf.dataset_out_path, help='the folder to store the result in. It will be filled with subfolders for indoor,outdoor,inout_extended etc. (default from configuration)')
+parser.add_argument('--out-dir', type=path_arg, nargs='+', default=[conf.dataset_out_path], help='the folder to store the result in, one per --ade-conf. It will be filled with subfolders for indoor,outdoor,inout_extended etc. (default from configuration)')
 parser.add_argument('--overwrite', dest="overwrite", action="store_true",  help='delete previous contents of --out-dir. If not set, a dialog is shown in case the folder is not empty.')
-parser.add_argument('--ade-conf', type=path_arg, default=conf.annotate_filers_conf, help='the path to a json file with the ade-specific filters for re-annotation. (default from configuration)')
-parser.add_argument('--snippet-dir', type=path_arg, default=conf.annotate_snippet_dir, help='the folder to store some snippet of the new dataset in. (default from configuration)')
+parser.add_argument('--ade-conf', type=path_arg, nargs='+', default=[conf.annotate_filers_conf], help='the path to a json file with the ade-specific filters for re-annotation. Multiple files can be given. (default from configuration)')
+parser.add_argument('--snippet-dir', type=path_arg, nargs='+', default=[conf.annotate_snippet_dir], help='the folder to store some snippet of the new dataset in. One per --ade-conf, or a single one to create subfolders in. (default from configuration)')
 parser.add_argument('--snippet-count', type=int, default=50, help='the number of images of the new dataset to also store in the snippet-dir. (default: 50)')
 parser.add_argument('--snippet-every', type=int, default=200, help='the number of images to skip between each snippet. (default: 200)')
 parser.add_argument('--no-confirm', dest="confirm", action="store_false",  help='dont prompt a confirmation from the user after showing the configuration and before starting the re-annotation.')
 parser.add_argument('--test-run', dest="test_run", action="store_true",  help='just annotate a few random images and store the ')
+parser.add_argument('--export-max-side', type=int, default=None, help='resize exported images and annotations, such that their longer side is at most this many pixels.\nImages are resized with area interpolation, annotations with nearest-neighbor. (default: None / full resolution)')
 args = parser.parse_args()
 
+if len(args.out_dir) != len(args.ade_conf) and not args.test_run:
+    print(f"Got {len(args.ade_conf)} configurations but {len(args.out_dir)} output folders. Specify one --out-dir per --ade-conf.")
+    exit()
+if len(args.snippet_dir) == 1 and len(args.ade_conf) > 1:
+    args.snippet_dir = [os.path.join(args.snippet_dir[0],f"{i}_{os.path.splitext(os.path.basename(p))[0]}") 
+                        for i,p in enumerate(args.ade_conf)]
+elif len(args.snippet_dir) != len(args.ade_conf):
+    print(f"Got {len(args.ade_conf)} configurations but {len(args.snippet_dir)} snippet folders. Specify one --snippet-dir per --ade-conf, or a single one.")
+    exit()
+
 # Load configuration and index data
 ade_index = utils.AdeIndex.load()
-ade_conf = utils.AdeConfiguration.load(ade_index,args.ade_conf)
+jobs = []
+for i,conf_path in enumerate(args.ade_conf):
+    ade_conf = utils.AdeConfiguration.load(ade_index,conf_path)
+    jobs.append(dict(
+        conf_path = conf_path,
+        ade_conf = ade_conf,
+        out_dir = args.out_dir[i] if i < len(args.out_dir) else None,
+        snippet_dir = args.snippet_dir[i],
+        palette = np.concatenate([[0,0,0],ade_conf.palette]).astype(np.uint8),
+        imgs_found = 0,
+        snippets_made = 0,
+        stats = {
+            'images' : [],
+            'indoor_count' : 0,
+            'outdoor_count' : 0,
+            'total_count' : 0,
+            'errors' : [],
+            'skipped_prefilter' : 0,
+            'skipped_synmatch' : 0,
+            'skipped_scene' : 0,
+            'skipped_fullmatch' : 0,
+            'skipped_trainval' : 0,
+            'export_max_side' : args.export_max_side,
+            'export' : {}
+        }
+    ))
 
 if not args.test_run:
-    # Check output folder
-    if not os.path.exists(args.out_dir):
-        os.makedirs(args.out_dir)
-    elif len(os.listdir(args.out_dir)) > 0:
-        if args.overwrite or input(f"Output folder {args.out_dir} is not empty. Clear it? [y/n]").lower() in ["y","Y"]:
-            print("Deleting previous countents of",args.out_dir)
-            shutil.rmtree(args.out_dir)
-            os.makedirs(args.out_dir)
-        else:
-            print("Annotate works only for a cleared folder. Pick a different one.")
-            exit()
+    # Check output folders
+    for job in jobs:
+        out_dir = job['out_dir']
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        elif len(os.listdir(out_dir)) > 0:
+            if args.overwrite or input(f"Output folder {out_dir} is not empty. Clear it? [y/n]").lower() in ["y","Y"]:
+                print("Deleting previous countents of",out_dir)
+                shutil.rmtree(out_dir)
+                os.makedirs(out_dir)
+            else:
+                print("Annotate works only for a cleared folder. Pick a different one.")
+                exit()
     
 
-stats = {
-    'images' : [],
-    'indoor_count' : 0,
-    'outdoor_count' : 0,
-    'total_count' : 0,
-    'errors' : [],
-    'skipped_synmatch' : 0,
-    'skipped_scene' : 0,
-    'skipped_fullmatch' : 0,
-    'skipped_trainval' : 0
-}
-
 imgs_to_load = utils.num_images
-palette = np.concatenate([[0,0,0],ade_conf.palette]).astype(np.uint8)
 
 print()
 
@@ -80,169 +110,255 @@ if args.test_run:
     args.snippet_every = 1
     
 
-# Show configuration and ask confirmation
-if args.test_run:
-    print(f"TEST RUN: Threshold: {ade_conf.detection_thres}, Images to process: {imgs_to_load}")
-    print("All images stored in", args.snippet_dir)
-else:
-    print(f"Threshold: {ade_conf.detection_thres}, Images to process: {imgs_to_load}, extract {args.snippet_count} snippets taken every {args.snippet_every} images")
-    print("Dataset output folder:",args.out_dir)
-    print("Snippet output folder",args.snippet_dir)
-    
-print()
-t = PrettyTable()
-t.field_names = ["id","class","scene","color (rgb)"]
-i = 0
-t.add_row([i,"SKIPPED","",f"{palette[i*3]:3d} {palette[i*3+1]:3d} {palette[i*3+2]:3d}"])
-for ind, cl in ade_conf.all_classes.items():
-    i = ind+1
-    t.add_row([i,cl.name,"both" if cl.scene is None else cl.scene,f"{palette[i*3]:3d} {palette[i*3+1]:3d} {palette[i*3+2]:3d}"])
-#t.set_style(PLAIN_COLUMNS)
-print(t)
+# Show configurations and ask confirmation
+for job in jobs:
+    ade_conf = job['ade_conf']
+    palette = job['palette']
+    print("Configuration",job['conf_path'])
+    if args.test_run:
+        print(f"TEST RUN: Threshold: {ade_conf.detection_thres}, Images to process: {imgs_to_load}")
+        print("All images stored in", job['snippet_dir'])
+    else:
+        print(f"Threshold: {ade_conf.detection_thres}, Images to process: {imgs_to_load}, extract {args.snippet_count} snippets taken every {args.snippet_every} images")
+        print("Dataset output folder:",job['out_dir'])
+        if args.export_max_side is not None:
+            print(f"Exported images and annotations are resized to at most {args.export_max_side} px")
+        print("Snippet output folder",job['snippet_dir'])
+        
+    print()
+    t = PrettyTable()
+    t.field_names = ["id","class","scene","color (rgb)"]
+    i = 0
+    t.add_row([i,"SKIPPED","",f"{palette[i*3]:3d} {palette[i*3+1]:3d} {palette[i*3+2]:3d}"])
+    for ind, cl in ade_conf.all_classes.items():
+        i = ind+1
+        t.add_row([i,cl.name,"both" if cl.scene is None else cl.scene,f"{palette[i*3]:3d} {palette[i*3+1]:3d} {palette[i*3+2]:3d}"])
+    #t.set_style(PLAIN_COLUMNS)
+    print(t)
+    print()
 
 if args.confirm and input("Okay? [y/n] ") != "y": exit()
 
-if not os.path.exists(args.snippet_dir): os.makedirs(args.snippet_dir)
-if not args.test_run:
-    # Create folder structure       
-    for l0 in ["indoor","inout","outdoor"]:
-        for l1 in ["annotations","images"]:
-            for l2 in ["train","val"]:
-                path = os.path.join(args.out_dir,l0,l1,l2)
-                if not os.path.exists(path): os.makedirs(path)
-
-    # Copy configuration to output folder
-    shutil.copy(args.ade_conf,os.path.join(args.out_dir,"filters.json"))
-else:
-    shutil.copy(args.ade_conf,os.path.join(args.snippet_dir,"filters.json"))
+for job in jobs:
+    if not os.path.exists(job['snippet_dir']): os.makedirs(job['snippet_dir'])
+    if not args.test_run:
+        # Create folder structure       
+        for l0 in ["indoor","inout","outdoor"]:
+            for l1 in ["annotations","images"]:
+                for l2 in ["train","val"]:
+                    path = os.path.join(job['out_dir'],l0,l1,l2)
+                    if not os.path.exists(path): os.makedirs(path)
+
+        # Copy configuration to output folder
+        shutil.copy(job['conf_path'],os.path.join(job['out_dir'],"filters.json"))
+    else:
+        shutil.copy(job['conf_path'],os.path.join(job['snippet_dir'],"filters.json"))
+
 
+# Candidate selection: reject all images without any synonym in bulk and count the synonym
+# matches of the remaining ones, before looking at any image individually. Images are candidates
+# if they pass the prefilter of at least one configuration.
+start_time = time.time()
+img_order = np.random.permutation(utils.num_images)
+prefiltered = np.array([job['ade_conf'].prefilter(ade_index,img_order) for job in jobs])
+# Number of images in img_order up to each position rejected by the prefilter of each configuration,
+# to count only the rejected images a configuration would have examined
+rejected = np.cumsum(~prefiltered,axis=1)
+positions = np.flatnonzero(prefiltered.any(axis=0))
+candidates = img_order[positions]
+prefiltered = prefiltered[:,positions]
+syn_counts = np.array([job['ade_conf'].syn_match_counts(ade_index,candidates) for job in jobs])
+candidate_time = time.time() - start_time
+for j,job in enumerate(jobs):
+    job['stats']['time_candidate_selection'] = candidate_time
+print(f"Candidate selection took {candidate_time:.2f}s: {utils.num_images - len(candidates)} images without any synonym skipped, {len(candidates)} candidates left.")
 
-imgs_found = 0
-snippets_made = 0
-imgs_skipped = 0
-for cc,img_index in enumerate(utils.AdeIndex.any_images(random=True)):
+def skip(job,reason):
+    job['stats']['skipped_'+reason] += 1
+
+def record_error(job,img_index,e):
+    job['stats']['errors'].append({
+        'img_id': img_index,
+        'error': e,
+        'error_print': str(e)
+    })
+
+def process(job,img_index,det,img_data,mode,mask_cache,export):
+    """Annotate one image with the configuration of the job and store the results."""
+    ade_conf = job['ade_conf']
+    stats = job['stats']
+    palette = job['palette']
+    filename = ade_index['filename'][img_index][:-4]
+    folder = ade_index['folder'][img_index]
+    scene = img_data['scene'][0]
+    
+    result = utils.Images.annotate(
+        ade_conf,filename,folder,img_data=img_data,
+        detection_thres=ade_conf.detection_thres,stats=True,mask_cache=mask_cache)
+    if result is None:
+        # Also checking parent and scene constraints yielded too few matches
+        skip(job,'fullmatch')
+        return
+    
+    ann_indices, matches = result
+    ann_img = Image.fromarray(ann_indices,mode='P')
+    ann_img.putpalette(palette)
+    stats[scene+'_count'] += 1
+    stats['total_count'] += 1
+    if not args.test_run:
+        if args.export_max_side is None:
+            # Save png image (annotation):
+            ann_img.save(os.path.join(job['out_dir'],scene,"annotations",mode,filename+".png"),format="PNG")
+            ann_img.save(os.path.join(job['out_dir'],"inout","annotations",mode,filename+".png"),format="PNG")
+            # Copy jpg image (image):
+            shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
+                        os.path.join(job['out_dir'],scene,"images",mode,ade_index['filename'][img_index]))
+            shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
+                        os.path.join(job['out_dir'],"inout","images",mode,ade_index['filename'][img_index]))
+        else:
+            # The image is resized once for all configurations, and written to both locations
+            if not 'jpg' in export:
+                export['jpg'], _, export['info'] = utils.Images.resize_export(
+                    utils.AdeIndex.img_path(ade_index, img_index), None, args.export_max_side)
+            for k,v in export['info'].items():
+                stats['export'][k] = stats['export'].get(k,0) + v
+            export_ann_img = Image.fromarray(utils.Images.export_annotation(ann_indices,args.export_max_side),mode='P')
+            export_ann_img.putpalette(palette)
+            for l0 in [scene,"inout"]:
+                export_ann_img.save(os.path.join(job['out_dir'],l0,"annotations",mode,filename+".png"),format="PNG")
+                with open(os.path.join(job['out_dir'],l0,"images",mode,ade_index['filename'][img_index]),"wb") as jpg_file:
+                    jpg_file.write(export['jpg'])
+    
+    match_list = {}
+    for i,m in enumerate(matches):
+        if len(m) > 0:
+            match_list[ade_conf.content_classes[i].name] = len(m)
+    
+    stats['images'].append({
+        'id': int(img_index),
+        'syn_matches': int(det),
+        'full_matches': len(match_list),
+        'scene': scene,
+        'matches': match_list
+    })
+    
+    if args.test_run or job['snippets_made'] < args.snippet_count:
+        snippet_dir = job['snippet_dir']
+        # Save png image (annotation):
+        ann_img.save(os.path.join(snippet_dir,filename+".png"),format="PNG")
+        # Copy jpg image (image):
+        shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
+                    os.path.join(snippet_dir,ade_index['filename'][img_index]))
+                    
+        rgb_img = utils.AdeIndex.load_img(ade_index,img_index,pillow=True)
+        overlay_img = Image.blend(rgb_img,ann_img.convert('RGB'),0.5)
+        
+        fig,ax = plt.subplots(nrows=2,ncols=1,sharex=True,figsize=(8,10))
+        ax[0].imshow(rgb_img)
+        ax[0].axis('off')
+        ax[1].imshow(overlay_img)
+        
+        legend_handles = []
+        for i, match in enumerate(matches):
+            if len(match) == 0: continue
+            t_class = ade_conf.content_classes[i]
+            legend_handles.append(mpatches.Patch(
+                color=t_class.color/255, label=f"{t_class.name} ({len(match)})"))
+        t_class = ade_conf.remains_classes[img_data['scene'][0]]
+        legend_handles.append(mpatches.Patch(
+            color=t_class.color/255, label=f"{t_class.name} (remains)"))
+        ax[1].legend(bbox_to_anchor=(1,1), loc="upper left",handles=legend_handles)
+        
+        ax[1].axis('off')
+        plt.tight_layout()
+        plt.subplots_adjust(right=0.8)
+        
+        plt.savefig(os.path.join(snippet_dir,filename + "_vis.png"))
+        plt.close('all')
+        
+        job['snippets_made'] += 1
+        
+    job['imgs_found'] += 1
+
+
+for cc,img_index in enumerate(candidates):
+    for j,job in enumerate(jobs):
+        if job['imgs_found'] < imgs_to_load:
+            job['stats']['skipped_prefilter'] = int(rejected[j,positions[cc]])
+    # Configurations still looking for images, which passed their own prefilter
+    open_jobs = [j for j,job in enumerate(jobs) if job['imgs_found'] < imgs_to_load and prefiltered[j,cc]]
+    if len(open_jobs) == 0:
+        if all(job['imgs_found'] >= imgs_to_load for job in jobs): break
+        continue
     try:
-        print(progress_bar(cc,utils.num_images,length=30,add_numbers=True),
-            "outdoor:", stats['outdoor_count'], 
-            "indoor:", stats['indoor_count'],
-            "skipped:", imgs_skipped, 
-            "errors:", len(stats['errors']), 
-            "snippets:", snippets_made ,end="\r")
+        print(progress_bar(cc,len(candidates),length=30,add_numbers=True),
+            " | ".join([f"outdoor: {job['stats']['outdoor_count']} indoor: {job['stats']['indoor_count']} "
+            f"errors: {len(job['stats']['errors'])} snippets: {job['snippets_made']}" for job in jobs]),end="\r")
         
-        det = ade_conf.syn_match(ade_index,img_index)
-        if det < ade_conf.detection_thres: 
-            # Just checking synonyms yielded too few matches
-            stats['skipped_synmatch'] += 1
-            imgs_skipped += 1
-            continue
+        active_jobs = []
+        for j in open_jobs:
+            if syn_counts[j,cc] < jobs[j]['ade_conf'].detection_thres: 
+                # Just checking synonyms yielded too few matches
+                skip(jobs[j],'synmatch')
+            else:
+                active_jobs.append(j)
+        if len(active_jobs) == 0: continue
         
         filename = ade_index['filename'][img_index][:-4]
-        folder = ade_index['folder'][img_index]
         img_data = utils.ImgData.loadi(ade_index,img_index)
         scene = img_data['scene'][0]
         
         if not scene in {"indoor","outdoor"} : 
             # Scene is not recognized
-            stats['skipped_scene'] += 1
-            imgs_skipped += 1
+            for j in active_jobs: skip(jobs[j],'scene')
             continue
         
         if filename[4] == "t": mode = "train" 
         elif filename[4] == "v": mode = "val"
         else: 
             #print("Unrecognized mode:",filename)
-            stats['skipped_trainval'] += 1
-            imgs_skipped += 1
-            continue
-        
-        result = utils.Images.annotate(
-            ade_conf,filename,folder,img_data=img_data,
-            detection_thres=ade_conf.detection_thres,stats=True)
-        if result is None:
-            # Also checking parent and scene constraints yielded too few matches
-            stats['skipped_fullmatch'] += 1
-            imgs_skipped += 1
+            for j in active_jobs: skip(jobs[j],'trainval')
             continue
         
-        ann_indices, matches = result
-        ann_img = Image.fromarray(ann_indices,mode='P')
-        ann_img.putpalette(palette)
-        stats[scene+'_count'] += 1
-        stats['total_count'] += 1
-        if not args.test_run:
-            # Save png image (annotation):
-            ann_img.save(os.path.join(args.out_dir,scene,"annotations",mode,filename+".png"),format="PNG")
-            ann_img.save(os.path.join(args.out_dir,"inout","annotations",mode,filename+".png"),format="PNG")
-            # Copy jpg image (image):
-            shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
-                        os.path.join(args.out_dir,scene,"images",mode,ade_index['filename'][img_index]))
-            shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
-                        os.path.join(args.out_dir,"inout","images",mode,ade_index['filename'][img_index]))
-        
-        match_list = {}
-        for i,m in enumerate(matches):
-            if len(m) > 0:
-                match_list[ade_conf.content_classes[i].name] = len(m)
-        
-        stats['images'].append({
-            'id': img_index,
-            'syn_matches': det,
-            'full_matches': len(match_list),
-            'scene': scene,
-            'matches': match_list
-        })
-        
-        if args.test_run or snippets_made < args.snippet_count:
-            # Save png image (annotation):
-            ann_img.save(os.path.join(args.snippet_dir,filename+".png"),format="PNG")
-            # Copy jpg image (image):
-            shutil.copy(utils.AdeIndex.img_path(ade_index, img_index),
-                        os.path.join(args.snippet_dir,ade_index['filename'][img_index]))
-                        
-            rgb_img = utils.AdeIndex.load_img(ade_index,img_index,pillow=True)
-            overlay_img = Image.blend(rgb_img,ann_img.convert('RGB'),0.5)
-            
-            fig,ax = plt.subplots(nrows=2,ncols=1,sharex=True,figsize=(8,10))
-            ax[0].imshow(rgb_img)
-            ax[0].axis('off')
-            ax[1].imshow(overlay_img)
-            
-            legend_handles = []
-            for i, match in enumerate(matches):
-                if len(match) == 0: continue
-                t_class = ade_conf.content_classes[i]
-                legend_handles.append(mpatches.Patch(
-                    color=t_class.color/255, label=f"{t_class.name} ({len(match)})"))
-            t_class = ade_conf.remains_classes[img_data['scene'][0]]
-            legend_handles.append(mpatches.Patch(
-                color=t_class.color/255, label=f"{t_class.name} (remains)"))
-            ax[1].legend(bbox_to_anchor=(1,1), loc="upper left",handles=legend_handles)
-            
-            ax[1].axis('off')
-            plt.tight_layout()
-            plt.subplots_adjust(right=0.8)
-            
-            plt.savefig(os.path.join(args.snippet_dir,filename + "_vis.png"))
-            plt.close('all')
-            
-            snippets_made += 1
-            
-        imgs_found += 1
-        if imgs_found >= imgs_to_load: break
-        
     except KeyboardInterrupt:
         break
         
     except BaseException as e:
         traceback.print_exc()
-        stats['errors'].append({
-            'img_id': img_index,
-            'error': e,
-            'error_print': str(e)
-        })
+        for j in open_jobs: record_error(jobs[j],img_index,e)
+        continue
+    
+    # Shared between the configurations, so every mask and the resized image is only loaded once
+    mask_cache = {}
+    export = {}
+    interrupted = False
+    for j in active_jobs:
+        try:
+            process(jobs[j],img_index,syn_counts[j,cc],img_data,mode,mask_cache,export)
+        except KeyboardInterrupt:
+            interrupted = True
+            break
+        except BaseException as e:
+            traceback.print_exc()
+            record_error(jobs[j],img_index,e)
+    if interrupted: break
+else:
+    # All images were examined, including the rejected ones after the last candidate
+    for j,job in enumerate(jobs):
+        if job['imgs_found'] < imgs_to_load:
+            job['stats']['skipped_prefilter'] = int(rejected[j,-1])
         
 print()
+for job in jobs:
+    stats = job['stats']
+    print("Configuration",job['conf_path'])
+    print("Skipped images:",", ".join([f"{k[8:]}: {v}" for k,v in stats.items() if k.startswith("skipped_")]))
+    if args.export_max_side is not None and not args.test_run:
+        print(utils.Images.export_report(stats['export']))
 
-stats_dir = args.snippet_dir if args.test_run else args.out_dir
-with open(os.path.join(stats_dir,"stats.pkl"),"wb") as statsfile:
-    pickle.dump(stats,statsfile)
+    stats_dir = job['snippet_dir'] if args.test_run else job['out_dir']
+    with open(os.path.join(stats_dir,"stats.pkl"),"wb") as statsfile:
+        pickle.dump(stats,statsfile)
+    if not args.test_run:
+        # Extended datasets list the annotated images in their split files
+        write_extended_splits(job['out_dir'])
@@ -16,11 +16,16 @@ import ade_utils as utils
 from utils import *
 
 parser = argparse.ArgumentParser(description=__doc__)
+parser.set_defaults(cache=True)
 parser.add_argument('--out-dir', type=path_arg, default="ade_summary", help='the folder to create the folder structure and store the html and image files in . (default: "ade_summary")')
 parser.add_argument('-n','--classnames',nargs='*',default=[],help='single classes to look for, separated by colon (:).')
 parser.add_argument('-c','--combinations',action='append',default=[],nargs='*',help='combinations of classes to look for in single images. Takes a list of ADE-class names, separated by colon (:).')
 parser.add_argument('-p','--parents',action='append',nargs='*',default=[],help='combinations of parent-class and child-class to look for in single images. Expects a list of ADE-class names, separated by colon (:), where the first item is the child and all following items are allowed parents. Example: window: house: building:')
 parser.add_argument('--count',type=int,default=10,help="number of examples to extract for each class / combination / parent-child pair.")
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes rendering the example thumbnails and plots. (default: number of cpus)')
+parser.add_argument('--plot-format', type=str, choices=["png","svg","html"], default="png", help='the format of the parent and scene plots of single classes. "html" inlines simple bar charts into the html file without rendering images. (default: "png")')
+parser.add_argument('--cache-dir', type=path_arg, default=conf.thumbnail_cache_path, help='the folder to cache rendered thumbnails in. (default from configuration)')
+parser.add_argument('--no-cache', dest="cache", action="store_false", help='render all thumbnails again, without using the cache.')
 args = parser.parse_args()
 
 if (len(args.classnames) + len(args.parents) + len(args.combinations)) == 0:
@@ -144,25 +149,31 @@ outline_color = [255,0,0]
 
 current_item = 0
 goal_width = 300
-def scalefac(img):
-    return goal_width/img.shape[0]  
 
 
-with HtmlContext(args.out_dir,"ADE20k Summary") as w:
+with HtmlContext(args.out_dir,"ADE20k Summary") as w, \
+        utils.ThumbnailRenderer(ade_index,args.cache_dir if args.cache else None,args.processes) as thumbnails:
     
     ##########################################################################################
     ## Single Classes
     
     if len(classnames) > 0:
         w("<details open class='l0'><summary class='part'>Single classes</summary>")
-        for class_index,classname in classnames:
+        
+        # Create all barplots at once
+        barplot_paths = [w.imgpath(f"{classname}_barplot.{args.plot_format}") for _,classname in classnames]
+        if args.plot_format != "html":
+            print("Plot parent and scene occurrences...")
+            utils.Plots.parent_stats_batch(ade_index,ade_stats,[class_index for class_index,_ in classnames],
+                [os.path.join(args.out_dir,barplot_path) for barplot_path in barplot_paths],args.processes)
+        
+        for (class_index,classname),barplot_path in zip(classnames,barplot_paths):
             current_item += 1
             print(f"({current_item}/{num_total_items})Single class '{classname}' (#{class_index})")
-            
-            # Create barplot
-            barplot_name = f"{classname}_barplot.png"
-            barplot_path = w.imgpath(barplot_name)
-            utils.Plots.parent_stats(ade_index,ade_stats,class_index,os.path.join(args.out_dir,barplot_path))
+            if args.plot_format == "html":
+                barplot = utils.Plots.parent_stats_html(ade_index,ade_stats,class_index)
+            else:
+                barplot = f"<img src='{barplot_path}'>"
 
             # Some infos
             w(f"<div class='section'><h1><span class='box' style='background-color:{HtmlContext.color(outline_color)}'></span>{classname}</h1>")
@@ -173,7 +184,7 @@ with HtmlContext(args.out_dir,"ADE20k Summary") as w:
             {HtmlContext.item("wordnet_frequency", ade_index['wordnet_frequency'][class_index])}
             {HtmlContext.item("wordnet_hypernym",  ade_index['wordnet_hypernym'][class_index])}
             {HtmlContext.item("wordnet_synset",    ade_index['wordnet_synset'][class_index])}
-            <img src='{barplot_path}'>
+            {barplot}
             </div>''')
             
             # Outlines
@@ -185,13 +196,11 @@ with HtmlContext(args.out_dir,"ADE20k Summary") as w:
                 #foldername = ade_index['folder'][img_index]
                 out_name = f"{filename}_{classname}_outlines.jpg"
                 out_path = os.path.join(w.img_folder,out_name)
-                img, img_data = utils.AdeIndex.load_img(ade_index, img_index,load_imgdata=True)
+                img_data = utils.AdeIndex.load_img(ade_index, img_index,load_imgdata=True,load_training_image=False)
                 # Highlight this class
-                classes_colors.append((class_index,None,class_color_dict[class_index],8 ))
-                img,obj_counts = utils.Images.class_outlines(img,img_data,classes_colors,False,True,scaling=scalefac(img))
-                classes_colors.pop()
-                cv2.imwrite(out_path,img)
-                w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="scene">{img_data['scene']}</p><img {'class="portrait" ' if img.shape[0] > img.shape[1] else ""} src='{w.imgpath(out_name)}'></div>''')
+                thumbnails.render(img_index,out_path,classes_colors + [(class_index,None,class_color_dict[class_index],8 )],
+                    height=goal_width,img_data=img_data)
+                w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="scene">{img_data['scene']}</p><img {'class="portrait" ' if utils.ImgData.is_portrait(img_data) else ""} src='{w.imgpath(out_name)}'></div>''')
             w("</div></div></div>")
         w("</details>")
     
@@ -226,10 +235,9 @@ with HtmlContext(args.out_dir,"ADE20k Summary") as w:
                 filename = ade_index['filename'][img_index][:-4]
                 out_name = f"{filename}_combi{i}_outlines.jpg"
                 out_path = os.path.join(w.img_folder,out_name)
-                img, img_data = utils.AdeIndex.load_img(ade_index, img_index,load_imgdata=True)
-                img,obj_counts = utils.Images.class_outlines(img,img_data,classes_colors,False,True,scaling=scalefac(img))
-                cv2.imwrite(out_path,img)
-                w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="scene">{img_data['scene']}</p><img {'class="portrait" ' if img.shape[0] > img.shape[1] else ""} src='{w.imgpath(out_name)}'></div>''')
+                img_data = utils.AdeIndex.load_img(ade_index, img_index,load_imgdata=True,load_training_image=False)
+                thumbnails.render(img_index,out_path,classes_colors,height=goal_width,img_data=img_data)
+                w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="scene">{img_data['scene']}</p><img {'class="portrait" ' if utils.ImgData.is_portrait(img_data) else ""} src='{w.imgpath(out_name)}'></div>''')
             w("</div></div>")
         w("</div>")
 
@@ -276,8 +284,7 @@ with HtmlContext(args.out_dir,"ADE20k Summary") as w:
                             parent_class = "NONE"
                         out_name = f"{filename}_{child_class_name}_of_{parent_class}_outlines.jpg"
                         out_path = os.path.join(w.img_folder,out_name)
-                        img = utils.AdeIndex.load_img(ade_index, img_index)
-                        img = utils.Images.class_outlines(img,img_data,classes_colors,legend=False,highlight_instances=[
+                        thumbnails.render(img_index,out_path,classes_colors,highlight_instances=[
                             { 
                                 "id": parent_id,
                                 "color": parent_color,
@@ -288,9 +295,8 @@ with HtmlContext(args.out_dir,"ADE20k Summary") as w:
                                 "color": child_color,
                                 "thickness": 4
                             }
-                        ],scaling=scalefac(img))
-                        cv2.imwrite(out_path,img)
-                        w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="capt">{parent_class}</p><img {'class="portrait" ' if img.shape[0] > img.shape[1] else ""} src='{w.imgpath(out_name)}'></div>''')
+                        ],height=goal_width,img_data=img_data)
+                        w(f'''<div title="{img_data['scene']}" class='grid-item'><p class="capt">{parent_class}</p><img {'class="portrait" ' if utils.ImgData.is_portrait(img_data) else ""} src='{w.imgpath(out_name)}'></div>''')
                         
                         if len(parents_left) == 0:
                             break
@@ -1,4 +1,4 @@
-"""Creates a summary html document for a given filter specification, containing the definition of each target class, random image examples with outlines around matched instances, and statistics. Use --full-count to count matches in all images (will still only extract --count many examples)."""
+"""Creates a summary html document for a given filter specification, containing the definition of each target class, random image examples with outlines around matched instances, and statistics. All target classes are evaluated in one randomized pass over the dataset, which stops as soon as each class has --count examples. Use --full-count to count matches in all images (will still only extract --count many examples, sampled uniformly from all matches), or --sample N to estimate the counts from a random sample of N images, stratified by scene and number of synonym matches. The example thumbnails are rendered in parallel and cached for later runs."""
 
 import argparse
 import os
@@ -12,37 +12,113 @@ import ade_utils as utils
 from utils import *
 
 parser = argparse.ArgumentParser(description=__doc__)
-parser.set_defaults(full_count=False)
+parser.set_defaults(full_count=False,cache=True)
 parser.add_argument('--conf-path', type=path_arg, default=conf.annotate_filers_conf, help='the path of the filter configuration. (default from configuration)')
 parser.add_argument('--out-dir', type=path_arg, default="filter_summary", help='the folder to create the folder structure and store the html and image files in . (default: "filter_summary")')
 parser.add_argument('--count',type=int,default=10,help="number of examples to extract for each target class.")
 parser.add_argument('--full-count', action="store_true",dest="full_count", help='whether to process the whole dataset and show how many matches were made per class. Otherwise only --count examples are processed. (default: False)')
+parser.add_argument('--sample', type=int, default=None, help='the number of images to estimate the matches per class from, with 95%% confidence intervals. Faster than --full-count. (default: None / no estimates)')
+parser.add_argument('--seed', type=int, default=None, help='the seed for drawing the --sample and the order of the images. (default: None / random)')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes rendering the example thumbnails. (default: number of cpus)')
+parser.add_argument('--cache-dir', type=path_arg, default=conf.thumbnail_cache_path, help='the folder to cache rendered thumbnails in. (default from configuration)')
+parser.add_argument('--no-cache', dest="cache", action="store_false", help='render all thumbnails again, without using the cache.')
 args = parser.parse_args()
 
 ade_index = utils.AdeIndex.load()
 conf = utils.AdeConfiguration.load(ade_index,args.conf_path)
+rng = np.random.default_rng(args.seed)
+
+estimates = None
+if args.sample is not None:
+    # Estimate the matches of all classes from one stratified sample of images
+    candidates = np.flatnonzero(conf.prefilter(ade_index))
+    syn_counts = conf.syn_match_counts(ade_index,candidates)
+    strata = utils.Sampling.strata(ade_index,syn_counts,candidates,args.sample)
+    picked = utils.Sampling.sample(strata,args.sample,args.seed)
+    values = []
+    for img_id in tqdm(candidates[picked],desc=f"Estimate matches from {len(picked)} images"):
+        img_data = utils.ImgData.loadi(ade_index,img_id)
+        matches = conf.full_match(img_data)
+        values.append(
+            [cl.syn_match(ade_index,img_id) > 0 and cl.scene_match(img_data) for cl in conf.content_classes] +
+            [len(m) > 0 for m in matches] +
+            [len(m) for m in matches])
+    est, ci = utils.Sampling.estimate_totals(values,strata[picked],np.bincount(strata))
+    n = len(conf.content_classes)
+    estimates = {}
+    for k,tclass in enumerate(conf.content_classes):
+        estimates[tclass.name] = dict(
+            synmatch = int(np.sum(np.asarray(ade_index['objectPresence'][list(tclass.synonyms.keys())] > 0).any(axis=0))),
+            scenematch = (est[k],ci[k]),
+            fullmatch = (est[n+k],ci[n+k]),
+            instances = (est[2*n+k],ci[2*n+k]))
+        print(f"{tclass.name:20}: {estimates[tclass.name]['synmatch']:5} synonym matches, "
+              f"{utils.Sampling.fmt(*estimates[tclass.name]['scenematch'])} synonym+scene matches, "
+              f"{utils.Sampling.fmt(*estimates[tclass.name]['fullmatch'])} full matches (estimated)")
+
+##########################################################################################
+## Find examples of all classes in one pass (and process all remaining images if args.full_count)
+
+num_classes = len(conf.content_classes)
+synmatch = np.zeros(num_classes,dtype=int)
+scenematch = np.zeros(num_classes,dtype=int)
+fullmatch = np.zeros(num_classes,dtype=int)
+instancesum = np.zeros(num_classes,dtype=int)
+# Per class a reservoir of (img_id, img_data, matched instances)
+examples = [[] for _ in range(num_classes)]
+
+# Images without any synonym can not match any class, so only the candidates have to be loaded
+candidates = np.flatnonzero(conf.prefilter(ade_index))
+candidates = candidates[rng.permutation(len(candidates))]
+syn_matrix = np.stack([
+    np.asarray(ade_index['objectPresence'][list(tclass.synonyms.keys())][:,candidates] > 0).any(axis=0)
+    for tclass in conf.content_classes])
+
+searched = 0
+for i,img_id in enumerate(tqdm(candidates,desc="Process all images" if args.full_count else f"Look for {args.count} examples per class")):
+    img_data = utils.ImgData.loadi(ade_index,img_id)
+    matches = conf.full_match(img_data)
+    for k,tclass in enumerate(conf.content_classes):
+        if not syn_matrix[k,i]: continue
+        synmatch[k] += 1
+        if not tclass.scene_match(img_data): continue
+        scenematch[k] += 1
+        instances = matches[k]
+        if len(instances) <= 0: continue
+        fullmatch[k] += 1
+        instancesum[k] += len(instances)
+        # Reservoir sampling, so that the examples are uniformly drawn from all full matches
+        if len(examples[k]) < args.count:
+            examples[k].append((img_id,img_data,instances))
+        else:
+            j = rng.integers(fullmatch[k])
+            if j < args.count:
+                examples[k][j] = (img_id,img_data,instances)
+    searched += 1
+    if not args.full_count and np.all(fullmatch >= args.count):
+        break
+# Images rejected by the prefilter count as searched once all candidates have been
+img_count = searched + (utils.num_images - len(candidates) if searched == len(candidates) else 0)
 
 goal_width = 300
-def scalefac(img):
-    return goal_width/img.shape[0]  
-    
-with HtmlContext(args.out_dir,"Filter Summary") as w:
+
+with HtmlContext(args.out_dir,"Filter Summary") as w, \
+        utils.ThumbnailRenderer(ade_index,args.cache_dir if args.cache else None,args.processes) as thumbnails:
     # w(f"""<script>
     # var masonries = {{}};
     # function grid(id){{
-    #     masonries[id] = new Masonry( '#grid-'+id, {{ 
-    #         "itemSelector": ".grid-item", 
-    #         "columnWidth": 100, 
+    #     masonries[id] = new Masonry( '#grid-'+id, {{
+    #         "itemSelector": ".grid-item",
+    #         "columnWidth": 100,
     #         "gutter": 3 }});
-        
+
     # }}
     # function relayout(id){{
     #     masonries[id].layout()
     # }}
     # </script>""")
-    
-    for tclass in conf.content_classes:
-        print("CLASS",tclass.name)
+
+    for k,tclass in enumerate(conf.content_classes):
         scene_str = "both" if tclass.scene is None else tclass.scene
         w(f"""<div class='section'>
         <h2><span class='box' style='background-color:{w.color(tclass.color)}'></span>
@@ -50,7 +126,7 @@ with HtmlContext(args.out_dir,"Filter Summary") as w:
         {scene_str}</span>
         <span class="header-info">z: {tclass.z_index}</span></h2>
         <div class="summary synonyms img-grid grid" id="grid-{tclass.name}">""")
-        
+
         if isinstance(tclass.synonyms,str):
             w(tclass.synonyms)
         else:
@@ -60,74 +136,52 @@ with HtmlContext(args.out_dir,"Filter Summary") as w:
                 if len(parents) > 0:
                     w(f"""<details{" open" if len(parents) < 6 else ""} class='parents' ontoggle='relayout("{tclass.name}")'>
                     <summary>One of {len(parents)} parents required</summary>
-                    <p> 
+                    <p>
                     {"</p><p>".join(utils.AdeIndex.classnames(ade_index,parents))}
                     </p></details>""")
-                w("""</div>""") 
+                w("""</div>""")
         w("</div>")
         w(f"""<script>
         grid("{tclass.name}")
         </script>""")
         w(f"""<div class='examples'>
-        <p>Instances of synonyms in 
-        <span style='color:{w.color((255,0,0))}'>thin outline</span> 
-        and those with matched parents with 
+        <p>Instances of synonyms in
+        <span style='color:{w.color((255,0,0))}'>thin outline</span>
+        and those with matched parents with
         <span style='color:{w.color((255,255,0))}'>thick outline</span>
         </p>""")
-        
-        ##########################################################################################
-        ## Find examples (and process all remaining images if args.full_count)
-
-        synmatch = 0
-        scenematch = 0
-        fullmatch = 0
-        instancesum = 0
-        if args.full_count: progressbar = tqdm(total=utils.num_images,desc="Process all images")
-        else: progressbar = tqdm(total=args.count,desc=f"Look for {args.count} examples only")
+
         html_buffer = f"""<div class='img-grid grid' id='grid-{tclass.name}-examples' data-masonry='{{ "itemSelector": ".grid-item", "columnWidth": 100, "gutter": 3 }}'>"""
-        for img_count,img_id in enumerate(utils.AdeIndex.any_images(random=True)):
-            if tclass.syn_match(ade_index,img_id):
-                synmatch += 1
-                img_data = utils.ImgData.loadi(ade_index,img_id)
-                if not tclass.scene_match(img_data): continue
-                scenematch += 1
-                instances = tclass.full_match(img_data)
-                if len(instances) <= 0: continue
-                fullmatch += 1
-                instancesum += len(instances)
-                if fullmatch <= args.count:
-                    out_name = f"{tclass.name}_example_{fullmatch}.jpg"
-                    out_path = w.imgpath(out_name)
-                    img = utils.AdeIndex.load_img(ade_index,img_id,False)
-                    img = utils.Images.class_outlines(img,img_data,
-                        [[synname,None,(255,0,0),3] for synname in tclass.synonyms],
-                        legend=False,add_info=False,
-                        highlight_instances=[{
-                            "id": o['id'],
-                            "color": (255,255,0),
-                            "thickness": 5
-                        } for o in instances],scaling=scalefac(img))
-                    cv2.imwrite(os.path.join(args.out_dir,out_path),img)
-                    parents = {
-                        utils.ImgData.find_obj_by_id(img_data,o['parts']['ispartof'])['name'] if o['parts']['ispartof'] != [] else "NONE"
-                        for o in instances
-                    }
-                    html_buffer += f"<img class='grid-item' title={parents} src='{out_path}'>"
-                        
-            if args.full_count:
-                if fullmatch >= args.count:
-                    break
-                progressbar.update(n=img_count)
-            else:
-                progressbar.update(n=fullmatch)
-        progressbar.close()   
+        for e,(img_id,img_data,instances) in enumerate(examples[k]):
+            parents = {
+                utils.ImgData.find_obj_by_id(img_data,o['parts']['ispartof'])['name'] if o['parts']['ispartof'] != [] else "NONE"
+                for o in instances
+            }
+            out_path = w.imgpath(f"{tclass.name}_example_{e+1}.jpg")
+            thumbnails.render(img_id,os.path.join(args.out_dir,out_path),
+                [[synname,None,(255,0,0),3] for synname in tclass.synonyms],
+                highlight_instances=[{
+                    "id": o['id'],
+                    "color": (255,255,0),
+                    "thickness": 5
+                } for o in instances],height=goal_width,img_data=img_data)
+            html_buffer += f"<img class='grid-item' title={parents} src='{out_path}'>"
         html_buffer += "</div>"
+        if estimates is not None:
+            e = estimates[tclass.name]
+            w(f'''<div class="summary">
+            {HtmlContext.item("Images sampled",len(picked))}
+            {HtmlContext.item("Synonym matches",e['synmatch'])}
+            {HtmlContext.item("Synonym+Scene matches (estimated)",utils.Sampling.fmt(*e['scenematch']))}
+            {HtmlContext.item("Full matches (estimated)",utils.Sampling.fmt(*e['fullmatch']))}
+            {HtmlContext.item("Avg instances per image (estimated)",e['instances'][0] / max(e['fullmatch'][0],1))}
+            </div>''')
         w(f'''<div class="summary">
         {HtmlContext.item("Images searched",img_count)}
-        {HtmlContext.item("Synonym matches",synmatch-1)}
-        {HtmlContext.item("Synonym+Scene matches",scenematch-1)}
-        {HtmlContext.item("Full matches",fullmatch)}
-        {HtmlContext.item("Avg instances per image",instancesum / fullmatch)}
+        {HtmlContext.item("Synonym matches",synmatch[k])}
+        {HtmlContext.item("Synonym+Scene matches",scenematch[k])}
+        {HtmlContext.item("Full matches",fullmatch[k])}
+        {HtmlContext.item("Avg instances per image",instancesum[k] / max(fullmatch[k],1))}
         </div>''')
         w(html_buffer)
         # w(f"""<script>
@@ -4,13 +4,22 @@ affects display of the training annotations, not the training itself.).
 
 Example:
 To join classes 0 and 1   : LUT=[0,0,1,2,3,...]
-To leave the index 0 free : LUT=[1,2,3,...]"""
+To leave the index 0 free : LUT=[1,2,3,...]
+To only update the palette: LUT=[0,1,2,3,...]
+
+The images are processed in a pool of processes and replaced atomically. If the LUT does not change
+any index, only the palette chunk of each PNG is rewritten, without decoding the pixels."""
 from PIL import Image
 import numpy as np
 from tqdm import tqdm
 import os
 import argparse
+import io
 import shutil
+import struct
+import time
+import zlib
+from multiprocessing import Pool
 
 from utils import * 
 
@@ -18,19 +27,28 @@ from utils import *
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--studienprojekt-dir', type=path_arg, default=conf.dataset_out_path, help='the folder containing the dataset (default from configuration).')
 parser.add_argument('--out-dir', type=path_arg, default=conf.dataset_out_path, help='the folder to store the transformed dataset (defaults to overwriting the input folder!)')
-parser.add_argument('--subsets', type=str, nargs='+', default=["indoor","outdoor","inout","outdoor_extended","inout_extended"], help='the subfolders of --studienprojekt-dir to use. (default: ["indoor","outdoor","inout","outdoor_extended","inout_extended"])')
+parser.add_argument('--subsets', type=str, nargs='+', default=["indoor","outdoor","inout","extension"], help='the subfolders of --studienprojekt-dir to use. The extended datasets only link to the others. (default: ["indoor","outdoor","inout","extension"])')
 parser.add_argument('--lut', type=int, nargs='+', default=None, help='the look-up table to use. If none is given, a selection is presented.')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes transforming the images. (default: number of cpus)')
 args = parser.parse_args()
 
+# Subsets which are the same folder (e.g. through symlinks) are only transformed once
+subsets = {}
 for subset in args.subsets:
-    dirr = os.path.join(args.out_dir,subset)
-    if os.path.exists(dirr) and len(os.listdir(dirr)) > 0:
-        if input(f"Output folder {dirr} is not empty. Clear contents? [y/n]").lower() == 'y':
-            shutil.rmtree(dirr)
-            os.makedirs(dirr)
-        else:
-            print("Skipping this folder")
-            args.subsets.remove(subset)
+    subsets.setdefault(os.path.realpath(os.path.join(args.studienprojekt_dir,subset)),subset)
+args.subsets = list(subsets.values())
+
+in_place = os.path.realpath(args.studienprojekt_dir) == os.path.realpath(args.out_dir)
+if not in_place:
+    for subset in list(args.subsets):
+        dirr = os.path.join(args.out_dir,subset)
+        if os.path.exists(dirr) and len(os.listdir(dirr)) > 0:
+            if input(f"Output folder {dirr} is not empty. Clear contents? [y/n]").lower() == 'y':
+                shutil.rmtree(dirr)
+                os.makedirs(dirr)
+            else:
+                print("Skipping this folder")
+                args.subsets.remove(subset)
 if len(args.subsets) == 0:
     print("No subfolders left")
     exit()
@@ -39,7 +57,8 @@ if len(args.subsets) == 0:
 if args.lut is None:
     luts = [
         ("Leave out index 0 / right shift", np.arange(1,23)),
-        ("Join index 0 and 1", np.concatenate([[0],np.arange(1,23)]))
+        ("Join index 0 and 1", np.concatenate([[0],np.arange(1,23)])),
+        ("Only update the palette", np.arange(0,23))
     ]
     ch = choice(luts,displaylist=[f"{l[0]} : {l[1]}" for l in luts])
     if ch is None:
@@ -49,26 +68,103 @@ lut = np.array(args.lut)
 # Train images palette starts at index one!
 newpalette = np.concatenate([np.array([0,0,0],dtype=np.uint8),conf.palette.flatten()]).astype(np.uint8)
 
-print(f"This will copy all annotations inside {args.studienprojekt_dir} to {args.out_dir} after applying the LUT")
-print(f"LUT: {lut}.")
+# Indices not changed by the LUT only need the new palette
+identity = np.array_equal(lut,np.arange(len(lut)))
+
+print(f"This will {'replace' if in_place else 'copy'} all annotations inside {args.studienprojekt_dir} {'in place' if in_place else 'to ' + args.out_dir} after applying the LUT")
+print(f"LUT: {lut}{' (identity, only the palette is replaced)' if identity else ''}.")
 print(f"Picked subfolders: {' '.join(args.subsets)}")
 print("Palette:",newpalette)
 if not input(f"Okay? [y/n] ") in ["y","Y"]: exit()
 
+def png_header(png : bytes):
+    """Bit depth and color type from the IHDR chunk of a PNG file, or None if it is no PNG."""
+    if png[:8] != b"\x89PNG\r\n\x1a\n" or png[12:16] != b"IHDR":
+        return None
+    return png[24], png[25]
+
+def palette_size(png : bytes):
+    """Number of entries of the PLTE chunk of a PNG file, or None if it has none. Only the chunk 
+    headers are read."""
+    pos = 8
+    while pos + 8 <= len(png):
+        length, chunk_type = struct.unpack(">I4s",png[pos:pos+8])
+        if chunk_type == b"PLTE":
+            return length // 3
+        if chunk_type == b"IDAT":
+            return None
+        pos += 12 + length
+    return None
+
+def replace_palette(png : bytes, palette : bytes):
+    """Replace the PLTE chunk of a PNG file without decoding the pixels. Returns None, if the PNG 
+    is not palette-based (color type 3), the new palette has more entries than the bit depth 
+    allows, or it has a transparency chunk which would not fit the new palette."""
+    header = png_header(png)
+    if header is None or header[1] != 3 or len(palette) // 3 > 2 ** header[0]:
+        return None
+    pos = 8
+    out = [png[:pos]]
+    replaced = False
+    while pos < len(png):
+        length, chunk_type = struct.unpack(">I4s",png[pos:pos+8])
+        end = pos + 12 + length
+        if chunk_type == b"PLTE":
+            out.append(struct.pack(">I4s",len(palette),chunk_type) + palette 
+                + struct.pack(">I",zlib.crc32(chunk_type + palette) & 0xffffffff))
+            replaced = True
+        else:
+            if chunk_type == b"tRNS" and length > len(palette) // 3:
+                return None
+            out.append(png[pos:end])
+        pos = end
+    return b"".join(out) if replaced else None
+
+def transform(job):
+    """Apply the LUT to one annotation and replace the output file atomically. Returns whether 
+    only the palette was rewritten."""
+    in_path, out_path = job
+    tmp_path = out_path + ".tmp"
+    if identity:
+        with open(in_path,"rb") as f:
+            png = f.read()
+        new_png = replace_palette(png,newpalette.tobytes())
+        # Indices outside the LUT fail below as for any other LUT. Valid indices are below the
+        # size of the old palette and the bit depth, so the pixels are only checked, if these 
+        # allow more indices than the LUT has.
+        if new_png is not None and (min(2 ** png_header(png)[0], palette_size(png)) <= len(lut)
+                                    or np.array(Image.open(io.BytesIO(png))).max(initial=0) < len(lut)):
+            with open(tmp_path,"wb") as f:
+                f.write(new_png)
+            os.replace(tmp_path,out_path)
+            return True
+    img = Image.open(in_path)
+    img = lut[img].astype(np.uint8)
+    img = Image.fromarray(img,mode='P')
+    img.putpalette(newpalette)
+    img.save(tmp_path,format="PNG")
+    os.replace(tmp_path,out_path)
+    return False
+
+jobs = []
 for l1 in args.subsets:
     l2 = "annotations"
     for l3 in ["train","val"]:
         in_folder = os.path.join(args.studienprojekt_dir,l1,l2,l3)
         out_folder = os.path.join(args.out_dir,l1,l2,l3)
+        if not os.path.exists(in_folder):
+            print("Skipping missing folder",in_folder)
+            continue
         if not os.path.exists(out_folder):
             os.makedirs(out_folder)
             print(in_folder,"->",out_folder,"(newly created)")
         else: print(in_folder,"->",out_folder)
-        
-        for name in tqdm(os.listdir(in_folder)):
-            img = Image.open(os.path.join(in_folder,name))
-            img = lut[img].astype(np.uint8)
-            img = Image.fromarray(img,mode='P')
-            img.putpalette(newpalette)
-            img.save(os.path.join(out_folder,name))
-            
\ No newline at end of file
+        jobs += [(os.path.join(in_folder,name),os.path.join(out_folder,name)) 
+            for name in os.listdir(in_folder) if name.endswith(".png")]
+
+start_time = time.time()
+with Pool(args.processes) as pool:
+    palette_only = sum(tqdm(pool.imap_unordered(transform,jobs,chunksize=16),total=len(jobs)))
+duration = time.time() - start_time
+print(f"Transformed {len(jobs)} annotations in {duration:.1f}s ({len(jobs)/max(duration,1e-9):.0f}/s), "
+      f"{palette_only} by only replacing the palette.")
@@ -0,0 +1,74 @@
+"""Re-export an already annotated studienprojekt dataset at a reduced resolution, such that the longer
+side of each image and annotation is at most --max-side pixels. Images are resized with area
+interpolation, annotations with nearest-neighbor (so no new class indices are created) and keep their
+palette. Images which are small enough are left untouched.
+
+This is the same as running annotate.py with --export-max-side, without re-annotating everything.
+The savings in disk space and decode time are reported at the end."""
+import argparse
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import ade_utils as utils
+from utils import *
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--max-side', type=int, required=True, help='the maximum length of the longer side of images and annotations in pixels.')
+parser.add_argument('--studienprojekt-dir', type=path_arg, default=conf.dataset_out_path, help='the folder containing the dataset (default from configuration).')
+parser.add_argument('--out-dir', type=path_arg, default=conf.dataset_out_path, help='the folder to store the resized dataset (defaults to overwriting the input folder!)')
+parser.add_argument('--subsets', type=str, nargs='+', default=["indoor","outdoor","inout","extension"], help='the subfolders of --studienprojekt-dir to use. The extended datasets only link to the others. (default: ["indoor","outdoor","inout","extension"])')
+parser.add_argument('--jpeg-quality', type=int, default=95, help='the quality of re-encoded jpg images. (default: 95)')
+args = parser.parse_args()
+
+in_place = os.path.realpath(args.studienprojekt_dir) == os.path.realpath(args.out_dir)
+print(f"This will resize all images and annotations inside {args.studienprojekt_dir} to at most {args.max_side} px and store them in {args.out_dir}")
+if in_place: print("The files will be replaced in place!")
+print(f"Picked subfolders: {' '.join(args.subsets)}")
+if not input(f"Okay? [y/n] ") in ["y","Y"]: exit()
+
+def write_replace(path, write):
+    """Write a file by calling write(tmp_path) first and then moving it to path, so that an
+    interrupted run never leaves half-written files behind."""
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+export_stats = {}
+for l1 in args.subsets:
+    for l3 in ["train","val"]:
+        img_folder = os.path.join(args.studienprojekt_dir,l1,"images",l3)
+        ann_folder = os.path.join(args.studienprojekt_dir,l1,"annotations",l3)
+        if not os.path.exists(img_folder):
+            print("Skipping missing folder",img_folder)
+            continue
+        out_img_folder = os.path.join(args.out_dir,l1,"images",l3)
+        out_ann_folder = os.path.join(args.out_dir,l1,"annotations",l3)
+        for f in [out_img_folder,out_ann_folder]:
+            if not os.path.exists(f): os.makedirs(f)
+        print(img_folder,"->",out_img_folder)
+
+        for img_name in tqdm([n for n in os.listdir(img_folder) if n.lower().endswith(".jpg")]):
+            ann_name = img_name[:-4] + ".png"
+            ann_pil = Image.open(os.path.join(ann_folder,ann_name))
+            ann_palette = ann_pil.getpalette()
+            jpg, ann, info = utils.Images.resize_export(
+                os.path.join(img_folder,img_name), np.array(ann_pil), args.max_side, args.jpeg_quality)
+            for k,v in info.items():
+                export_stats[k] = export_stats.get(k,0) + v
+            if in_place and not info['resized']:
+                continue
+
+            ann_pil = Image.fromarray(ann,mode='P')
+            if ann_palette is not None: ann_pil.putpalette(ann_palette)
+            def write_jpg(path):
+                with open(path,"wb") as jpg_file:
+                    jpg_file.write(jpg)
+            write_replace(os.path.join(out_img_folder,img_name), write_jpg)
+            write_replace(os.path.join(out_ann_folder,ann_name), lambda path: ann_pil.save(path,format="PNG"))
+
+print(utils.Images.export_report(export_stats))
@@ -0,0 +1,92 @@
+"""Randomized checks of the compiled filter matching (AdeConfiguration) against the per-class
+matching (AdeTargetClass), on synthetic images and configurations. verify_filters.py does the same
+on the real dataset."""
+import numpy as np
+import pytest
+
+# Few ADE20k-classes, so that synonyms, parents and objects collide often
+ade_classes = 12
+
+
+@pytest.fixture
+def utils(load):
+    return load("ade_utils")
+
+
+def random_configuration(utils, rng):
+    """Configuration with random content classes, synonyms, parent constraints (including NONE)
+    and scenes."""
+    target_classes = {}
+    for class_id in range(int(rng.integers(1, 10))):
+        synonyms = {}
+        for syn in rng.choice(ade_classes, size=int(rng.integers(1, 4)), replace=False):
+            parents = set()
+            if rng.random() < 0.5:
+                parents = {int(p) for p in rng.choice(ade_classes, size=int(rng.integers(1, 3)), replace=False)}
+                if rng.random() < 0.3:
+                    parents.add(-1)
+            synonyms[int(syn)] = parents
+        target_classes[class_id] = utils.AdeTargetClass(f"class{class_id}", synonyms,
+            scene=rng.choice([None, "indoor", "outdoor"]), z_index=int(rng.integers(0, 3)), class_id=class_id)
+    return utils.AdeConfiguration(target_classes, 0)
+
+
+def random_img_data(rng):
+    """Image annotation with random objects in random order of ids. Objects are either top-level,
+    part of another object or part of an object missing in the annotation."""
+    count = int(rng.integers(0, 15))
+    ids = rng.permutation(count + 5)[:count]
+    missing = [int(i) for i in range(count + 5) if i not in ids]
+    objects = []
+    for i in ids:
+        r = rng.random()
+        if r < 0.4 or count == 1:
+            ispartof = []
+        elif r < 0.8:
+            ispartof = int(rng.choice([j for j in ids if j != i]))
+        else:
+            ispartof = missing[int(rng.integers(len(missing)))]
+        objects.append({'id': int(i), 'name_ndx': int(rng.integers(ade_classes)), 'parts': {'ispartof': ispartof}})
+    return {'object': objects, 'scene': [rng.choice(["indoor", "outdoor"])]}
+
+
+def test_full_match_equals_per_class_matching(utils):
+    rng = np.random.default_rng(0)
+    missing_parents = 0
+    for _ in range(50):
+        ade_conf = random_configuration(utils, rng)
+        for _ in range(20):
+            img_data = random_img_data(rng)
+            _, parents = utils.ImgData.object_arrays(img_data)
+            missing_parents += np.sum(parents == -2)
+            expected = [[o['id'] for o in cl.full_match(img_data)] if cl.scene_match(img_data) else []
+                        for cl in ade_conf.content_classes]
+            result = [[o['id'] for o in matches] for matches in ade_conf.full_match(img_data)]
+            assert result == expected
+    assert missing_parents > 0
+
+
+def test_missing_parent_matches_only_unconstrained_synonyms(utils):
+    cl = {0: utils.AdeTargetClass("free", {3: set()}, class_id=0),
+          1: utils.AdeTargetClass("constrained", {3: {5, -1}}, class_id=1)}
+    ade_conf = utils.AdeConfiguration(cl, 0)
+    img_data = {'object': [{'id': 0, 'name_ndx': 3, 'parts': {'ispartof': 7}}], 'scene': ["indoor"]}
+    assert utils.ImgData.object_arrays(img_data)[1].tolist() == [-2]
+    result = [[o['id'] for o in matches] for matches in ade_conf.full_match(img_data)]
+    assert result == [[0], []]
+    assert cl[1].full_match(img_data) == []
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_syn_match_counts_equal_per_image_counts(utils, seed):
+    rng = np.random.default_rng(seed)
+    ade_conf = random_configuration(utils, rng)
+    presence = np.zeros((utils.num_classes, 40), dtype=int)
+    presence[:ade_classes] = rng.integers(0, 3, size=(ade_classes, 40)) * (rng.random((ade_classes, 40)) < 0.2)
+    ade_index = {'objectPresence': presence}
+    expected = np.array([ade_conf.syn_match(ade_index, i) for i in range(40)])
+    prefiltered = ade_conf.prefilter(ade_index)
+    assert np.array_equal(ade_conf.syn_match_counts(ade_index), expected)
+    assert np.array_equal(prefiltered, expected > 0)
+    img_indices = rng.permutation(40)[:25]
+    assert np.array_equal(ade_conf.syn_match_counts(ade_index, img_indices), expected[img_indices])
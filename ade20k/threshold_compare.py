@@ -1,8 +1,13 @@
 """Takes a filter configuration and quickly counts the images for different
 detection thresholds, based on Synonym-matches only. Use this as a rough estimate
-of how many target classes you should require at minimum ("detection_threshold" in filters.json)."""
+of how many target classes you should require at minimum ("detection_threshold" in filters.json).
+
+With --sample N, the numbers of full matches (including parent and scene constraints) are also
+estimated from a random sample of N images, stratified by scene and number of synonym matches, and
+shown with 95% confidence intervals."""
 
 import argparse
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -17,36 +22,53 @@ parser.set_defaults(show_plot=False)
 parser.add_argument('--conf-path', type=path_arg, default=conf.annotate_filers_conf, help='the path of the filter configuration. (default from configuration)')
 parser.add_argument('--show-plot', action="store_true",dest="show_plot", help='whether to show a histogram plot of the results. (default: False)')
 parser.add_argument('--save-file',type=path_arg, help='a path to save a histogram plot of the results to. (default: None / no saving)')
+parser.add_argument('--sample', type=int, default=None, help='the number of images to estimate full matches from. (default: None / synonym matches only)')
+parser.add_argument('--seed', type=int, default=None, help='the seed for drawing the --sample. (default: None / random)')
 args = parser.parse_args()
 
 ade_index = utils.AdeIndex.load()
 conf = utils.AdeConfiguration.load(ade_index,args.conf_path)
 
-matches_hist = dict()
-for img_index in tqdm(range(utils.num_images),desc="Process all images"):
-    try:
-        classes = conf.syn_match(ade_index,img_index,True)
-        det = len(classes)
-        if not det in matches_hist:
-            matches_hist[det] = 1
-        else:
-            matches_hist[det] += 1
-    except KeyboardInterrupt:
-        exit()
-    except BaseException as e:
-        print("\n",e)
-        stats['errors'].append({
-            'img_id': img_index,
-            'error': e,
-            'error_print': str(e)
-        })
+start_time = time.time()
+candidates = np.flatnonzero(conf.prefilter(ade_index))
+syn_counts = conf.syn_match_counts(ade_index,candidates)
+print(f"Counted synonym matches in {time.time()-start_time:.2f}s, {utils.num_images-len(candidates)} images without any synonym.")
+matches_hist = {0: utils.num_images-len(candidates)}
+for det,count in zip(*np.unique(syn_counts,return_counts=True)):
+    matches_hist[int(det)] = matches_hist.get(int(det),0) + int(count)
 print()
 print("threshold, number of matched images")
 for matches,count in sorted(matches_hist.items(),key=lambda item:item[0]):
     print(f"{matches:9d}, {count:5d} ")        
 
+if args.sample is not None:
+    # Full matches are only possible in images with synonym matches
+    start_time = time.time()
+    strata = utils.Sampling.strata(ade_index,syn_counts,candidates,args.sample)
+    picked = utils.Sampling.sample(strata,args.sample,args.seed)
+    full_counts = []
+    for img_index in tqdm(candidates[picked],desc="Full matches of sampled images"):
+        img_data = utils.ImgData.loadi(ade_index,img_index)
+        full_counts.append(sum(len(m) > 0 for m in conf.full_match(img_data)))
+    full_counts = np.array(full_counts)
+    thresholds = np.arange(np.max(syn_counts)+1)
+    exact, exact_ci = utils.Sampling.estimate_totals(
+        full_counts[:,None] == thresholds[None,:],strata[picked],np.bincount(strata))
+    at_least, at_least_ci = utils.Sampling.estimate_totals(
+        full_counts[:,None] >= thresholds[None,:],strata[picked],np.bincount(strata))
+    exact[0] += utils.num_images-len(candidates)
+    at_least[0] += utils.num_images-len(candidates)
+    print()
+    print(f"Estimated from {len(picked)} sampled images in {time.time()-start_time:.1f}s (95% confidence intervals):")
+    print("threshold, estimated full matches (exactly), estimated images kept (at least threshold)")
+    for t in thresholds:
+        print(f"{t:9d}, {utils.Sampling.fmt(exact[t],exact_ci[t]):>17}, {utils.Sampling.fmt(at_least[t],at_least_ci[t]):>17}")
+
 if args.show_plot or args.save_file is not None:
-    plt.bar(matches_hist.keys(),matches_hist.values())
+    plt.bar(matches_hist.keys(),matches_hist.values(),label="Synonym matches")
+    if args.sample is not None:
+        plt.errorbar(thresholds,exact,yerr=exact_ci,fmt="o",color="black",label="Full matches (estimated)")
+        plt.legend()
     plt.xlabel("Number of matched classes")
     plt.ylabel("Number of images")
     plt.xticks(np.arange(max(matches_hist.keys())+1))
@@ -0,0 +1,62 @@
+"""Check on random images, that the compiled single-pass matching of a filter configuration
+(AdeConfiguration.full_match) finds exactly the same object instances as matching each target class
+separately (AdeTargetClass.full_match). The bulk candidate selection (prefilter and synonym match 
+counts) is also compared against per-image synonym matching on all images. Shows the time both 
+approaches took. Use this after changing the matching code. test_filters.py checks the same on
+synthetic images and configurations, without the dataset."""
+import argparse
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import ade_utils as utils
+from utils import path_arg, conf
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--conf-path', type=path_arg, default=conf.annotate_filers_conf, help='the path of the filter configuration. (default from configuration)')
+parser.add_argument('--count', type=int, default=500, help='the number of random images to check. (default: 500)')
+parser.add_argument('--seed', type=int, default=None, help='the seed for picking random images. (default: None / random)')
+args = parser.parse_args()
+
+ade_index = utils.AdeIndex.load()
+ade_conf = utils.AdeConfiguration.load(ade_index,args.conf_path)
+
+t = time.perf_counter()
+per_image_counts = np.array([ade_conf.syn_match(ade_index,img_index) for img_index in tqdm(range(utils.num_images),desc="Per-image synonym matching")])
+time_per_image = time.perf_counter() - t
+t = time.perf_counter()
+candidates = np.flatnonzero(ade_conf.prefilter(ade_index))
+bulk_counts = np.zeros((utils.num_images),dtype=int)
+bulk_counts[candidates] = ade_conf.syn_match_counts(ade_index,candidates)
+time_bulk = time.perf_counter() - t
+print(f"Candidate selection: {np.sum(per_image_counts != bulk_counts)} mismatches, {utils.num_images-len(candidates)} images rejected by the prefilter.")
+print(f"Per-image synonym matching: {time_per_image:.3f}s, prefilter and bulk counting: {time_bulk:.3f}s ({time_per_image/time_bulk:.1f}x faster)")
+
+rng = np.random.default_rng(args.seed)
+img_indices = rng.choice(utils.num_images, size=min(args.count,utils.num_images), replace=False)
+
+mismatches = 0
+time_single = 0.0
+time_compiled = 0.0
+for img_index in tqdm(img_indices,desc="Compare matches"):
+    img_data = utils.ImgData.loadi(ade_index,img_index)
+
+    t = time.perf_counter()
+    expected = [cl.full_match(img_data) if cl.scene_match(img_data) else []
+                for cl in ade_conf.content_classes]
+    time_single += time.perf_counter() - t
+
+    t = time.perf_counter()
+    result = ade_conf.full_match(img_data)
+    time_compiled += time.perf_counter() - t
+
+    for cl, exp, res in zip(ade_conf.content_classes, expected, result):
+        exp_ids = [o['id'] for o in exp]
+        res_ids = [o['id'] for o in res]
+        if exp_ids != res_ids:
+            mismatches += 1
+            print(f"\nMismatch in image {img_index} for {cl.name}: expected {exp_ids}, got {res_ids}")
+
+print(f"{len(img_indices)} images checked, {mismatches} mismatches.")
+print(f"Per-class matching: {time_single:.3f}s, compiled matching: {time_compiled:.3f}s")
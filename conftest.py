@@ -0,0 +1,28 @@
+"""The scripts import their siblings by name and load 'conf.json' from the working directory, as
+each folder has its own (symlinked) utils.py and conf.json. So every test runs in the folder of its
+module and imports the modules of that folder afresh through the load fixture."""
+import importlib
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def script_folder(request, monkeypatch):
+    """Change into the folder of the test module and make its modules importable by name, for the
+    duration of the test. Modules of the same name imported before are hidden meanwhile."""
+    folder = os.path.dirname(str(request.fspath))
+    monkeypatch.chdir(folder)
+    monkeypatch.syspath_prepend(folder)
+    for f in os.listdir(folder):
+        name, ext = os.path.splitext(f)
+        if ext == ".py" and name in sys.modules and not name.startswith("test_") and name != "conftest":
+            monkeypatch.delitem(sys.modules, name)
+    return folder
+
+
+@pytest.fixture
+def load(script_folder):
+    """Function importing a module of the folder of the test by name."""
+    return importlib.import_module
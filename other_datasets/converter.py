@@ -0,0 +1,213 @@
+"""
+Shared framework for converting other facade datasets to Studienprojekt Format and adding them to the
+extended datasets. A dataset is described by a list of samples (see find_samples) and a mapping of
+its annotations to the Studienprojekt classes:
+
+-   IndexMapping for palette-index (P-Mode) annotations, given one classname per index
+-   ColorMapping for RGB annotations, given one classname per color
+
+convert_dataset converts all samples in a pool of processes into the 'extension' folder of the
+dataset, which the extended datasets overlay (see prepare_dataset_extension_dirs in utils.py).
+Samples are sorted by name and every extension_datasets_val_every-th of them is used as val data,
+independent of the order of the files on disk. Each annotation is mapped and encoded once and the
+same bytes are written to all locations.
+"""
+import argparse
+import io
+import os
+import time
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from utils import *
+
+
+locations = ["extension"]
+
+
+def pack_rgb(rgb):
+    """Pack RGB values (in the last axis) into one 24 bit integer each."""
+    rgb = np.asarray(rgb,dtype=np.uint32)
+    return (rgb[...,0] << 16) | (rgb[...,1] << 8) | rgb[...,2]
+
+
+class IndexMapping(object):
+    """Mapping of palette-index (P-Mode) annotations to Studienprojekt classes."""
+
+    def __init__(self, classnames : List[str]):
+        """Construct
+
+        Args:
+            classnames (List[str]): Studienprojekt classname for each index of the dataset.
+        """
+        self.lut = np.array([conf.by_name[name].id for name in classnames],dtype=np.uint8)
+        self.background_id = conf.by_name['background'].id
+
+    def __call__(self, ann):
+        """Map an annotation image to Studienprojekt class ids. Unknown indices are mapped to
+        background.
+
+        Args:
+            ann (PIL image): Annotation of the dataset
+
+        Raises:
+            ValueError: If the annotation is not P-Mode.
+
+        Returns:
+            np.array: Class ids
+            dict: Pixel count of each unknown index, by its name
+        """
+        if ann.mode != 'P':
+            raise ValueError("not P-Mode")
+        data = np.array(ann)
+        known = data < len(self.lut)
+        unknown = {}
+        if not known.all():
+            indices, counts = np.unique(data[~known],return_counts=True)
+            unknown = {f"index {i}": int(c) for i,c in zip(indices,counts)}
+        return np.where(known,self.lut[np.minimum(data,len(self.lut)-1)],self.background_id), unknown
+
+
+class ColorMapping(object):
+    """Mapping of RGB annotations to Studienprojekt classes. Colors are packed into 24 bit integers
+    and looked up in the sorted known colors."""
+
+    def __init__(self, colors : Dict[Tuple[int,int,int],str]):
+        """Construct
+
+        Args:
+            colors (Dict[Tuple[int,int,int],str]): Studienprojekt classname for each RGB color of the dataset.
+        """
+        packed = pack_rgb(list(colors.keys()))
+        order = np.argsort(packed)
+        self.colors = packed[order]
+        self.ids = np.array([conf.by_name[v].id for v in colors.values()],dtype=np.uint8)[order]
+        self.background_id = conf.by_name['background'].id
+
+    def __call__(self, ann):
+        """Map an annotation image to Studienprojekt class ids. Unknown colors are mapped to
+        background.
+
+        Args:
+            ann (PIL image): Annotation of the dataset
+
+        Returns:
+            np.array: Class ids
+            dict: Pixel count of each unknown color, by its name
+        """
+        packed = pack_rgb(np.array(ann.convert('RGB')))
+        pos = np.minimum(np.searchsorted(self.colors,packed),len(self.colors)-1)
+        known = self.colors[pos] == packed
+        unknown = {}
+        if not known.all():
+            colors, counts = np.unique(packed[~known],return_counts=True)
+            unknown = {f"color {c >> 16}:{(c >> 8) & 255}:{c & 255}": int(n) for c,n in zip(colors,counts)}
+        return np.where(known,self.ids[pos],self.background_id), unknown
+
+
+def argument_parser(description : str):
+    """Argument parser with the options shared by all converter scripts."""
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(overwrite=False)
+    parser.add_argument('--overwrite', dest="overwrite", action="store_true",  help=f'delete extended dataset folders which are full copies (not overlays) without asking. If not set, a dialog is shown for each of them.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes converting the images. (default: number of cpus)')
+    return parser
+
+
+def find_samples(img_folder : str, ann_folder : str, ann_ext : str = ".png"):
+    """List all jpg images of a dataset (any case of the extension) with their annotations, sorted by name.
+
+    Args:
+        img_folder (str): Folder of the .jpg images
+        ann_folder (str): Folder of the annotations
+        ann_ext (str, optional): Extension of the annotations. Defaults to ".png".
+
+    Returns:
+        List[tuple]: (name, image path, annotation path) of each image
+    """
+    files = sorted(f for f in os.listdir(img_folder) if f.lower().endswith(".jpg"))
+    return [(os.path.splitext(f)[0], os.path.join(img_folder,f), os.path.join(ann_folder,os.path.splitext(f)[0] + ann_ext))
+        for f in files]
+
+
+def _convert_sample(job):
+    """Worker of convert_dataset: convert one sample and write it to all destinations."""
+    name, img_path, ann_path, mode, mapping, destinations = job
+    result = dict(name=name, mode=mode, skipped=None, unknown={}, bytes=0)
+    if not os.path.exists(ann_path):
+        result['skipped'] = "missing annotation"
+        return result
+    try:
+        ids, result['unknown'] = mapping(Image.open(ann_path))
+    except ValueError as e:
+        result['skipped'] = str(e)
+        return result
+    # +1 to skip the zero index
+    ann_new = Image.fromarray(ids.astype(np.uint8) + 1,mode='P')
+    ann_new.putpalette(conf.train_palette)
+    buffer = io.BytesIO()
+    ann_new.save(buffer,format="PNG")
+    ann_bytes = buffer.getvalue()
+    with open(img_path,"rb") as f:
+        img_bytes = f.read()
+    for ann_dir, img_dir in destinations:
+        with open(os.path.join(ann_dir,name + ".png"),"wb") as f:
+            f.write(ann_bytes)
+        with open(os.path.join(img_dir,name + ".jpg"),"wb") as f:
+            f.write(img_bytes)
+    result['bytes'] = len(destinations) * (len(ann_bytes) + len(img_bytes))
+    return result
+
+
+def convert_dataset(samples : List[tuple], mapping, processes : int = None, out_locations : List[str] = locations):
+    """Convert all samples of a dataset and write them into the extension of the dataset, in a pool of
+    processes. Updates the split files of the extended datasets and reports skipped samples, 
+    unknown labels and the throughput at the end.
+
+    Args:
+        samples (List[tuple]): (name, image path, annotation path) of each sample, see find_samples
+        mapping (IndexMapping or ColorMapping): Mapping of the dataset's annotations
+        processes (int, optional): Number of processes. Defaults to the number of cpus.
+        out_locations (List[str], optional): Subfolders of the dataset folder to write to.
+            Defaults to locations.
+    """
+    samples = sorted(samples)
+    print(f"Converting {len(samples)} files. Every {conf.extension_datasets_val_every}-th file is used as val data.")
+    jobs = []
+    for i,(name, img_path, ann_path) in enumerate(samples):
+        mode = "val" if i % conf.extension_datasets_val_every == 0 else "train"
+        destinations = [(os.path.join(conf.dataset_out_path,loc,"annotations",mode),
+                         os.path.join(conf.dataset_out_path,loc,"images",mode)) for loc in out_locations]
+        jobs.append((name, img_path, ann_path, mode, mapping, destinations))
+    modes = {"train":0,"val":0}
+    skipped = {}
+    unknown = {}
+    bytes_written = 0
+    start_time = time.time()
+    with Pool(processes) as pool:
+        iterr = tqdm(pool.imap_unordered(_convert_sample,jobs,chunksize=4),total=len(jobs))
+        for result in iterr:
+            if result['skipped'] is not None:
+                print(f"\rSkipping {result['name']}: {result['skipped']}.")
+                skipped[result['skipped']] = skipped.get(result['skipped'],0) + 1
+                continue
+            modes[result['mode']] += 1
+            bytes_written += result['bytes']
+            for label, count in result['unknown'].items():
+                files, pixels = unknown.get(label,(0,0))
+                unknown[label] = (files + 1, pixels + count)
+            iterr.set_description(f"{modes['train']:4} train, {modes['val']:4} val, {sum(skipped.values()):4} skipped")
+    duration = time.time() - start_time
+    write_extended_splits()
+
+    for label, (files, pixels) in sorted(unknown.items()):
+        print(f"Unknown {label} in {files} files ({pixels} pixels) was mapped to background.")
+    for reason, count in skipped.items():
+        print(f"{count} files skipped: {reason}")
+    converted = modes['train'] + modes['val']
+    print(f"Converted {converted} files ({modes['train']} train, {modes['val']} val) into {len(out_locations)} locations "
+          f"in {duration:.1f}s: {converted / max(duration,1e-9):.1f} files/s, {bytes_written / max(duration,1e-9) / 1e6:.1f} MB/s written.")
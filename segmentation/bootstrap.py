@@ -0,0 +1,109 @@
+"""Bootstrap confidence intervals of the class IoUs and mIoU of one or more models, and paired
+significance of the differences between them, from the per-image confusion matrices stored by
+evaluate.py --per-image. Only images evaluated for all given models are used, and all models are
+resampled with the same images, so the comparisons are paired. A difference is marked as
+significant (*) if its confidence interval does not contain 0.
+
+All resamples are computed at once: with the resampling matrix W (resamples x images) the totals of
+all resamples are a single matrix product of W with the per-image class statistics."""
+
+import argparse
+import itertools
+import os
+import time
+import warnings
+
+import numpy as np
+
+from eval_utils import bootstrap_weights, class_stats, iou, load_confusions
+from utils import *
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('files', type=path_arg, nargs='*', default=[], help='the npz files stored by evaluate.py --per-image. If omitted, an interactive choice of the files in --stats-dir is shown.')
+parser.add_argument('--stats-dir', type=path_arg, default=conf.segmentation_stats_path, help='the folder containing the npz files, for the interactive choice. (default from configuration)')
+parser.add_argument('--resamples', type=int, default=2000, help='the number of bootstrap resamples. (default: 2000)')
+parser.add_argument('--confidence', type=float, default=0.95, help='the confidence level of the intervals. (default: 0.95)')
+parser.add_argument('--scene', default="all", choices=["all","indoor","outdoor"], help='the images to use. (default: all)')
+parser.add_argument('--seed', type=int, default=None, help='the seed for the resampling. (default: None / random)')
+args = parser.parse_args()
+
+files = args.files
+if len(files) == 0:
+    files = [os.path.join(args.stats_dir,f) for f in sorted(os.listdir(args.stats_dir)) if f.endswith(".npz")]
+    files = multichoice(files,displaylist=[os.path.basename(f) for f in files])
+    if len(files) == 0: exit()
+
+confusions = [load_confusions(f) for f in files]
+titles = [os.path.splitext(os.path.basename(f))[0] for f in files]
+classnames = list(confusions[0]['classnames'])
+for f, c in zip(files, confusions):
+    if list(c['classnames']) != classnames:
+        print("Different classes in",f)
+        exit()
+
+# Images of the chosen scene which all models were evaluated on, in the same order for all models
+common = set.intersection(*[
+    {name for name, scene in zip(c['names'], c['scenes']) if args.scene == "all" or scene == args.scene}
+    for c in confusions])
+names = sorted(common)
+if len(names) == 0:
+    print("No common images.")
+    exit()
+for title, c in zip(titles, confusions):
+    if len(c['names']) > len(names):
+        print(f"{title}: {len(c['names']) - len(names)} of {len(c['names'])} images not used.")
+stats = []
+for c in confusions:
+    index = {name: i for i, name in enumerate(c['names'])}
+    stats.append(class_stats(c, np.array([index[name] for name in names])))
+
+start_time = time.time()
+rng = np.random.default_rng(args.seed)
+W = bootstrap_weights(args.resamples, len(names), rng)
+num_classes = len(classnames)
+point = [iou(s.sum(axis=0)) for s in stats]
+resampled = [iou((W @ s.reshape(len(names), -1)).reshape(args.resamples, 3, num_classes)) for s in stats]
+with warnings.catch_warnings():
+    # Classes neither annotated nor predicted in a resample are NaN and skipped in the mIoU
+    warnings.simplefilter("ignore", category=RuntimeWarning)
+    point_miou = [np.nanmean(p) for p in point]
+    resampled_miou = [np.nanmean(r, axis=1) for r in resampled]
+duration = time.time() - start_time
+print(f"{args.resamples} resamples of {len(names)} images in {duration:.2f}s.")
+
+alpha = 1 - args.confidence
+def interval(values):
+    """Percentile confidence interval, ignoring NaN resamples."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+def fmt(value, lo, hi):
+    return f"{value:.3f} [{lo:.3f},{hi:.3f}]"
+
+print(f"\n## IoU with {100*args.confidence:g}% confidence intervals")
+print(f"{'class':20} " + " ".join(f"{t[:21]:>21}" for t in titles))
+for k, cl in enumerate(classnames):
+    row = []
+    for p, r in zip(point, resampled):
+        lo, hi = interval(r[:, k])
+        row.append(fmt(p[k], lo, hi))
+    print(f"{cl[:20]:20} " + " ".join(f"{v:>21}" for v in row))
+row = []
+for p, r in zip(point_miou, resampled_miou):
+    lo, hi = interval(r)
+    row.append(fmt(p, lo, hi))
+print(f"{'mIoU':20} " + " ".join(f"{v:>21}" for v in row))
+
+for a, b in itertools.combinations(range(len(files)), 2):
+    print(f"\n## {titles[a]} - {titles[b]}: IoU difference, {100*args.confidence:g}% confidence interval, p-value")
+    def line(name, diff, resampled_diff):
+        lo, hi = interval(resampled_diff)
+        valid = resampled_diff[~np.isnan(resampled_diff)]
+        p = min(1.0, 2 * min(np.mean(valid <= 0), np.mean(valid >= 0))) if len(valid) > 0 else np.nan
+        significant = "*" if lo > 0 or hi < 0 else " "
+        print(f"{name[:20]:20} {diff:+.3f} [{lo:+.3f},{hi:+.3f}] p={p:.3f} {significant}")
+    for k, cl in enumerate(classnames):
+        line(cl, point[a][k] - point[b][k], resampled[a][:, k] - resampled[b][:, k])
+    line("mIoU", point_miou[a] - point_miou[b], resampled_miou[a] - resampled_miou[b])
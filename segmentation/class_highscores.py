@@ -1,12 +1,12 @@
 """Takes all configurations from a directory and computes class-wise highscores of given properties
-(defaults to both IoU and Acc)."""
+(defaults to both IoU and Acc). The logs are read through the metrics store (see metrics_store.py)."""
 
 import numpy as np
 import matplotlib.pyplot as plt
 import os 
-import json
 import argparse
 
+from metrics_store import MetricsStore
 from utils import *
 
 props = ["IoU","Acc"]
@@ -20,12 +20,14 @@ parser.add_argument('--omit-zero', dest="omit_zero", action="store_true",
     help='whether to hide a configuration, if it not made any highscore for a property.')
 parser.add_argument('--second-bests', type=int, default=100,
     help='how many ranks below the best to also show, in gray.')
+parser.add_argument('--db', type=path_arg, default=conf.segmentation_metrics_db,
+    help='the metrics store database file. (default from configuration)')
 args = parser.parse_args()
 
 props = args.properties
 
-files_pre = [f for f in os.listdir(args.log_dir) if f.lower().endswith(".json")]
-files_pre.sort()
+store = MetricsStore(args.db)
+files_pre = store.ingest_dir(args.log_dir)
 files = []
 values = {p:[] for p in props}
 IoUs = []
@@ -37,13 +39,11 @@ final_stats = {
 }
 titles = []
 for log_name in files_pre:
-    try:
-        data = multi_root_json_parse(open(os.path.join(args.log_dir,log_name),"r").read())
-    except json.JSONDecodeError:
-        print("Skipped (json error) ",log_name)
+    data = store.last_val_step(log_name)
+    if data is None:
+        print("Skipped (no val steps) ",log_name)
         continue
-    this_info = data[0]
-    data = data[-1]
+    this_info = store.log(log_name)['info']
     if not "IoU.background" in data:
         print("Skipped (old labels) ",log_name)
         continue
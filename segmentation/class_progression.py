@@ -1,12 +1,19 @@
 """Show the performance of individual classes over time given the training log file. If no logfile argument is given,
-it interactively shows all files in the log-dir and gives a choice."""
+it interactively shows all files in the log-dir and gives a choice. Improvements of a class (new highscores) are
+marked. Lines with more than --max-points points are downsampled, but all marked points are kept. The log is read through the metrics store 
+(see metrics_store.py).
+
+With --follow, the log is tailed while training is running: every --interval seconds the appended records
+are parsed and the existing plot lines are updated in place. With --headless, no window is shown and the
+svg is rewritten on each update instead."""
 import numpy as np
 import matplotlib.pyplot as plt
 import os 
-import json
 import sys 
 import argparse
+import time
 
+from metrics_store import MetricsStore
 from utils import *
 
 """
@@ -46,37 +53,25 @@ def gridarg(strr):
     return grid
 
 parser = argparse.ArgumentParser(description=__doc__)
-parser.set_defaults(save_plots=True,epochs=False)
+parser.set_defaults(save_plots=True,epochs=False,follow=False,headless=False)
 parser.add_argument('logfile', type=path_arg, nargs='?', default=None, help='the training log json to visualize.')
 parser.add_argument('--log-dir', type=path_arg, default=conf.segmentation_logs_path,help='the folder to look for logfiles in when interactive. (default from configuration)')
+parser.add_argument('--db', type=path_arg, default=conf.segmentation_metrics_db, help='the metrics store database file. (default from configuration)')
 parser.add_argument('--plots-dir', type=path_arg, default=conf.segmentation_plots_path,help='the folder to store generated plots into. Will be created if not existent. No files are overwritten. (default from configuration)')
-parser.add_argument('--no-save-plots', dest="save_plots", action="save_false", help='dont save plots as svg into a folder.')
+parser.add_argument('--no-save-plots', dest="save_plots", action="store_false", help='dont save plots as svg into a folder.')
 parser.add_argument('--exclude', type=str, nargs='+',default=[],help='the names of classes to exclude.')
 parser.add_argument('--only', type=str, nargs='+',default=[],help='which classes to display only.')
 parser.add_argument('--grid',type=gridarg,default=[2,3],help='Size of the grid to split the plots into. 1x1 shows all in a single plot. '+gridarg.__doc__)
-parser.add_argument('--epochs', dest="epochs", action="save_true", help='use epochs instead of iterations as time value.')
+parser.add_argument('--epochs', dest="epochs", action="store_true", help='use epochs instead of iterations as time value.')
 parser.add_argument('--property', default="IoU", choices=['IoU','Acc'], help='the property whose values to display.')
+parser.add_argument('--max-points', type=int, default=500, help='the maximum number of points drawn per line. Longer lines are downsampled preserving their shape (LTTB). 0 draws all points. (default: 500)')
+parser.add_argument('--follow', dest="follow", action="store_true", help='keep updating the plot with the records appended to the log while training is running.')
+parser.add_argument('--interval', type=float, default=30, help='the number of seconds between updates with --follow. (default: 30)')
+parser.add_argument('--headless', dest="headless", action="store_true", help='do not show a window, only save the plot (with --follow: rewrite the svg on each update).')
 args = parser.parse_args()
 
-def multi_root_json_parse(string):
-    """Parse a json string with multiple root elements into a list of dicts"""
-    import re
-    regex = re.compile("\{|\}")
-    level = 0
-    start = 0
-    jsons = []
-    for match in regex.finditer(string):
-        if match.group() == "{": level+=1
-        elif match.group() == "}":
-            if level <= 0:
-                raise ValueError("JSON bracket level conflict!! Too many }'s")
-            level -= 1
-            if level == 0:
-                end = match.span()[1]
-                jsons.append(json.loads(string[start:end]))
-                start = end+1
-    return jsons
-
+if args.headless:
+    plt.switch_backend("Agg")
 
 classnames = [cl.name for cl in conf.classes]
 if len(args.exclude) > 0:
@@ -112,29 +107,17 @@ if args.save_plots:
         os.makedirs(args.plots_dir)
         print("Generated plot output folder",args.plots_dir)
 
-max_length = []
-train_steps = []
-val_steps = []
-last_train_iter = 0
-with open(log_path) as f:
-    jsons = multi_root_json_parse(f.read())
-    
-this_info = jsons[0]
-for line_json in jsons[1:]:
-    if not 'mode' in line_json.keys():
-        print("Skip")
-        continue
-    if line_json['mode'] == "train":
-        train_steps.append(line_json)
-        last_train_iter = line_json['iter']
-    else:
-        line_json['last_train_iter'] = last_train_iter
-        val_steps.append(line_json)
+store = MetricsStore(args.db)
+store.ingest(log_path)
+log = store.log(log_path)
+this_info = log['info']
+train_steps = store.train_steps(log_path)
+val_steps = store.val_steps(log_path)
 print(f"{log_path}: {len(train_steps)} train steps, {len(val_steps)} val steps")
 if args.epochs:
-    max_length = max(val_steps[-1]['epoch'],train_steps[-1]['epoch'])
+    max_length = max([step['epoch'] for step in val_steps + train_steps],default=0)
 else:
-    max_length = last_train_iter
+    max_length = log['last_train_iter']
 
 def classplot(axis,val,setup=True,prop="IoU",label="",color="blue",i=0,length=1,classnames=None,index_shift=0):
     barwidth = 0.6
@@ -188,8 +171,29 @@ plot_x = -1
 plot_y = -1
 plot_i = 0
 axis = None
-time_axis = [item['epoch'] if args.epochs else item['last_train_iter']/1000 for item in val_steps]
+def time_value(item):
+    return item['epoch'] if args.epochs else item['last_train_iter']/1000
+
+def improvement_indices(values):
+    """Indices of the values (after the first) which are higher than all before."""
+    indices = []
+    best = values[0] if len(values) > 0 else None
+    for i in range(1,len(values)):
+        if values[i] > best:
+            best = values[i]
+            indices.append(i)
+    return indices
+
+def line_data(time_axis, values, imprv_indices):
+    """Time axis and values downsampled to --max-points (keeping the improvements), and the
+    positions of the improvements in the downsampled line, for markevery."""
+    kept = downsample_indices(time_axis,values,args.max_points,keep=imprv_indices)
+    return np.asarray(time_axis)[kept], np.asarray(values)[kept], list(np.searchsorted(kept,imprv_indices))
+
+time_axis = [time_value(item) for item in val_steps]
 improvements = np.zeros((len(time_axis)))
+# Line of each class, which is updated with --follow
+class_lines = {}
 
 print("\nTable of class highscores per",('epoch' if args.epochs else 'iteration (x 1000)'),":")
 print("classname, ",", ".join([str(t) for t in time_axis]))
@@ -204,22 +208,14 @@ for class_index,class_name in enumerate(classnames):
     propname = args.property+"."+class_name
     values = [item[propname] for item in val_steps]
     color = conf.by_name[class_name].color / 255.0
-    imprv_indices = []
-    maxx = val_steps[0][propname]
-    print(class_name,", ",end="")
-    for i,step in enumerate(val_steps[1:]):
-        if step[propname] > maxx:
-            maxx = step[propname]
-            imprv_indices.append(i+1)
-            print("x, ",end="")
-        else:
-            print(" , ",end="")
-    print("")
+    imprv_indices = improvement_indices(values)
+    print(class_name,", "+"".join("x, " if i in imprv_indices else " , " for i in range(1,len(values))))
     improvements[imprv_indices] += 1
-    axis.plot(
-        time_axis,
-        values,"o-",color=color,label=class_name,
-        markevery=imprv_indices)
+    line_x, line_y, markers = line_data(time_axis,values,imprv_indices)
+    class_lines[class_name] = axis.plot(
+        line_x,
+        line_y,"o-",color=color,label=class_name,
+        markevery=markers)[0]
     
 print("")
 
@@ -237,4 +233,49 @@ if args.save_plots:
     plt.savefig(plot_filepath)
     print("Saved plot to",plot_filepath)
 
-plt.show()
+def update():
+    """Add the val steps appended to the log to the plot. If the log was replaced, the lines are 
+    rebuilt from scratch. The svg (if saved) is overwritten."""
+    new_train, new_val = store.ingest(log_path)
+    if store.step_count("val",log_path) != len(val_steps) + new_val:
+        # The log was replaced and ingested again, its steps in the store start at 0 again
+        val_steps.clear()
+        new_val = store.step_count("val",log_path)
+        print(f"{time.strftime('%H:%M:%S')} log replaced")
+    elif new_val == 0: return
+    first_new = len(val_steps)
+    val_steps.extend(store.val_steps(log_path,first_step=first_new))
+    time_axis = [time_value(item) for item in val_steps]
+    new_highscores = []
+    for class_name, line in class_lines.items():
+        values = [item[args.property+"."+class_name] for item in val_steps]
+        imprv_indices = improvement_indices(values)
+        line_x, line_y, markers = line_data(time_axis,values,imprv_indices)
+        line.set_data(line_x,line_y)
+        line.set_markevery(markers)
+        if len(imprv_indices) > 0 and imprv_indices[-1] >= first_new:
+            new_highscores.append(class_name)
+    print(f"{time.strftime('%H:%M:%S')} +{new_val} val steps, new highscores: {', '.join(new_highscores) if len(new_highscores) > 0 else 'none'}")
+    for a in fig.axes:
+        a.relim()
+        a.autoscale_view()
+    fig.canvas.draw_idle()
+    if args.save_plots:
+        fig.savefig(plot_filepath)
+
+if args.follow:
+    print(f"Following {log_path} every {args.interval}s, stop with Ctrl+C.")
+    if args.headless:
+        try:
+            while True:
+                time.sleep(args.interval)
+                update()
+        except KeyboardInterrupt:
+            pass
+    else:
+        timer = fig.canvas.new_timer(interval=int(args.interval*1000))
+        timer.add_callback(update)
+        timer.start()
+        plt.show()
+elif not args.headless:
+    plt.show()
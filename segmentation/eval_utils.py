@@ -0,0 +1,232 @@
+"""Utilities for scoring segmentation results against ground truth annotations, with the same metrics
+and keys as the MMSegmentation validation logs (aAcc, mIoU, mAcc, IoU.<CLASSNAME>, Acc.<CLASSNAME>):
+
+-   match_files : Pair prediction pngs (see inference_test.py) with annotation pngs and their scene
+-   confusion_matrix : Confusion matrix of one image
+-   evaluate : Confusion matrices of many images per scene, computed in a pool of processes
+-   metrics : Metrics of a confusion matrix
+-   save_confusions, load_confusions : Compact storage of the confusion matrices of single images
+-   class_stats, bootstrap_weights, iou : Vectorized bootstrap of the class IoUs over images
+
+Predictions contain the class ids, annotations the class ids + 1 with 0 as ignored pixels (see
+annotate.py). Predicted ids outside of the classes are counted as an extra 'other' class, which
+is always wrong.
+"""
+import os
+from multiprocessing import Pool
+from typing import List
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+scenes = ["indoor","outdoor"]
+
+
+def match_files(pred_dir : str, ann_dir : str):
+    """Pair all prediction pngs with the annotation of the same name. Predictions prefixed with
+    a scene (as written by inference_test.py for split image folders) are matched without the
+    prefix. Annotations are looked up in ann_dir and in its scene subfolders. The scene of a pair
+    is taken from the prefix or the subfolder, if any.
+
+    Args:
+        pred_dir (str): Folder of the prediction pngs
+        ann_dir (str): Folder of the annotation pngs
+
+    Returns:
+        List[tuple]: (prediction path, annotation path, scene or None) of each matched prediction
+        List[str]: Prediction paths without annotation
+    """
+    pairs = []
+    missing = []
+    for name in sorted(os.listdir(pred_dir)):
+        if not name.lower().endswith(".png"): continue
+        scene = None
+        ann_name = name
+        for s in scenes:
+            if name.startswith(s + "_"):
+                scene = s
+                ann_name = name[len(s)+1:]
+        candidates = [(os.path.join(ann_dir,ann_name), scene)]
+        candidates += [(os.path.join(ann_dir,s,ann_name), s) for s in scenes if scene in (None, s)]
+        for ann_path, ann_scene in candidates:
+            if os.path.exists(ann_path):
+                pairs.append((os.path.join(pred_dir,name), ann_path, ann_scene))
+                break
+        else:
+            missing.append(os.path.join(pred_dir,name))
+    return pairs, missing
+
+
+def confusion_matrix(pred, gt, num_classes : int):
+    """Confusion matrix of one image, rows are the annotated and columns the predicted classes.
+
+    Args:
+        pred (np.array): Predicted class ids
+        gt (np.array): Annotated class ids + 1, 0 is ignored
+        num_classes (int): Number of classes
+
+    Returns:
+        np.array: (num_classes+1)x(num_classes+1) pixel counts, the last column counts predictions
+            outside of the classes. The last row is always 0.
+    """
+    n = num_classes + 1
+    gt = gt.astype(np.int64).ravel() - 1
+    pred = np.minimum(pred.ravel(), num_classes).astype(np.int64)
+    valid = (gt >= 0) & (gt < num_classes)
+    return np.bincount(gt[valid] * n + pred[valid], minlength=n * n).reshape(n, n)
+
+
+def _image_confusion(job):
+    """Worker of evaluate: confusion matrix of one prediction and annotation."""
+    pred_path, ann_path, num_classes = job
+    pred = np.array(Image.open(pred_path))
+    gt = np.array(Image.open(ann_path))
+    if pred.shape != gt.shape:
+        raise ValueError(f"Prediction {pred_path} has shape {pred.shape}, annotation {ann_path} has shape {gt.shape}")
+    return confusion_matrix(pred, gt, num_classes)
+
+
+def evaluate(pairs : List[tuple], num_classes : int, processes : int = None, per_image : list = None):
+    """Sum the confusion matrices of all pairs, in total and per scene, in a pool of processes.
+
+    Args:
+        pairs (List[tuple]): (prediction path, annotation path, scene or None), see match_files
+        num_classes (int): Number of classes
+        processes (int, optional): Number of processes. Defaults to the number of cpus.
+        per_image (list, optional): If given, the confusion matrix of each pair is appended to it,
+            in the order of the pairs. Defaults to None.
+
+    Returns:
+        Dict[str,np.array]: Confusion matrix for 'all' and each scene with images
+    """
+    results = {"all": 0}
+    jobs = [(pred_path, ann_path, num_classes) for pred_path, ann_path, _ in pairs]
+    with Pool(processes) as pool:
+        iterr = pool.imap(_image_confusion, jobs, chunksize=8)
+        for (_, _, scene), cm in tqdm(zip(pairs, iterr), total=len(jobs)):
+            results["all"] = results["all"] + cm
+            if per_image is not None:
+                per_image.append(cm)
+            if scene is not None:
+                results[scene] = results.get(scene, 0) + cm
+    return results
+
+
+def metrics(cm, classnames : List[str]):
+    """Metrics of a confusion matrix, as in the MMSegmentation validation logs. The IoU of classes
+    which are neither annotated nor predicted and the Acc of classes without annotated pixels are 
+    NaN and not part of mIoU and mAcc. Classes which are only predicted have an IoU of 0.
+
+    Args:
+        cm (np.array): Confusion matrix, see confusion_matrix
+        classnames (List[str]): Name of each class
+
+    Returns:
+        dict: aAcc, mIoU, mAcc, IoU.<CLASSNAME> and Acc.<CLASSNAME>
+    """
+    n = len(classnames)
+    cm = np.asarray(cm, dtype=np.float64)
+    intersect = np.diag(cm)[:n]
+    area_label = cm.sum(axis=1)[:n]
+    area_pred = cm.sum(axis=0)[:n]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersect / (area_label + area_pred - intersect)
+        acc = intersect / area_label
+    result = {
+        "aAcc": round(float(intersect.sum() / max(area_label.sum(), 1)), 4),
+        "mIoU": round(float(np.nanmean(iou)), 4) if not np.all(np.isnan(iou)) else float("nan"),
+        "mAcc": round(float(np.nanmean(acc)), 4) if not np.all(np.isnan(acc)) else float("nan"),
+    }
+    for name, value in zip(classnames, iou):
+        result[f"IoU.{name}"] = round(float(value), 4)
+    for name, value in zip(classnames, acc):
+        result[f"Acc.{name}"] = round(float(value), 4)
+    return result
+
+
+def save_confusions(path : str, names : List[str], scenes : List[str], cms : List[np.array], classnames : List[str]):
+    """Store the confusion matrices of single images compactly in an npz file: only the non-zero
+    cells of each matrix, as flat cell indices and pixel counts (uint32).
+
+    Args:
+        path (str): Path of the npz file
+        names (List[str]): Name of each image, to pair the images of different models
+        scenes (List[str]): Scene of each image (or None)
+        cms (List[np.array]): Confusion matrix of each image, see confusion_matrix
+        classnames (List[str]): Name of each class
+    """
+    cells = [np.flatnonzero(cm) for cm in cms]
+    counts = [cm.ravel()[c] for cm, c in zip(cms, cells)]
+    offsets = np.concatenate([[0], np.cumsum([len(c) for c in cells])]).astype(np.int64)
+    np.savez_compressed(path,
+        names = np.array(names),
+        scenes = np.array(["" if scene is None else scene for scene in scenes]),
+        classnames = np.array(classnames),
+        offsets = offsets,
+        cells = np.concatenate(cells).astype(np.uint32) if len(cells) > 0 else np.zeros(0, np.uint32),
+        counts = np.concatenate(counts).astype(np.uint32) if len(counts) > 0 else np.zeros(0, np.uint32))
+
+
+def load_confusions(path : str):
+    """Load confusion matrices of single images stored by save_confusions.
+
+    Returns:
+        dict: names, scenes (empty string for unknown), classnames, offsets, cells and counts
+    """
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def class_stats(confusions : dict, images = None):
+    """Intersection, annotated area and predicted area of each class in each image, which are
+    all that is needed to compute the IoU of any set of images.
+
+    Args:
+        confusions (dict): Confusion matrices of single images, see load_confusions
+        images (np.array, optional): Indices of the images to use, in this order. Defaults to all.
+
+    Returns:
+        np.array: Nx3xC pixel counts (intersection, annotated, predicted) of N images and C classes
+    """
+    c = len(confusions['classnames'])
+    n = c + 1
+    num_images = len(confusions['names'])
+    img = np.repeat(np.arange(num_images), np.diff(confusions['offsets']))
+    gt = confusions['cells'] // n
+    pred = confusions['cells'] % n
+    counts = confusions['counts'].astype(np.float64)
+    def per_image_class(mask, cls):
+        return np.bincount(img[mask] * c + cls[mask], weights=counts[mask], minlength=num_images * c).reshape(num_images, c)
+    stats = np.stack([
+        per_image_class((gt == pred) & (gt < c), gt),
+        per_image_class(gt < c, gt),
+        per_image_class(pred < c, pred)], axis=1)
+    return stats if images is None else stats[images]
+
+
+def bootstrap_weights(num_resamples : int, num_images : int, rng):
+    """Resampling matrix W of the bootstrap: W[b,i] is how often image i is drawn in resample b.
+    The totals of all resamples are then W @ per-image values.
+
+    Args:
+        num_resamples (int): Number of resamples B
+        num_images (int): Number of images N
+        rng (np.random.Generator): Random generator
+
+    Returns:
+        np.array: BxN float32
+    """
+    draws = rng.integers(0, num_images, size=(num_resamples, num_images))
+    draws += np.arange(num_resamples)[:, None] * num_images
+    return np.bincount(draws.ravel(), minlength=num_resamples * num_images).reshape(
+        num_resamples, num_images).astype(np.float32)
+
+
+def iou(totals):
+    """IoU of each class from summed class_stats (...x3xC), NaN for classes which are neither 
+    annotated nor predicted, as in metrics."""
+    intersect, area_label, area_pred = totals[..., 0, :], totals[..., 1, :], totals[..., 2, :]
+    union = area_label + area_pred - intersect
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersect / union, np.nan)
@@ -0,0 +1,78 @@
+"""Score the results of inference_test.py against ground truth annotations. For each given output
+folder, all prediction pngs are matched with the annotation pngs of the same name in --ann-dir (or its
+indoor/outdoor subfolders) and the confusion matrices are summed in a pool of processes. The metrics
+are printed and stored as json in --stats-dir, with the same keys as the validation entries of the
+training logs (aAcc, mIoU, mAcc, IoU.<CLASSNAME>, Acc.<CLASSNAME>), for all images and separately
+for the indoor and outdoor images, if their scene is known from the file name prefix or the
+annotation subfolder.
+
+With --per-image, the confusion matrix of each image is also stored compactly (eval_<FOLDER>.npz), for
+bootstrap confidence intervals and model comparisons with bootstrap.py."""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from eval_utils import evaluate, match_files, metrics, save_confusions
+from utils import *
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.set_defaults(per_image=False)
+parser.add_argument('folders', type=path_arg, nargs='*', default=[], help='the output folders of inference_test.py to score. If omitted, an interactive choice of the folders in --output-dir is shown.')
+parser.add_argument('--output-dir', type=path_arg, default=conf.segmentation_out_path, help='the folder containing the output folders, for the interactive choice. (default from configuration)')
+parser.add_argument('--ann-dir', type=path_arg, default=os.path.join(conf.dataset_out_path,"inout","annotations","val"), help='the folder containing the annotation pngs, optionally split into indoor/outdoor subfolders. (default: annotations/val of the inout dataset)')
+parser.add_argument('--stats-dir', type=path_arg, default=conf.segmentation_stats_path, help='the folder to store the json results in. (default from configuration)')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of processes reading the images. (default: number of cpus)')
+parser.add_argument('--per-image', dest="per_image", action="store_true", help='whether to also store the confusion matrix of each image, for bootstrap.py.')
+args = parser.parse_args()
+
+if not os.path.exists(args.ann_dir):
+    print("Annotation dir does not exist: ",args.ann_dir)
+    exit()
+
+folders = args.folders
+if len(folders) == 0:
+    folders = [os.path.join(args.output_dir,d) for d in sorted(os.listdir(args.output_dir))]
+    folders = [d for d in folders if os.path.isdir(d)]
+    folders = multichoice(folders,displaylist=[os.path.basename(d) for d in folders])
+    if len(folders) == 0: exit()
+
+classnames = [cl.name for cl in conf.classes]
+os.makedirs(args.stats_dir, exist_ok=True)
+
+for folder in folders:
+    name = os.path.basename(os.path.normpath(folder))
+    print("#",name,"#")
+    pairs, missing = match_files(folder, args.ann_dir)
+    if len(missing) > 0:
+        print(f"{len(missing)} predictions without annotation are skipped, e.g. {missing[0]}")
+    if len(pairs) == 0:
+        print("No predictions with annotations found.")
+        continue
+    start_time = time.time()
+    per_image = [] if args.per_image else None
+    cms = evaluate(pairs, len(classnames), args.processes, per_image)
+    duration = time.time() - start_time
+    pixels = int(cms["all"].sum())
+    print(f"{len(pairs)} images, {pixels} annotated pixels in {duration:.1f}s ({len(pairs)/max(duration,1e-9):.1f} images/s).")
+
+    results = {scene: metrics(cm, classnames) for scene, cm in cms.items()}
+    for scene, result in results.items():
+        print(f"{scene:8}: aAcc {result['aAcc']:.4f} | mIoU {result['mIoU']:.4f} | mAcc {result['mAcc']:.4f}")
+    print(f"{'class':20} " + " ".join(f"{scene:>8}" for scene in results))
+    for cl in classnames:
+        print(f"{cl[:20]:20} " + " ".join(f"{result[f'IoU.{cl}']:8.4f}" for result in results.values()))
+
+    out_path = os.path.join(args.stats_dir,f"eval_{name}.json")
+    with open(out_path,"w") as f:
+        json.dump(dict(folder=folder, ann_dir=args.ann_dir, images=len(pairs), **results), f, indent=1)
+    print("Stored in",out_path)
+    if per_image is not None:
+        out_path = os.path.join(args.stats_dir,f"eval_{name}.npz")
+        save_confusions(out_path, [os.path.basename(pred_path) for pred_path,_,_ in pairs],
+            [scene for _,_,scene in pairs], per_image, classnames)
+        print(f"Per-image confusion matrices stored in {out_path} ({os.path.getsize(out_path)/1e3:.1f} kB)")
@@ -7,19 +7,47 @@ exist in that directory. In that case, algorithms trained only indoor/outdoor wi
 corresponding images. 
 
 Images are then saved to --output-dir, into one folder per model. Each image is stored as .jpg (original
-with segmentation overlayed) and as .png (original segmentation mask, as P-Mode png)."""
+with segmentation overlayed) and as .png (original segmentation mask, as P-Mode png).
+
+Images are decoded in a background thread just ahead of the inference and each result is written
+in another background thread as soon as it is there, so only a few images are in memory at once.
+
+The algorithms can run on the CPU (--device cpu). With --batch-size > 1, images of the same size
+(after the resize of the test pipeline) are grouped into batches and processed at once, so no padding
+changes the results. Test time augmentations (flip, multiple scales) are run one image at a time.
+
+All picked algorithms are loaded at once. Algorithms with the same test pipeline (resize, normalization)
+share the images: each image is decoded and preprocessed once and then run through all of them, with
+one writer thread per algorithm. With --tensor-cache-dir, the preprocessed images are also stored on
+disk, so later runs with the same pipeline skip decoding and preprocessing.
+
+For large images, --tile-size N runs the algorithms on overlapping N x N tiles of the preprocessed
+image, --tile-batch-size tiles at once, and blends the logits in the overlaps. With --max-memory, the
+tile batch size is chosen to stay within the given memory budget. --tile-check N additionally runs
+whole-image inference on the first N images and reports how many pixels agree with the tiled result.
+
+With --cache-dir, every result is cached on disk, keyed by the checkpoint, config, image content and
+the inference options, so a rerun only computes missing results and writes the outputs from the cache.
+Batched results are treated as equal to single-image results."""
 
 import argparse
+import contextlib
+import functools
 import os
 import pickle
 import sys
+import time
 
 import mmcv
 import numpy as np
-from mmseg.apis import inference_segmentor, init_segmentor
+import torch
+from mmseg.apis import init_segmentor
 from PIL import Image
 from tqdm import tqdm
 
+from inference_utils import (Prefetcher, ResultCache, ResultWriter, TensorCache, batch_inference,
+                             bucket_batches, list_images, pipeline_key, probe_tile_batch_size,
+                             revert_sync_batchnorm, size_key, test_pipeline, tiled_inference)
 from utils import *
 
 
@@ -27,7 +55,18 @@ parser = argparse.ArgumentParser(description=__doc__)
 parser.set_defaults(paths=False,ignore_model_classcount=False)
 parser.add_argument('folders', type=path_arg, nargs='*', default=[], help='the algorithm folders to use. Interpreted as paths relative to --work-dir, or relative to this script if --paths True is set. if omitted, an interactive choice is shown.')
 parser.add_argument('--paths', dest="paths", action="store_true", help='whether to interpret the positional arguments as paths. If set to False (default), the arguments are interpreted as paths relative to --work-dir.')
-parser.add_argument('--max-imgs', type=int, default=999999, help='the maximum number of images to run inference on.')
+parser.add_argument('--max-imgs', type=int, default=999999, help='the maximum number of images to run inference on. Only these are decoded.')
+parser.add_argument('--queue-size', type=int, default=8, help='the maximum number of decoded images and results waiting to be processed or written. (default: 8)')
+parser.add_argument('--device', type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help='the device to run the algorithms on, e.g. cpu or cuda:0. (default: cuda:0 if available, else cpu)')
+parser.add_argument('--batch-size', type=int, default=1, help='the number of images to process at once. Images are grouped by their exact size, so they need no padding. (default: 1)')
+parser.add_argument('--cache-dir', type=path_arg, default=None, help='the folder to cache the results in. Reruns only compute results which are not cached. (default: None / no result cache)')
+parser.add_argument('--tensor-cache-dir', type=path_arg, default=None, help='the folder to cache the preprocessed images in, for later runs with the same test pipeline. Takes a few MB per image. (default: None / no disk cache)')
+parser.add_argument('--tile-size', type=int, default=None, help='the edge length of the tiles to run the algorithms on, in pixels of the preprocessed image. (default: None / whole images)')
+parser.add_argument('--tile-overlap', type=int, default=64, help='the minimum overlap of neighbouring tiles in pixels. (default: 64)')
+parser.add_argument('--tile-batch-size', type=int, default=4, help='the number of tiles to process at once, unless --max-memory is given. (default: 4)')
+parser.add_argument('--max-memory', type=int, default=None, help='the memory budget in MB for tiled inference (resident memory of this process on the CPU, allocated memory on a GPU), which determines the tile batch size. (default: None / use --tile-batch-size)')
+parser.add_argument('--tile-check', type=int, default=0, help='the number of images to also run whole-image inference on, to compare it with the tiled inference. (default: 0)')
+parser.add_argument('--tile-tolerance', type=float, default=0.99, help='the minimum fraction of pixels which have to agree in the --tile-check. (default: 0.99)')
 parser.add_argument('--images-dir', type=path_arg, default=conf.test_images_dir, help='the folder containing the images to run inference on. (default from configuration)')
 
 parser.add_argument('--work-dir', type=path_arg, default=conf.segmentation_model_path, help='the folder containing all trained algorithms folders. (default from configuration)')
@@ -36,6 +75,10 @@ parser.add_argument('--overlay-opacity', type=float, default=0.5, help='the opac
 parser.add_argument('--ignore-model-classcount', dest="ignore_model_classcount", action="store_true", help='whether to ignore if a model has more classes than the general configuration. If set to False, a dialog will show in this case, if set to True (or if the dialog is answered with Yes), the palette will be padded with blacks.')
 args = parser.parse_args()
 
+if args.tile_size is not None and args.tile_overlap >= args.tile_size:
+    print("The tile overlap must be smaller than the tile size.")
+    exit()
+
 
 if not os.path.exists(args.images_dir):
     print("Images dir does not exist: ",args.images_dir)
@@ -104,86 +147,163 @@ if len(args.folders) == 0:
     if not input("Is this okay? [y/n]") in ["y","Y"]:
         exit()
 
-print("Loading images ...")
-in_folders = ["indoor","outdoor"]
-in_out_split = True
-for folder in in_folders:
-    in_folder = os.path.join(args.images_dir,folder)
-    if not os.path.exists(in_folder):
-        print("Indoor/Outdoor folder missing, use all images from ",args.images_dir)
-        in_out_split=False
-    
-if in_out_split:
-    all_images = {}
-    all_image_names = {}
-    for folder in in_folders:
-        folder_path = os.path.join(args.images_dir,folder)
-        images = []
-        img_names = os.listdir(folder_path)
-        for img_name in img_names:
-            images.append(mmcv.imread(os.path.join(folder_path,img_name)))
-        all_images[folder] = images
-        all_image_names[folder] = img_names
-    print(f" done. {len(all_images['indoor'])} indoor, {len(all_images['outdoor'])} outdoor.")
-else:
-    all_images = []
-    all_image_names = os.listdir(custom_folder)
-    for img_name in all_image_names:
-        all_images.append(mmcv.imread(os.path.join(custom_folder,img_name)))
-    print(f" done. {len(all_images)} images.")
-
-    
-
+all_images = list_images(args.images_dir)
+in_out_split = None not in all_images
+print(" | ".join(f"{len(paths)} {folder or 'all'}" for folder,paths in all_images.items()),"images found.")
 
+loaded = []
 for model_desc in models:
-    print("# Model",model_desc['name'],"#")
-    print("- load model... ")
+    print("- load model",model_desc['name'],"...")
     # build the model from a config file and a checkpoint file
-    model = init_segmentor(model_desc['config_file'], model_desc['checkpoint_file'], device='cuda:0')
-    print(f"- ...done loading model.")
+    model = init_segmentor(model_desc['config_file'], model_desc['checkpoint_file'], device=args.device)
+    if args.device == "cpu":
+        model = revert_sync_batchnorm(model)
     
     if len(model.CLASSES) != len(conf.palette) and not args.ignore_model_classcount:
         if not input(f"{len(model.CLASSES)} classes in model, {len(conf.palette)} palette items. Okay? [y/n] ") in ["y","Y"]:
             continue
-    palette = conf.padded_palette(len(model.CLASSES))
     
     out_folder = os.path.join(args.output_dir,"output_"+model_desc['name'])
-    
     if not os.path.exists(out_folder): os.makedirs(out_folder)
     
+    # (image path, output name without extension)
     if in_out_split:
-        images = []
-        #image_paths = []
-        out_img_names = []
-        for folder in model_desc['input_folders']:
-            images = images + all_images[folder]
-            #image_paths.extend([os.path.join(in_folder_root,folder,n) for n in all_image_names[folder]])
-            out_img_names = out_img_names + [folder+"_"+n for n in all_image_names[folder]]
+        items = [(path, folder+"_"+os.path.splitext(os.path.basename(path))[0])
+            for folder in model_desc['input_folders'] for path in all_images[folder]]
     else:
-        images = all_images
-        out_img_names = all_image_names
-        
-    num_imgs = min(args.max_imgs,len(out_img_names))
-    print(f"- inference on {num_imgs} images... ")
-    # test a single image and show the results
-    results = [] 
-    min_index = 9999
-    max_index = -1
-    for img in tqdm(images[:num_imgs]):
-        result = inference_segmentor(model, img)
-        #result = [res + 1 for res in result] # this would account for the shift. but maybe we don't need it.
-        results.append(result)
-        min_index = min(min_index,np.min(result[0]))
-        max_index = max(max_index,np.max(result[0]))
-    print("- ...done inference.")
-    print(f"Min index {min_index} max index {max_index}")
+        items = [(path, os.path.splitext(os.path.basename(path))[0]) for path in all_images[None]]
+    
+    loaded.append(dict(model_desc,
+        model = model,
+        palette = conf.padded_palette(len(model.CLASSES)),
+        out_folder = out_folder,
+        items = items[:args.max_imgs],
+        model_time = 0.0,
+        tile_batch_size = args.tile_batch_size if args.max_memory is None else None,
+        tile_checks = [],
+        min_index = 9999,
+        max_index = -1))
+print(f"- ...done loading {len(loaded)} models.")
+
+results_cache = None
+if args.cache_dir is not None:
+    results_cache = ResultCache(args.cache_dir)
+    options = dict(tile_size=args.tile_size, tile_overlap=args.tile_overlap if args.tile_size is not None else None)
+    for m in loaded:
+        m['result_key'] = ResultCache.model_key(m['model'], m['checkpoint_file'], options)
+
+# Models with the same test pipeline share the decoded and preprocessed images
+groups = {}
+for m in loaded:
+    groups.setdefault(pipeline_key(m['model']),[]).append(m)
+print(f"{len(groups)} distinct test pipelines.")
+
+def write(m, out_name, img, result, cache_key=None):
+    if cache_key is not None:
+        results_cache.put(cache_key, result[0])
+    ann_img = Image.fromarray(np.array(result[0],dtype=np.uint8),'P')
+    ann_img.putpalette(m['palette'].flatten())
+    ann_img.save(os.path.join(m['out_folder'],out_name+".png"))
+    m['model'].show_result(img, result, palette=m['palette'], out_file=os.path.join(m['out_folder'],out_name+".jpg"), opacity=args.overlay_opacity)
+
+for key, group in groups.items():
+    print("# Models",", ".join(m['name'] for m in group),"#")
+    # (image path, output name, indices of the models processing it) of each image any model needs
+    wanted = {}
+    for k, m in enumerate(group):
+        for path, out_name in m['items']:
+            wanted.setdefault((path, out_name), []).append(k)
+    items = [(path, out_name, ks) for (path, out_name), ks in wanted.items()]
     
-    print("- store results... ",end="")
-    for img_name,result,img in zip(out_img_names,results,images):
-        # with open(os.path.join(out_folder,img_name[:-4]+".pkl"),"wb") as ff:
-        #     pickle.dump(result, ff)
-        ann_img = Image.fromarray(np.array(result[0],dtype=np.uint8),'P')
-        ann_img.putpalette(palette.flatten())
-        ann_img.save(os.path.join(out_folder,img_name[:-4]+".png"))
-        model.show_result(img, result, palette=palette, out_file=os.path.join(out_folder,img_name[:-4]+".jpg"), opacity=args.overlay_opacity)
-    print("done.")
+    pipeline = test_pipeline(group[0]['model'])
+    def preprocess(path):
+        img = mmcv.imread(path)
+        return img, pipeline(dict(img=img))
+    tensor_cache = None
+    if args.tensor_cache_dir is not None:
+        tensor_cache = TensorCache(args.tensor_cache_dir, key)
+    # (image, preprocessed image, cached results by model index, cache keys by model index) of an item.
+    # The image is only preprocessed if a result is missing.
+    def load(item):
+        path, _, ks = item
+        cached = {}
+        cache_keys = {}
+        if results_cache is not None:
+            with open(path,"rb") as f:
+                img_bytes = f.read()
+            for k in ks:
+                cache_keys[k] = ResultCache.key(group[k]['result_key'], img_bytes)
+                seg = results_cache.get(cache_keys[k])
+                if seg is not None: cached[k] = seg
+            if len(cached) == len(ks):
+                return mmcv.imfrombytes(img_bytes), None, cached, cache_keys
+        if tensor_cache is not None:
+            img, data = tensor_cache.load(path, preprocess)
+        else:
+            img, data = preprocess(path)
+        return img, data, cached, cache_keys
+    
+    if args.tile_size is not None:
+        mode = f" in tiles of {args.tile_size}x{args.tile_size}"
+    elif args.batch_size > 1:
+        mode = f" in batches of {args.batch_size}"
+    else:
+        mode = ""
+    print(f"- inference on {len(items)} images on {args.device}{mode}... ")
+    images = Prefetcher(items, load, args.queue_size)
+    start_time = time.time()
+    try:
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(functools.partial(write, m), args.queue_size)) for m in group]
+            stack.enter_context(torch.inference_mode())
+            progress = stack.enter_context(tqdm(total=len(items)))
+            if args.batch_size > 1 and args.tile_size is None:
+                batches = bucket_batches(images, args.batch_size, lambda entry: size_key(entry[1][1]) if entry[1][1] is not None else None)
+            else:
+                batches = ([entry] for entry in images)
+            for batch in batches:
+                for k, m in enumerate(group):
+                    for (_, out_name, _), (img, _, cached, _) in batch:
+                        if k in cached:
+                            m['min_index'] = min(m['min_index'],np.min(cached[k]))
+                            m['max_index'] = max(m['max_index'],np.max(cached[k]))
+                            writers[k].put(out_name, img, [cached[k]])
+                    entries = [entry for entry in batch if k in entry[0][2] and k not in entry[1][2]]
+                    if len(entries) == 0: continue
+                    t = time.perf_counter()
+                    if args.tile_size is None:
+                        segs = batch_inference(m['model'], [data for _,(_,data,_,_) in entries], args.device)
+                    else:
+                        (_, (_, data, _, _)), = entries
+                        if m['tile_batch_size'] is None:
+                            m['tile_batch_size'] = probe_tile_batch_size(m['model'], data, args.device, args.tile_size, args.max_memory * 2**20)
+                            print(f"\r{m['name']}: {m['tile_batch_size']} tiles at once within {args.max_memory} MB")
+                        segs = [tiled_inference(m['model'], data, args.device, args.tile_size, args.tile_overlap, m['tile_batch_size'])]
+                    m['model_time'] += time.perf_counter() - t
+                    if args.tile_size is not None and len(m['tile_checks']) < args.tile_check:
+                        whole = batch_inference(m['model'], [data], args.device)[0]
+                        m['tile_checks'].append(np.mean(whole == segs[0]))
+                    for ((img_path, out_name, _), (img, _, _, cache_keys)), seg in zip(entries, segs):
+                        #seg = seg + 1 # this would account for the shift. but maybe we don't need it.
+                        m['min_index'] = min(m['min_index'],np.min(seg))
+                        m['max_index'] = max(m['max_index'],np.max(seg))
+                        writers[k].put(out_name, img, [seg], cache_keys.get(k))
+                progress.update(len(batch))
+    finally:
+        images.close()
+    duration = time.time() - start_time
+    print(f"- ...done inference, {len(items)} images decoded once for {len(group)} models.")
+    if tensor_cache is not None:
+        print(f"Tensor cache: {tensor_cache.hits} hits, {tensor_cache.misses} misses.")
+    for m, writer in zip(group, writers):
+        model_ms = 1000*m['model_time']/max(len(m['items']),1)
+        print(f"{m['name']}: {writer.count} results stored, min index {m['min_index']} max index {m['max_index']}, {model_ms:.1f} ms model time per image")
+        if len(m['tile_checks']) > 0:
+            failed = sum(agreement < args.tile_tolerance for agreement in m['tile_checks'])
+            print(f"{m['name']}: tiled and whole-image inference agree on {100*np.mean(m['tile_checks']):.2f}% of the pixels"
+                  f" (min {100*np.min(m['tile_checks']):.2f}%), {failed} of {len(m['tile_checks'])} images below {100*args.tile_tolerance:.1f}%")
+    if len(items) > 0:
+        print(f"{len(items)/duration:.2f} images/s")
+if results_cache is not None:
+    print(f"Result cache: {results_cache.hits} hits, {results_cache.misses} misses, "
+          f"{results_cache.bytes_read/1e6:.1f} MB read, {results_cache.bytes_written/1e6:.1f} MB written.")
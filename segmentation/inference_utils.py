@@ -0,0 +1,541 @@
+"""Utilities for running trained algorithms on many images without holding all of them in memory:
+
+-   list_images : List the input images, split into indoor/outdoor if possible
+-   Prefetcher : Iterator decoding images in a background thread
+-   ResultWriter : ContextManager writing results in a background thread
+-   test_pipeline, bucket_batches, batch_inference : Batched inference with little padding
+-   pipeline_key, TensorCache : Share preprocessed images between models with the same test pipeline
+-   ResultCache : Segmentation maps by model, image content and inference options, for reruns
+-   tiled_logits, tiled_inference, probe_tile_batch_size : Inference on large images in overlapping tiles
+-   revert_sync_batchnorm : Make models with SyncBN runnable on the CPU
+"""
+import hashlib
+import json
+import math
+import os
+import queue
+import resource
+import threading
+from typing import Callable, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmcv.parallel import collate, scatter
+from mmseg.apis.inference import LoadImage
+from mmseg.datasets.pipelines import Compose
+
+image_extensions = (".jpg",".jpeg",".png")
+
+
+def list_images(images_dir : str, in_folders : List[str] = ["indoor","outdoor"]):
+    """List all images in the images dir, sorted by name. If all in_folders exist in images_dir,
+    the images are taken from these subfolders.
+
+    Args:
+        images_dir (str): Folder containing the images
+        in_folders (List[str], optional): Names of the subfolders. Defaults to ["indoor","outdoor"].
+
+    Returns:
+        Dict[str,List[str]]: Image paths by subfolder, or by None if the images are not split.
+    """
+    if all(os.path.exists(os.path.join(images_dir,folder)) for folder in in_folders):
+        folders = {folder: os.path.join(images_dir,folder) for folder in in_folders}
+    else:
+        print("Indoor/Outdoor folder missing, use all images from ",images_dir)
+        folders = {None: images_dir}
+    return {folder: [os.path.join(path,name) for name in sorted(os.listdir(path))
+                     if name.lower().endswith(image_extensions)]
+            for folder, path in folders.items()}
+
+
+_end = object()
+
+class Prefetcher(object):
+    """Iterator over (item, load(item)) for the given items, where load is done in a background
+    thread ahead of the consumer. At most queue_size loaded items are held in memory. Nothing is
+    loaded beyond the items, so limit them to stop loading early."""
+
+    def __init__(self, items : list, load : Callable, queue_size : int = 8):
+        """Construct and start the background thread.
+
+        Args:
+            items (list): Items to load, e.g. image paths
+            load (Callable): Function loading an item
+            queue_size (int, optional): Maximum number of loaded items waiting. Defaults to 8.
+        """
+        self.items = items
+        self.load = load
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for item in self.items:
+                if self.stopped.is_set(): return
+                self._put((item, self.load(item)))
+        except BaseException as e:
+            self._put(e)
+            return
+        self._put(_end)
+
+    def _put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _end: return
+            if isinstance(entry, BaseException): raise entry
+            yield entry
+
+    def close(self):
+        """Stop loading, if the consumer does not need the remaining items."""
+        self.stopped.set()
+        self.thread.join()
+
+
+class ResultWriter(object):
+    """ContextManager calling write(*args) for every put(*args) in a background thread, such that
+    results can be stored while the next ones are computed. put blocks if queue_size results are
+    waiting. Exceptions of write are raised in the next put or when exiting."""
+
+    def __init__(self, write : Callable, queue_size : int = 8):
+        """Construct
+
+        Args:
+            write (Callable): Function storing a result
+            queue_size (int, optional): Maximum number of results waiting. Defaults to 8.
+        """
+        self.write = write
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.count = 0
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is _end: return
+            if self.error is not None: continue
+            try:
+                self.write(*args)
+                self.count += 1
+            except BaseException as e:
+                self.error = e
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def put(self, *args):
+        """Queue a result for writing."""
+        if self.error is not None: raise self.error
+        self.queue.put(args)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queue.put(_end)
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+
+def revert_sync_batchnorm(module):
+    """Replace all SyncBatchNorm layers by BatchNorm2d layers with the same parameters, because
+    SyncBatchNorm can only run on GPUs. Uses the mmcv implementation if available.
+
+    Args:
+        module (torch.nn.Module): Model
+
+    Returns:
+        torch.nn.Module: Model without SyncBatchNorm
+    """
+    try:
+        from mmcv.cnn.utils import revert_sync_batchnorm as mmcv_revert
+        return mmcv_revert(module)
+    except ImportError:
+        pass
+    result = module
+    if isinstance(module, torch.nn.modules.batchnorm.SyncBatchNorm):
+        result = torch.nn.BatchNorm2d(module.num_features, module.eps, module.momentum,
+            module.affine, module.track_running_stats)
+        if module.affine:
+            with torch.no_grad():
+                result.weight = module.weight
+                result.bias = module.bias
+        result.running_mean = module.running_mean
+        result.running_var = module.running_var
+        result.num_batches_tracked = module.num_batches_tracked
+        result.training = module.training
+    for name, child in module.named_children():
+        result.add_module(name, revert_sync_batchnorm(child))
+    return result
+
+
+def test_pipeline(model):
+    """The test pipeline of the model's config, loading images from arrays, as used by
+    mmseg.apis.inference_segmentor."""
+    return Compose([LoadImage()] + model.cfg.data.test.pipeline[1:])
+
+
+def pipeline_key(model):
+    """Key of the model's test pipeline (see test_pipeline). Models with equal keys preprocess
+    images identically, so the preprocessed images can be shared between them."""
+    return json.dumps(model.cfg.data.test.pipeline[1:], sort_keys=True, default=str)
+
+
+class TensorCache(object):
+    """Preprocessed images on disk, so that later runs with the same test pipeline skip decoding and
+    preprocessing. Entries are keyed by the pipeline key, the image path, its size and modification
+    time, so changed images are preprocessed again."""
+
+    def __init__(self, cache_dir : str, key : str):
+        """Construct
+
+        Args:
+            cache_dir (str): Folder to store the preprocessed images in
+            key (str): Pipeline key, see pipeline_key
+        """
+        self.cache_dir = cache_dir
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, img_path : str):
+        stat = os.stat(img_path)
+        key = repr((self.key, os.path.abspath(img_path), stat.st_size, stat.st_mtime_ns))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+    def load(self, img_path : str, preprocess : Callable):
+        """Load the preprocessed image from the cache, or preprocess and store it.
+
+        Args:
+            img_path (str): Path of the image
+            preprocess (Callable): Function returning the entry to cache for an image path
+
+        Returns:
+            Entry returned by preprocess
+        """
+        path = self._path(img_path)
+        try:
+            entry = torch.load(path)
+            self.hits += 1
+            return entry
+        except FileNotFoundError:
+            pass
+        except (EOFError, RuntimeError) as e:
+            # Truncated entry, e.g. from a full disk. Other errors (e.g. of a changed torch version)
+            # are raised, so the cache does not silently stop working.
+            print(f"Broken cache entry {path} for {img_path} is replaced: {e}")
+            os.remove(path)
+        entry = preprocess(img_path)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        torch.save(entry, tmp_path)
+        os.replace(tmp_path, path)
+        self.misses += 1
+        return entry
+
+
+class ResultCache(object):
+    """Segmentation maps on disk, content-addressed by the model (checkpoint and config), the
+    inference options and the image content, so that reruns only compute missing results. Counts
+    hits, misses and the bytes read and written."""
+
+    def __init__(self, cache_dir : str):
+        """Construct
+
+        Args:
+            cache_dir (str): Folder to store the results in
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path : str):
+        """SHA1 hex digest of the file's content, read in chunks."""
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def model_key(model, checkpoint_file : str, options : dict):
+        """Key of a model and the inference options which influence its results.
+
+        Args:
+            model (torch.nn.Module): Segmentation model, whose config is hashed
+            checkpoint_file (str): Path of the checkpoint
+            options (dict): Inference options, e.g. the tile size
+
+        Returns:
+            str: Key, see key
+        """
+        return hashlib.sha1(repr((ResultCache.file_hash(checkpoint_file), model.cfg.pretty_text,
+            sorted(options.items()))).encode()).hexdigest()
+
+    @staticmethod
+    def key(model_key : str, img_bytes : bytes):
+        """Key of the result of a model (see model_key) on an image (its encoded file content)."""
+        return hashlib.sha1(model_key.encode() + hashlib.sha1(img_bytes).digest()).hexdigest()
+
+    def _path(self, key : str):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, key : str):
+        """The cached segmentation map (np.array) for the key, or None."""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                seg = f['seg']
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_read += os.path.getsize(path)
+        return seg
+
+    def put(self, key : str, seg):
+        """Store a segmentation map (np.array) for the key."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, seg=seg.astype(np.uint8) if seg.max(initial=0) < 256 else seg)
+        self.bytes_written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+
+def bucket_batches(entries, batch_size : int, key : Callable, max_pending : int = None):
+    """Group a stream of entries into batches of entries with the same key, e.g. similar size, in 
+    order to minimize padding. A batch is yielded as soon as it is full. If more than max_pending
+    entries are waiting, the biggest bucket is yielded early, which bounds the memory use.
+
+    Args:
+        entries (iterable): Entries to group
+        batch_size (int): Maximum number of entries per batch
+        key (Callable): Bucket key of an entry
+        max_pending (int, optional): Maximum number of waiting entries. Defaults to 4*batch_size.
+
+    Yields:
+        list: Entries of one batch
+    """
+    if max_pending is None: max_pending = 4 * batch_size
+    buckets = {}
+    pending = 0
+    for entry in entries:
+        bucket = buckets.setdefault(key(entry), [])
+        bucket.append(entry)
+        pending += 1
+        if len(bucket) >= batch_size or pending > max_pending:
+            biggest = max(buckets, key=lambda k: len(buckets[k])) if len(bucket) < batch_size else key(entry)
+            batch = buckets.pop(biggest)
+            pending -= len(batch)
+            yield batch
+    for batch in buckets.values():
+        yield batch
+
+
+def size_key(data):
+    """Bucket key of preprocessed data (see test_pipeline) by its exact size, so that the batches of
+    batch_inference need no padding."""
+    return tuple(data['img'][0].shape[-2:])
+
+
+def batch_inference(model, datas : list, device : str):
+    """Run the model on a batch of images preprocessed by test_pipeline. Images of different sizes
+    are padded to the same size, which changes the results of decode heads with global pooling 
+    (e.g. the PPM of UperNet), so batch images of the same size (see size_key) for results equal to
+    mmseg.apis.inference_segmentor. Only the 'whole' test mode with a single scale and without 
+    flipping is batched, other test modes and test time augmentations are run one by one.
+
+    Args:
+        model (torch.nn.Module): Segmentation model
+        datas (list): Preprocessed images
+        device (str): Device of the model
+
+    Returns:
+        list: Segmentation map of each image (np.array of its original size)
+    """
+    if model.test_cfg.get('mode', 'whole') != 'whole' or any(
+            len(data['img']) > 1 or any(meta.data.get('flip', False) for meta in data['img_metas'])
+            for data in datas):
+        results = []
+        for data in datas:
+            data = collate([data], samples_per_gpu=1)
+            if device != 'cpu':
+                data = scatter(data, [device])[0]
+            else:
+                data['img_metas'] = [i.data[0] for i in data['img_metas']]
+            results.append(model(return_loss=False, rescale=True, **data)[0])
+        return results
+    imgs = [data['img'][0] for data in datas]
+    metas = [data['img_metas'][0].data for data in datas]
+    h = max(img.shape[-2] for img in imgs)
+    w = max(img.shape[-1] for img in imgs)
+    batch = torch.stack([F.pad(img, (0, w - img.shape[-1], 0, h - img.shape[-2])) for img in imgs]).to(device)
+    seg_logits = model.encode_decode(batch, metas)
+    results = []
+    for seg_logit, meta in zip(seg_logits, metas):
+        # Remove the padding, then scale to the original size
+        img_h, img_w = meta['img_shape'][:2]
+        seg_logit = seg_logit[None, :, :img_h, :img_w]
+        seg_logit = F.interpolate(seg_logit, size=meta['ori_shape'][:2], mode='bilinear', 
+            align_corners=model.align_corners)
+        results.append(seg_logit.argmax(dim=1)[0].cpu().numpy())
+    return results
+
+
+def rescaled_argmax(seg_logit, size : tuple, align_corners : bool, stripe : int = 256):
+    """Bilinear scaling of the logits to the given size followed by argmax over the classes, as in
+    batch_inference, but done in stripes of rows, so the scaled logits are never held completely.
+
+    Args:
+        seg_logit (torch.Tensor): Logits (C,H,W)
+        size (tuple): Output size (h,w)
+        align_corners (bool): align_corners of the bilinear scaling
+        stripe (int, optional): Number of output rows per stripe. Defaults to 256.
+
+    Returns:
+        np.array: Segmentation map of the given size
+    """
+    out_h, out_w = size
+    def coords(n):
+        # Normalized sample positions, such that grid_sample equals F.interpolate
+        if align_corners:
+            return torch.linspace(-1, 1, n, device=seg_logit.device) if n > 1 else torch.zeros(1, device=seg_logit.device)
+        return (torch.arange(n, device=seg_logit.device, dtype=torch.float32) * 2 + 1) / n - 1
+    xs = coords(out_w)
+    ys = coords(out_h)
+    result = []
+    for y in range(0, out_h, stripe):
+        grid_y, grid_x = torch.meshgrid(ys[y:y+stripe], xs)
+        grid = torch.stack([grid_x, grid_y], dim=-1)[None].to(seg_logit.dtype)
+        scaled = F.grid_sample(seg_logit[None], grid, mode='bilinear', padding_mode='border', 
+            align_corners=align_corners)
+        result.append(scaled.argmax(dim=1)[0].cpu().numpy())
+    return np.concatenate(result, axis=0)
+
+
+def tile_starts(size : int, tile : int, overlap : int):
+    """Start positions of tiles, spread evenly over size, such that neighbouring tiles overlap by
+    at least overlap pixels."""
+    if size <= tile: return [0]
+    n = math.ceil((size - overlap) / (tile - overlap))
+    return [round(i * (size - tile) / (n - 1)) for i in range(n)]
+
+
+def tile_weights(h : int, w : int, overlap : int):
+    """Blending weights of a tile, rising linearly over overlap+1 pixels at each edge. Weights never
+    reach zero, so the image borders, which are covered by only one tile, are not lost."""
+    def ramp(n):
+        i = torch.arange(n, dtype=torch.float32)
+        return torch.minimum(torch.minimum(i + 1, n - i), torch.tensor(overlap + 1.0)) / (overlap + 1)
+    return ramp(h)[:, None] * ramp(w)[None, :]
+
+
+def tiled_logits(model, data, device : str, tile_size : int, overlap : int, tile_batch_size : int):
+    """Run the model on overlapping tiles of an image preprocessed by test_pipeline, tile_batch_size
+    tiles at once. The logits of overlapping tiles are blended with tile_weights, normalized by the
+    sum of the weights at each pixel.
+
+    Args:
+        model (torch.nn.Module): Segmentation model
+        data (dict): Preprocessed image
+        device (str): Device of the model
+        tile_size (int): Edge length of the square tiles (in the preprocessed image)
+        overlap (int): Minimum overlap of neighbouring tiles
+        tile_batch_size (int): Number of tiles to process at once
+
+    Returns:
+        torch.Tensor: Logits (C,H,W) of the preprocessed image without padding (img_shape)
+    """
+    meta = data['img_metas'][0].data
+    img_h, img_w = meta['img_shape'][:2]
+    img = data['img'][0][:, :img_h, :img_w]
+    th, tw = min(tile_size, img_h), min(tile_size, img_w)
+    weights = tile_weights(th, tw, overlap).to(device)
+    tiles = [(y, x) for y in tile_starts(img_h, th, overlap) for x in tile_starts(img_w, tw, overlap)]
+    logit_sum = None
+    weight_sum = torch.zeros((img_h, img_w), device=device)
+    for i in range(0, len(tiles), tile_batch_size):
+        positions = tiles[i:i+tile_batch_size]
+        batch = torch.stack([img[:, y:y+th, x:x+tw] for y, x in positions]).to(device)
+        seg_logits = model.encode_decode(batch, [meta] * len(positions)) * weights
+        if logit_sum is None:
+            logit_sum = torch.zeros((seg_logits.shape[1], img_h, img_w), device=device)
+        for (y, x), seg_logit in zip(positions, seg_logits):
+            logit_sum[:, y:y+th, x:x+tw] += seg_logit
+            weight_sum[y:y+th, x:x+tw] += weights
+    return logit_sum / weight_sum
+
+
+def tiled_inference(model, data, device : str, tile_size : int, overlap : int, tile_batch_size : int):
+    """Segmentation map from tiled_logits, scaled to the original image size with rescaled_argmax.
+    Apart from the tiling equivalent to batch_inference of the single image. Flip augmentation is 
+    not applied.
+
+    Returns:
+        np.array: Segmentation map of the original image size
+    """
+    seg_logit = tiled_logits(model, data, device, tile_size, overlap, tile_batch_size)
+    meta = data['img_metas'][0].data
+    return rescaled_argmax(seg_logit, meta['ori_shape'][:2], model.align_corners)
+
+
+def _memory(device : str):
+    """Current and peak memory use in bytes: allocated memory of a CUDA device, or the resident 
+    memory of this process for the CPU."""
+    if device.startswith('cuda'):
+        return torch.cuda.memory_allocated(device), torch.cuda.max_memory_allocated(device)
+    with open("/proc/self/statm") as f:
+        current = int(f.read().split()[1]) * resource.getpagesize()
+    # ru_maxrss is in KB on Linux
+    return current, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def probe_tile_batch_size(model, data, device : str, tile_size : int, max_memory : int):
+    """Estimate the largest number of tiles which can be processed at once within max_memory, by 
+    running batches of one and two tiles and measuring the growth of the peak memory use. On the
+    CPU, the peak is that of the whole process, so an earlier higher peak (e.g. from loading the 
+    model) can hide the first probe, and the growth between the probes only shows the part of the
+    second one above it. The memory per tile is therefore taken as at least the growth of the peak
+    over the memory use before the probes, which is never less than the real memory per tile, so
+    the estimate errs on the safe side.
+
+    Args:
+        model (torch.nn.Module): Segmentation model
+        data (dict): Preprocessed image, for the image metadata
+        device (str): Device of the model
+        tile_size (int): Edge length of the square tiles
+        max_memory (int): Memory budget in bytes, see _memory
+
+    Returns:
+        int: Tile batch size (at least 1)
+    """
+    meta = data['img_metas'][0].data
+    channels = data['img'][0].shape[0]
+    peaks = []
+    base, _ = _memory(device)
+    for n in (1, 2):
+        if device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats(device)
+        model.encode_decode(torch.zeros((n, channels, tile_size, tile_size), device=device), [meta] * n)
+        peaks.append(_memory(device)[1])
+    per_tile = max(peaks[1] - peaks[0], peaks[0] - base)
+    return max(1, 1 + int((max_memory - peaks[0]) // max(per_tile, 1)))
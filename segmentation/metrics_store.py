@@ -0,0 +1,238 @@
+"""Store of all MMSegmentation training logs in one SQLite database, which training_plot.py,
+class_progression.py and class_highscores.py query instead of parsing the logs on every run.
+
+The table 'logs' holds one row per log file (path, nice_config_title, info record and the byte offset
+up to which it has been ingested), the tables 'train' and 'val' one row per train/val step with one
+column per logged value (e.g. loss, mIoU, IoU.<CLASSNAME>). Columns are added when new values
+appear in a log. As SQLite column names are case-insensitive, the table 'columns' maps each logged
+key to its column, which gets a numbered suffix if another key differs only in case. Ingestion is
+incremental: only the bytes appended to a log since its last ingestion are parsed (see TrainingLog).
+
+Run as a script to ingest all logs of the --log-dir."""
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+import time
+from typing import List
+
+import numpy as np
+
+from utils import *
+
+
+class MetricsStore(object):
+    """SQLite store of training logs. Logs are identified by their real path."""
+
+    def __init__(self, db_path : str = conf.segmentation_metrics_db):
+        """Open (or create) the store.
+
+        Args:
+            db_path (str, optional): Path of the database file. Defaults to the configured path.
+        """
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS logs (path TEXT PRIMARY KEY, title TEXT, info TEXT, "
+                            "offset INTEGER, last_train_iter INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS columns (tbl TEXT, key TEXT, col TEXT, PRIMARY KEY (tbl, key))")
+            for table in ("train","val"):
+                self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (log TEXT, step INTEGER)")
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_log_step ON {table} (log, step)")
+        # Column of each logged key and key of each column, per table
+        self.columns = {table: {} for table in ("train","val")}
+        self.keys = {table: {} for table in ("train","val")}
+        with self.db:
+            for table in ("train","val"):
+                self._refresh(table)
+                # Columns of stores created before the table 'columns' existed are named like their keys
+                for row in self.db.execute(f"PRAGMA table_info({table})").fetchall():
+                    if row[1] not in ("log","step") and row[1] not in self.keys[table]:
+                        self._add_key(table, row[1], row[1])
+
+    @staticmethod
+    def _quote(name : str):
+        return '"' + name.replace('"','""') + '"'
+
+    @staticmethod
+    def _fold(name : str):
+        """Column name as compared by SQLite, which ignores the case of ASCII letters only."""
+        return name.encode().lower()
+
+    def _refresh(self, table : str):
+        """Re-read the column of each key of a table, as other processes may have added columns."""
+        for key, col in self.db.execute("SELECT key, col FROM columns WHERE tbl=?", (table,)):
+            self.columns[table][key] = col
+            self.keys[table][col] = key
+
+    def _add_key(self, table : str, key : str, col : str):
+        self.db.execute("INSERT OR IGNORE INTO columns VALUES (?, ?, ?)", (table, key, col))
+        self.columns[table][key] = col
+        self.keys[table][col] = key
+
+    def _column(self, table : str, key : str):
+        """Column of a logged key, which is added to the table if the key is new."""
+        if key not in self.columns[table]:
+            self._refresh(table)
+        if key in self.columns[table]:
+            return self.columns[table][key]
+        taken = {self._fold(row[1]) for row in self.db.execute(f"PRAGMA table_info({table})")}
+        col = key
+        i = 1
+        while self._fold(col) in taken:
+            col = f"{key}#{i}"
+            i += 1
+        try:
+            self.db.execute(f"ALTER TABLE {table} ADD COLUMN {self._quote(col)}")
+        except sqlite3.OperationalError:
+            # Another process added the column since the refresh
+            self._refresh(table)
+            if key in self.columns[table]:
+                return self.columns[table][key]
+            raise
+        self._add_key(table, key, col)
+        return col
+
+    def _insert(self, table : str, path : str, records : List[dict]):
+        if len(records) == 0: return
+        names = sorted({k for record in records for k in record})
+        cols = [self._column(table, name) for name in names]
+        first_step = self.db.execute(f"SELECT COUNT(*) FROM {table} WHERE log=?", (path,)).fetchone()[0]
+        def value(v):
+            return v if v is None or isinstance(v,(int,float,str)) else json.dumps(v)
+        self.db.executemany(
+            f"INSERT INTO {table} (log, step, {', '.join(self._quote(c) for c in cols)}) "
+            f"VALUES (?, ?, {', '.join('?' for _ in cols)})",
+            [[path, first_step + i] + [value(record.get(n)) for n in names] for i, record in enumerate(records)])
+
+    def ingest(self, path : str):
+        """Add the records appended to the log since its last ingestion. If the log was replaced by
+        a shorter file, its steps are dropped and it is ingested again.
+
+        Args:
+            path (str): Path of the log json file
+
+        Returns:
+            int: Number of new train steps
+            int: Number of new val steps
+        """
+        path = os.path.realpath(path)
+        entry = self.log(path)
+        if entry is None:
+            log = TrainingLog(path)
+        else:
+            log = TrainingLog(path, entry['offset'], entry['info'], entry['last_train_iter'])
+        with self.db:
+            if log.replaced:
+                for table in ("train","val"):
+                    self.db.execute(f"DELETE FROM {table} WHERE log=?", (path,))
+            self._insert("train", path, log.train_steps)
+            self._insert("val", path, log.val_steps)
+            self.db.execute("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)", (path,
+                nice_config_title(log.info) if log.info is not None else None, json.dumps(log.info),
+                log.reader.offset, log.last_train_iter))
+        return len(log.train_steps), len(log.val_steps)
+
+    def ingest_dir(self, log_dir : str):
+        """Ingest all .json logs of a folder, sorted by name.
+
+        Returns:
+            List[str]: Paths of the logs
+        """
+        paths = [os.path.join(log_dir,f) for f in sorted(os.listdir(log_dir)) if f.lower().endswith(".json")]
+        for path in paths:
+            self.ingest(path)
+        return paths
+
+    def log(self, path : str):
+        """Entry of a log in the store.
+
+        Returns:
+            dict: path, title, info (dict), offset and last_train_iter, or None if not ingested
+        """
+        row = self.db.execute("SELECT path, title, info, offset, last_train_iter FROM logs WHERE path=?",
+            (os.path.realpath(path),)).fetchone()
+        if row is None: return None
+        return dict(path=row[0], title=row[1], info=json.loads(row[2]), offset=row[3], last_train_iter=row[4])
+
+    def steps(self, table : str, path : str, first_step : int = 0, last_only : bool = False):
+        """Train or val steps of a log as dicts, with the keys of the log records. Values which are
+        missing in some steps are NaN, values which are missing in all steps are left out.
+
+        Args:
+            table (str): 'train' or 'val'
+            path (str): Path of the log
+            first_step (int, optional): Index of the first step to return. Defaults to 0.
+            last_only (bool, optional): Whether to return only the last step. Defaults to False.
+
+        Returns:
+            List[dict]: Steps in the order of the log
+        """
+        query = f"SELECT * FROM {table} WHERE log=? AND step>=? ORDER BY step"
+        if last_only: query += " DESC LIMIT 1"
+        cursor = self.db.execute(query, (os.path.realpath(path), first_step))
+        if any(d[0] not in self.keys[table] for d in cursor.description[2:]):
+            self._refresh(table)
+        names = [self.keys[table].get(d[0], d[0]) for d in cursor.description]
+        rows = cursor.fetchall()
+        present = [i for i, d in enumerate(cursor.description)
+                   if d[0] not in ("log","step") and any(row[i] is not None for row in rows)]
+        return [{names[i]: (math.nan if row[i] is None else row[i]) for i in present} for row in rows]
+
+    def step_count(self, table : str, path : str):
+        """Number of train or val steps of a log. Drops when the log was replaced by a shorter one."""
+        return self.db.execute(f"SELECT COUNT(*) FROM {table} WHERE log=?", (os.path.realpath(path),)).fetchone()[0]
+
+    def train_steps(self, path : str, first_step : int = 0):
+        """Train steps of a log, see steps."""
+        return self.steps("train", path, first_step)
+
+    def val_steps(self, path : str, first_step : int = 0):
+        """Val steps of a log (with 'last_train_iter'), see steps."""
+        return self.steps("val", path, first_step)
+
+    def last_val_step(self, path : str):
+        """Last val step of a log, or None."""
+        steps = self.steps("val", path, last_only=True)
+        return steps[0] if len(steps) > 0 else None
+
+    def series(self, table : str, path : str, names : List[str]):
+        """Columns of the train or val steps of a log as arrays.
+
+        Args:
+            table (str): 'train' or 'val'
+            path (str): Path of the log
+            names (List[str]): Names of the columns, e.g. ['last_train_iter','mIoU']
+
+        Returns:
+            Dict[str,np.array]: float array per column, NaN where missing. Unknown columns and
+                columns with non-numeric values (e.g. mode) are left out.
+        """
+        if any(n not in self.columns[table] for n in names):
+            self._refresh(table)
+        names = [n for n in names if n in self.columns[table]]
+        if len(names) == 0: return {}
+        rows = self.db.execute(f"SELECT {', '.join(self._quote(self.columns[table][n]) for n in names)} "
+                               f"FROM {table} WHERE log=? ORDER BY step", (os.path.realpath(path),)).fetchall()
+        columns = list(zip(*rows)) if len(rows) > 0 else [() for _ in names]
+        return {n: np.array([math.nan if v is None else v for v in column], dtype=np.float64)
+                for n, column in zip(names, columns)
+                if all(v is None or isinstance(v,(int,float)) for v in column)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log-dir', type=path_arg, default=conf.segmentation_logs_path, help='the folder containing the training logs. (default from configuration)')
+    parser.add_argument('--db', type=path_arg, default=conf.segmentation_metrics_db, help='the database file. (default from configuration)')
+    args = parser.parse_args()
+
+    store = MetricsStore(args.db)
+    start_time = time.time()
+    for path in sorted(os.listdir(args.log_dir)):
+        if not path.lower().endswith(".json"): continue
+        new_train, new_val = store.ingest(os.path.join(args.log_dir,path))
+        log = store.log(os.path.join(args.log_dir,path))
+        print(f"{str(log['title']):40} +{new_train:6} train steps, +{new_val:4} val steps ({log['offset']/1e6:.1f} MB ingested in total)")
+    print(f"Done in {time.time()-start_time:.1f}s.")
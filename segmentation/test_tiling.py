@@ -0,0 +1,105 @@
+"""Checks of the tiled inference (inference_utils.tiled_logits, tiled_inference) against whole-image
+inference, with small mock models on random images."""
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("mmseg")
+from mmcv.parallel import DataContainer
+
+
+@pytest.fixture
+def inference_utils(load):
+    return load("inference_utils")
+
+
+class MockModel(torch.nn.Module):
+    """Segmentation model with a single convolution as encode_decode. With kernel 1, the logits of
+    each pixel only depend on the pixel itself, so tiling must not change them at all."""
+
+    def __init__(self, kernel : int = 1, channels : int = 3, classes : int = 6):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(channels, classes, kernel, padding=kernel // 2)
+        self.test_cfg = dict(mode='whole')
+        self.align_corners = False
+
+    def encode_decode(self, img, img_metas):
+        return self.conv(img)
+
+
+def random_data(rng, img_h : int, img_w : int, pad : int = 0, scale : float = 1.0):
+    """Preprocessed image as from test_pipeline, padded by pad pixels, of an original image scaled
+    by scale."""
+    img = torch.from_numpy(rng.random((3, img_h + pad, img_w + pad), dtype=np.float32))
+    meta = dict(img_shape=(img_h, img_w, 3), ori_shape=(round(img_h * scale), round(img_w * scale), 3), flip=False)
+    return dict(img=[img], img_metas=[DataContainer(meta, cpu_only=True)])
+
+
+@pytest.mark.parametrize("size,tile,overlap", [(100, 100, 8), (90, 100, 8), (101, 32, 8), (513, 128, 32), (64, 16, 15)])
+def test_tile_starts_cover_with_overlap(inference_utils, size, tile, overlap):
+    starts = inference_utils.tile_starts(size, tile, overlap)
+    if size <= tile:
+        assert starts == [0]
+        return
+    assert starts[0] == 0 and starts[-1] == size - tile
+    assert all(a + tile - b >= overlap for a, b in zip(starts, starts[1:]))
+
+
+def test_tile_weights(inference_utils):
+    overlap = 4
+    weights = inference_utils.tile_weights(20, 12, overlap)
+    assert weights.shape == (20, 12)
+    assert torch.all(weights > 0) and torch.all(weights <= 1)
+    assert torch.allclose(weights, weights.flip(0)) and torch.allclose(weights, weights.flip(1))
+    assert weights[0, 0] == pytest.approx(1 / (overlap + 1) ** 2)
+    assert weights[overlap, overlap] == 1
+    assert torch.all(weights[overlap:-overlap, overlap:-overlap] == 1)
+
+
+@pytest.mark.parametrize("img_h,img_w,tile,overlap,pad", [(64, 64, 32, 8, 0), (75, 130, 32, 8, 5), (40, 200, 64, 16, 3), (20, 30, 64, 8, 0)])
+def test_tiled_logits_equal_whole_logits(inference_utils, img_h, img_w, tile, overlap, pad):
+    """Pointwise model: the blended logits equal the whole-image logits everywhere, including the
+    edge tiles, which only holds if the weights are normalized correctly."""
+    rng = np.random.default_rng(0)
+    model = MockModel()
+    data = random_data(rng, img_h, img_w, pad)
+    with torch.no_grad():
+        whole = model.encode_decode(data['img'][0][None, :, :img_h, :img_w], None)[0]
+        tiled = inference_utils.tiled_logits(model, data, 'cpu', tile, overlap, tile_batch_size=3)
+    assert tiled.shape == whole.shape
+    assert torch.allclose(tiled, whole, atol=1e-5)
+
+
+def test_tiled_logits_within_tolerance_at_seams(inference_utils):
+    """3x3 convolution: tiles miss the neighbours outside of them, which only changes the logits
+    in the overlaps, where the blending weight of the tile edge is small."""
+    rng = np.random.default_rng(1)
+    model = MockModel(kernel=3)
+    overlap = 8
+    data = random_data(rng, 100, 140)
+    with torch.no_grad():
+        whole = model.encode_decode(data['img'][0][None], None)[0]
+        tiled = inference_utils.tiled_logits(model, data, 'cpu', 48, overlap, tile_batch_size=4)
+        # Largest change of the logits by the missing neighbours of a tile edge
+        max_error = model.conv.weight.abs().sum(dim=(1, 2, 3)).max()
+    diff = (tiled - whole).abs()
+    seams = torch.zeros(100, 140, dtype=torch.bool)
+    for y in inference_utils.tile_starts(100, 48, overlap):
+        seams[max(y - 1, 0):y + 1] = seams[y + 47:y + 49] = True
+    for x in inference_utils.tile_starts(140, 48, overlap):
+        seams[:, max(x - 1, 0):x + 1] = seams[:, x + 47:x + 49] = True
+    assert torch.all(diff[:, ~seams] < 1e-5)
+    assert diff.max() > 0
+    assert diff.max() <= 2 * max_error / (overlap + 1)
+
+
+@pytest.mark.parametrize("scale", [1.0, 2.5, 0.5])
+def test_tiled_inference_matches_batch_inference(inference_utils, scale):
+    rng = np.random.default_rng(2)
+    model = MockModel()
+    data = random_data(rng, 60, 90, pad=4, scale=scale)
+    with torch.no_grad():
+        whole = inference_utils.batch_inference(model, [data], 'cpu')[0]
+        tiled = inference_utils.tiled_inference(model, data, 'cpu', 32, 8, tile_batch_size=2)
+    assert tiled.shape == whole.shape == data['img_metas'][0].data['ori_shape'][:2]
+    assert np.mean(tiled == whole) >= 0.999
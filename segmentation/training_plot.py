@@ -1,14 +1,20 @@
 """Creates a two-part plot showing statistics for one or multiple training logs. The left plot shows
 a global statistic (mIoU, aAcc or mAcc) over time and the right plot shows a class statistic (IoU or Acc)
 for each class. If --mode joint is set, all training logs are shown in the same plot, with different
-colors."""
+colors. Lines with more than --max-points points are downsampled. The logs are read through the metrics store (see metrics_store.py), which only parses what
+was appended to them since the last run.
+
+With --follow, the logs are tailed while training is running: every --interval seconds the appended
+records are parsed and the existing plot lines are updated in place. With --headless, no window is
+shown and the svg is rewritten on each update instead."""
 import numpy as np
 import matplotlib.pyplot as plt
 import os 
-import json
 import sys 
 import argparse
+import time
 
+from metrics_store import MetricsStore
 from utils import *
 
 """
@@ -39,12 +45,13 @@ Log File structure:
 
 
 parser = argparse.ArgumentParser(description=__doc__)
-parser.set_defaults(save_plots=True,epochs=False)
+parser.set_defaults(save_plots=True,epochs=False,follow=False,headless=False)
 parser.add_argument('logfiles', type=path_arg, nargs='*', default=None,  help='the training log json to visualize.')
 parser.add_argument('--log-dir', type=path_arg, default=conf.segmentation_logs_path, help='the folder to look for logfiles in when interactive. (default from configuration)')
+parser.add_argument('--db', type=path_arg, default=conf.segmentation_metrics_db, help='the metrics store database file. (default from configuration)')
 parser.add_argument('--plots-dir', type=path_arg, default=conf.segmentation_plots_path, help='the folder to store generated plots into. Will be created if not existent. No files are overwritten. (default from configuration)')
-parser.add_argument('--no-save-plots', dest="save_plots", action="save_false",  help='dont save plots as svg into a folder.')
-parser.add_argument('--epochs', dest="epochs", action="save_true",  help='use epochs instead of iterations as time value.')
+parser.add_argument('--no-save-plots', dest="save_plots", action="store_false",  help='dont save plots as svg into a folder.')
+parser.add_argument('--epochs', dest="epochs", action="store_true",  help='use epochs instead of iterations as time value.')
 parser.add_argument('--mode', default='joint', choices=['joint','separate'], help='whether to display multiple training logs in one joint plot or in separate plots. (default: joint)')
 parser.add_argument('--class-property', default="IoU", choices=['IoU','Acc'],  help='the property displayed in the class-wise plot. (default: IoU)')
 parser.add_argument('--global-property', default="mIoU", choices=['mIoU','aAcc','mAcc','lr'],  help='the property displayed over time in the total plot. (default: mIoU)')
@@ -52,8 +59,15 @@ parser.add_argument('--second-global-property', default=None, choices=['mIoU','a
 parser.add_argument('--colors',type=str,default=["red","blue","green","orange","purple","pink"],nargs='+', help='colors to assign to the training logs in that order.')
 parser.add_argument('--names',type=str,nargs='+',default=[], help='names to assign to the training logs in that order. (defaults to the main part of the filename or the name specified in the log)')
 parser.add_argument('--time-range',choices=['min','max','ask'],default='ask', help="how to behave in case of different time spans of the training logs. 'min' crops all logs by the shortest length, 'max' displays all logs completely and 'ask' asks interactively. (default: ask)")
+parser.add_argument('--max-points', type=int, default=500, help='the maximum number of points drawn per line. Longer lines are downsampled preserving their shape (LTTB). 0 draws all points. (default: 500)')
+parser.add_argument('--follow', dest="follow", action="store_true",  help='keep updating the plot with the records appended to the logs while training is running.')
+parser.add_argument('--interval', type=float, default=30, help='the number of seconds between updates with --follow. (default: 30)')
+parser.add_argument('--headless', dest="headless", action="store_true",  help='do not show a window, only save the plot (with --follow: rewrite the svg on each update).')
 args = parser.parse_args()
 
+if args.headless:
+    plt.switch_backend("Agg")
+
 classnames = [cl.name for cl in conf.classes]
 
 
@@ -90,38 +104,28 @@ max_length = []
 min_acc = 1.0
 max_acc = 0.0
 print("Process ...")
+store = MetricsStore(args.db)
 for log_path in paths:
-    these_train_steps = []
-    these_val_steps = []
-    last_train_iter = 0
-    with open(log_path) as f:
-        jsons = multi_root_json_parse(f.read())
-        
-    infos.append(jsons[0])
-    skipped = 0
-    for line_json in jsons[1:]:
-        if not 'mode' in line_json.keys():
-            #print("Skip")
-            skipped += 1
-            continue
-        if line_json['mode'] == "train":
-            these_train_steps.append(line_json)
-            last_train_iter = line_json['iter']
-        else:
-            line_json['last_train_iter'] = last_train_iter
-            these_val_steps.append(line_json)
-            min_acc = min(min_acc,line_json['aAcc'])
-            max_acc = max(max_acc,line_json['aAcc'])
-    print(f" -> {log_path}: {len(these_train_steps)} train steps, {len(these_val_steps)} val steps {skipped} skipped lines")
+    store.ingest(log_path)
+    log = store.log(log_path)
+    these_train_steps = store.train_steps(log_path)
+    these_val_steps = store.val_steps(log_path)
+    infos.append(log['info'])
+    for step in these_val_steps:
+        min_acc = min(min_acc,step['aAcc'])
+        max_acc = max(max_acc,step['aAcc'])
+    print(f" -> {log_path}: {len(these_train_steps)} train steps, {len(these_val_steps)} val steps")
     train_steps.append(these_train_steps)
     val_steps.append(these_val_steps)
     if args.epochs:
-        max_length.append(max(these_val_steps[-1]['epoch'],these_train_steps[-1]['epoch']))
+        max_length.append(max([step['epoch'] for step in these_val_steps + these_train_steps],default=0))
     else:
-        max_length.append(last_train_iter)
+        max_length.append(log['last_train_iter'])
 
 common_length = min(max_length)
-if args.time_range == 'min' or (args.time_range == 'ask' and input(f"Common length {common_length} {'epochs' if args.epochs else 'iterations'}? [y/n] ").lower() == "y"):
+if args.follow:
+    pass # Logs which are still growing are never cropped
+elif args.time_range == 'min' or (args.time_range == 'ask' and input(f"Common length {common_length} {'epochs' if args.epochs else 'iterations'}? [y/n] ").lower() == "y"):
     for i in range(len(train_steps)):
         train_steps[i] = list(filter(lambda it: 
                 it['epoch' if args.epochs else 'iter']<= common_length,train_steps[i]))
@@ -156,12 +160,23 @@ def classplot(axis,val,setup=True,prop="IoU",label="",color="blue",i=0,length=1,
             indices.append(i2)
             values.append(val[propname])
     indices = np.array(indices)
-    axis.bar(indices+shift,values,w,label=label,color=color)
+    bars = axis.bar(indices+shift,values,w,label=label,color=color)
     if setup:
         axis.set_xticks(np.arange(len(ticks)))
         axis.set_xticklabels([tick[:10] for tick in ticks],rotation="vertical")
         axis.set_ylabel(prop)
         axis.set_title(f"{prop} for classes")
+    return bars
+
+def time_value(item):
+    return item['epoch'] if args.epochs else item['last_train_iter']/1000
+
+def line_data(steps, prop):
+    """Time and values of prop over the steps, downsampled to --max-points."""
+    x = np.array([time_value(item) for item in steps])
+    y = np.array([item[prop] for item in steps],dtype=np.float64)
+    kept = downsample_indices(x,y,args.max_points)
+    return x[kept], y[kept]
 
 
 if args.mode == 'separate':
@@ -173,17 +188,33 @@ elif args.mode == 'joint':
     #if not epoch_x: otherax = ax[0].twinx()
 print("Plot...")
 plot_filename = ""
+titles = []
+# Per log the plotted lines and class bars, which are updated with --follow
+global_lines = []
+second_lines = []
+class_bars = []
+
+def plot_classes(i):
+    """Draw the class-wise bars of the last val step of log i."""
+    last_val = val_steps[i][-1] if len(val_steps[i]) > 0 else {}
+    if args.mode == 'separate':
+        return classplot(ax[i,1], last_val,prop=args.class_property)
+    return classplot(ax[1],last_val,
+                     setup=i==0, prop=args.class_property,
+                     label=f"{titles[i]} | {last_val.get('epoch',0)} epochs", color=args.colors[i % len(args.colors)],
+                     i=i,length=len(paths),classnames=classnames) #,index_shift=(-1 if 'converted_classes' in this_info else 0)
+
 for i,this_path in enumerate(paths):
     print(" -> ",this_path)
     these_train_steps = train_steps[i]
     these_val_steps = val_steps[i]
-    time_steps = [item['epoch'] for item in these_val_steps] if args.epochs else [item['last_train_iter']/1000 for item in these_val_steps]
     color = args.colors[i % len(args.colors)]
     this_info = infos[i]
     if len(args.names) > i:
         this_title = args.names[i]
     else:
         this_title = nice_config_title(this_info)
+    titles.append(this_title)
     plot_filename += this_title + "__"
     
     if args.mode == 'separate':
@@ -192,14 +223,13 @@ for i,this_path in enumerate(paths):
         normal_ax.set_ylabel(args.global_property+" (Validation)")
         normal_ax.set_title(this_title)
         
-        normal_ax.plot(time_steps,
-            [item[args.global_property] for item in these_val_steps],"o-",color=color,label=f"{args.global_property} (Validation)")
+        global_lines.append(normal_ax.plot(*line_data(these_val_steps,args.global_property),"o-",color=color,label=f"{args.global_property} (Validation)")[0])
         if args.second_global_property is not None:
             other_ax = normal_ax.twinx()
-            other_ax.plot(time_steps,[item[args.second_global_property] for item in these_val_steps],'--',color=color,label=f"{args.second_global_property} (Validation)")
+            second_lines.append(other_ax.plot(*line_data(these_val_steps,args.second_global_property),'--',color=color,label=f"{args.second_global_property} (Validation)")[0])
             other_ax.set_ylabel(args.second_global_property+" (Validation) - dashed line")
             
-        classplot(ax[i,1], these_val_steps[-1],prop=args.class_property)
+        class_bars.append(plot_classes(i))
     elif args.mode == 'joint':
         if i==0:
             #ax[0].set_ylim([min_acc,1.0])
@@ -211,17 +241,10 @@ for i,this_path in enumerate(paths):
                 other_ax = ax[0].twinx()
                 other_ax.set_ylabel(args.second_global_property + " (Validation) - dashed line")
             #if not epoch_x: otherax.set_ylabel('Epoch (transparent)')
-        normal_ax.plot(
-            [item['epoch'] if args.epochs else item['last_train_iter']/1000 for item in these_val_steps],
-            [item[args.global_property] for item in these_val_steps],"o-",color=color)
+        global_lines.append(normal_ax.plot(*line_data(these_val_steps,args.global_property),"o-",color=color)[0])
         if args.second_global_property is not None:
-            other_ax.plot(
-                [item['epoch'] if args.epochs else item['last_train_iter']/1000 for item in these_val_steps],
-                [item[args.second_global_property] for item in these_val_steps],"--",color=color)
-        classplot(ax[1],these_val_steps[-1],
-                  setup=i==0, prop=args.class_property,
-                  label=f"{this_title} | {these_val_steps[-1]['epoch']} epochs", color=color,
-                  i=i,length=len(paths),classnames=classnames) #,index_shift=(-1 if 'converted_classes' in this_info else 0)
+            second_lines.append(other_ax.plot(*line_data(these_val_steps,args.second_global_property),"--",color=color)[0])
+        class_bars.append(plot_classes(i))
 if args.mode == 'joint':
     li,la = ax[1].get_legend_handles_labels()
     ax[0].legend(li,la,loc=0)
@@ -241,4 +264,52 @@ if args.save_plots:
         i += 1
     plt.savefig(plot_filepath)
     print("Saved plot to",plot_filepath)
-plt.show()
+
+def update():
+    """Add the val steps appended to the logs to the plot. The series of a log which was replaced
+    are rebuilt from scratch. The svg (if saved) is overwritten."""
+    changed = False
+    for i,log_path in enumerate(paths):
+        new_train, new_val = store.ingest(log_path)
+        if store.step_count("val",log_path) != len(val_steps[i]) + new_val:
+            # The log was replaced and ingested again, its steps in the store start at 0 again
+            val_steps[i] = store.val_steps(log_path)
+            print(f"{time.strftime('%H:%M:%S')} {titles[i]}: log replaced, {len(val_steps[i])} val steps")
+        elif new_val == 0: 
+            continue
+        else:
+            val_steps[i].extend(store.val_steps(log_path,first_step=len(val_steps[i])))
+            print(f"{time.strftime('%H:%M:%S')} {titles[i]}: +{new_val} val steps, {args.global_property} {val_steps[i][-1][args.global_property]:.4f}")
+        changed = True
+        global_lines[i].set_data(*line_data(val_steps[i],args.global_property))
+        if args.second_global_property is not None:
+            second_lines[i].set_data(*line_data(val_steps[i],args.second_global_property))
+        class_bars[i].remove()
+        class_bars[i] = plot_classes(i)
+    if not changed: return
+    for a in fig.axes:
+        a.relim()
+        a.autoscale_view()
+    if args.mode == 'joint':
+        li,la = ax[1].get_legend_handles_labels()
+        ax[0].legend(li,la,loc=0)
+    fig.canvas.draw_idle()
+    if args.save_plots:
+        fig.savefig(plot_filepath)
+
+if args.follow:
+    print(f"Following {len(paths)} logs every {args.interval}s, stop with Ctrl+C.")
+    if args.headless:
+        try:
+            while True:
+                time.sleep(args.interval)
+                update()
+        except KeyboardInterrupt:
+            pass
+    else:
+        timer = fig.canvas.new_timer(interval=int(args.interval*1000))
+        timer.add_callback(update)
+        timer.start()
+        plt.show()
+elif not args.headless:
+    plt.show()
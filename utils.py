@@ -67,12 +67,14 @@ class GeneralConfig(object):
         self.segmentation_logs_path =  path('segmentation_logs_dir')
         self.segmentation_plots_path = path('segmentation_plots_dir')
         self.segmentation_stats_path = path('segmentation_stats_dir')
+        self.segmentation_metrics_db = path('segmentation_metrics_db')
         self.segmentation_model_path = path('segmentation_model_dir')
         self.segmentation_out_path =   path('segmentation_out_dir')
         
         self.test_images_dir =         path('test_images_dir')
         
         self.html_template_dir =       path('html_template_dir')
+        self.thumbnail_cache_path =    path('thumbnail_cache_dir')
         
     def padded_palette(self,padding_length):
         """Return the color palette, padded with [0,0,0] entries to the given length. If padding_length
@@ -274,36 +276,155 @@ class HtmlContext(object):
 #######################################################
 # Data loading utils
 
-def multi_root_json_parse(string:str):
-    """Parse a json string with multiple root elements into a list of dicts. Accepts only
-    root elements enclosed in curly brackets. If a json-file had multiple lists as root-elements
-    it would not work.
+class JsonLogReader(object):
+    """Incremental reader of JSON-lines logs as written by MMSegmentation (one json object per line).
+    The reader remembers the byte offset up to which the file has been parsed, so each read() of a
+    growing log only parses the appended records. A truncated last line, which is still being
+    written, is left for the next read(). Lines which are no valid json are skipped and counted."""
 
-    Args:
-        string (str): JSON-string as loaded from a file.
+    def __init__(self, path : str, offset : int = 0):
+        """Construct
+
+        Args:
+            path (str): Path of the log file
+            offset (int, optional): Byte offset to start reading at. Defaults to 0.
+        """
+        self.path = path
+        self.offset = offset
+        self.skipped = 0
+
+    def replaced(self):
+        """Whether the file is shorter than the offset, i.e. it was replaced by another file and the 
+        next read() starts again at the beginning."""
+        return os.path.getsize(self.path) < self.offset
 
-    Raises:
-        ValueError: If there are more closing brackets than opening brackets
+    def read(self):
+        """Parse the records appended since the last read, or all records if the file was replaced.
+
+        Yields:
+            dict: Records in the order of the file
+        """
+        if self.replaced():
+            self.offset = 0
+        with open(self.path,"rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        return
+                    self.offset += len(line)
+                    yield record
+                    return
+                self.offset += len(line)
+                line = line.strip()
+                if len(line) == 0: continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.skipped += 1
+                    continue
+                yield record
+
+class TrainingLog(object):
+    """MMSegmentation training log, split into the info (first record), the train steps and the 
+    val steps, each as a list of dicts. Each val step also gets the field 'last_train_iter', the
+    iteration of the train step before it. update() adds the records appended to the file since
+    the last update. If the file was replaced by a shorter one, update() reads it again from the 
+    start and sets replaced. Records without mode are counted in skipped, invalid lines in 
+    reader.skipped."""
+
+    def __init__(self, path : str, offset : int = 0, info : dict = None, last_train_iter : int = 0):
+        """Construct and read the log. To continue reading a log which has been read up to offset
+        before (e.g. by the metrics store), pass its info and last_train_iter, then only the steps
+        after offset are held.
+
+        Args:
+            path (str): Path of the log json file
+            offset (int, optional): Byte offset to start reading at. Defaults to 0.
+            info (dict, optional): Info record, if offset is after it. Defaults to None.
+            last_train_iter (int, optional): Iteration of the last train step before offset. Defaults to 0.
+        """
+        self.path = path
+        self.reader = JsonLogReader(path, offset)
+        self.info = info
+        self.train_steps = []
+        self.val_steps = []
+        self.last_train_iter = last_train_iter
+        self.skipped = 0
+        self.replaced = False
+        self.update()
+
+    def update(self):
+        """Read the records appended since the last update. If the file was replaced, all steps are
+        dropped and read again.
+
+        Returns:
+            int: Number of new train steps
+            int: Number of new val steps
+        """
+        self.replaced = self.reader.replaced()
+        if self.replaced:
+            self.info = None
+            self.train_steps = []
+            self.val_steps = []
+            self.last_train_iter = 0
+            self.skipped = 0
+        num_train, num_val = len(self.train_steps), len(self.val_steps)
+        for record in self.reader.read():
+            if self.info is None:
+                self.info = record
+            elif not 'mode' in record:
+                self.skipped += 1
+            elif record['mode'] == "train":
+                self.train_steps.append(record)
+                self.last_train_iter = record['iter']
+            else:
+                record['last_train_iter'] = self.last_train_iter
+                self.val_steps.append(record)
+        return len(self.train_steps) - num_train, len(self.val_steps) - num_val
+
+def downsample_indices(x, y, max_points : int, keep = ()):
+    """Indices of the points of the series (x,y) to plot, such that at most max_points points (plus
+    the keep indices) are drawn while the shape of the series is preserved. The points are chosen
+    with Largest-Triangle-Three-Buckets: the series is split into buckets, and from each bucket the
+    point spanning the largest triangle with the previously chosen point and the mean of the next
+    bucket is taken. The first and the last point and all keep indices (e.g. marked points) are
+    always included.
+
+    Args:
+        x (array-like): x values, ascending
+        y (array-like): y values, NaN values are only chosen if a bucket has no other
+        max_points (int): Maximum number of points chosen by LTTB, at least 3
+        keep (array-like, optional): Indices which have to be included. Defaults to ().
 
     Returns:
-        List[dict]: List of dicts created with json.loads
+        np.array: Sorted indices of the points to plot
     """
-    import re
-    regex = re.compile("\{|\}")
-    level = 0
-    start = 0
-    jsons = []
-    for match in regex.finditer(string):
-        if match.group() == "{": level+=1
-        elif match.group() == "}":
-            if level <= 0:
-                raise ValueError("JSON bracket level conflict!! Too many }'s")
-            level -= 1
-            if level == 0:
-                end = match.span()[1]
-                jsons.append(json.loads(string[start:end]))
-                start = end+1
-    return jsons
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    n = len(x)
+    if max_points is None or n <= max_points or max_points < 3:
+        return np.arange(n)
+    # Bucket boundaries of the n-2 inner points
+    bounds = np.linspace(1,n-1,max_points-1).astype(int)
+    chosen = [0]
+    for b in range(max_points-2):
+        start, end = bounds[b], bounds[b+1]
+        if b+2 < len(bounds):
+            next_x = np.mean(x[end:bounds[b+2]])
+            next_y = np.nanmean(y[end:bounds[b+2]]) if not np.all(np.isnan(y[end:bounds[b+2]])) else 0.0
+        else:
+            next_x, next_y = x[-1], y[-1]
+        a = chosen[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        if np.all(np.isnan(areas)):
+            chosen.append(start)
+        else:
+            chosen.append(start + int(np.nanargmax(areas)))
+    chosen.append(n-1)
+    return np.union1d(chosen,np.asarray(keep,dtype=int))
 
 def path_arg(path):
     """Runs expanduser on the path"""
@@ -374,22 +495,56 @@ def nice_config_title(this_info):
     
     return this_info['exp_name']
 
+extended_datasets = {"outdoor_extended": "outdoor", "inout_extended": "inout"}
+"""Extended datasets and the base dataset each of them extends with the images in 'extension'."""
+
 def prepare_dataset_extension_dirs(overwrite=False):
-    """Creates the folders for the extended dataset by copying the outdoor and inout folders into
-    outdoor_extended and inout_extended, if they do not exist already. If a folder exists but does
-    not contain a 'done' file, a prompt is asked from the user to overwrite it."""
-    for loc in ["inout","outdoor"]:
-        in_path = os.path.join(conf.dataset_out_path,loc)
-        out_path = os.path.join(conf.dataset_out_path,loc+"_extended")
-        if os.path.exists(out_path):
-            if 'done' in os.listdir(out_path):
-                continue
-            if len(os.listdir(out_path)) > 0: 
-                if overwrite or input(f"Folder {out_path} seems to be unfinished. Delete and copy again from {in_path}? [y/n] ").lower() == 'y':
+    """Creates the folder 'extension' for the converted images of the extension datasets, and the
+    extended datasets outdoor_extended and inout_extended as overlays of their base dataset and the
+    extension: their images and annotations folders contain the symlinks 'base' and 'ext' to the
+    corresponding folders of the base dataset and the extension, and split files list the samples
+    of both (see write_extended_splits). Nothing is copied. If an extended dataset exists as a full
+    copy (the old format), a prompt is asked from the user to delete it."""
+    for kind in ["images","annotations"]:
+        for mode in ["train","val"]:
+            os.makedirs(os.path.join(conf.dataset_out_path,"extension",kind,mode),exist_ok=True)
+    for loc, base in extended_datasets.items():
+        out_path = os.path.join(conf.dataset_out_path,loc)
+        if os.path.exists(out_path) and not os.path.islink(os.path.join(out_path,"images","base")):
+            if len(os.listdir(out_path)) > 0:
+                if overwrite or input(f"Folder {out_path} is not an overlay of {base} and extension. Delete it? [y/n] ").lower() == 'y':
                     shutil.rmtree(out_path)
                 else:
                     raise FileExistsError(f"Folder {out_path} is already there and not empty.")
-        print(f"Generate {out_path} by copying {in_path}...")
-        shutil.copytree(in_path, out_path)
-        os.mknod(os.path.join(out_path,'done'))
-        print("... done.")
\ No newline at end of file
+        for kind in ["images","annotations"]:
+            os.makedirs(os.path.join(out_path,kind),exist_ok=True)
+            for link, target in [("base",base),("ext","extension")]:
+                link_path = os.path.join(out_path,kind,link)
+                if not os.path.islink(link_path):
+                    os.symlink(os.path.join("..","..",target,kind),link_path)
+        os.makedirs(os.path.join(out_path,"splits"),exist_ok=True)
+    write_extended_splits()
+
+def write_extended_splits(dataset_path : str = None):
+    """Writes splits/train.txt and splits/val.txt of each extended dataset, listing all samples of
+    the base dataset and the extension as 'base/train/NAME' and 'ext/train/NAME', relative to the
+    images and annotations folders. MMSegmentation reads them with img_dir='images', 
+    ann_dir='annotations' and split='splits/train.txt'. Has to be called after files were added to 
+    the base datasets or the extension. Extended datasets which were not prepared are skipped.
+
+    Args:
+        dataset_path (str, optional): Folder of the dataset. Defaults to the one from the configuration.
+    """
+    if dataset_path is None: dataset_path = conf.dataset_out_path
+    for loc, base in extended_datasets.items():
+        if not os.path.exists(os.path.join(dataset_path,loc,"splits")): continue
+        for mode in ["train","val"]:
+            lines = []
+            for link, folder in [("base",base),("ext","extension")]:
+                ann_folder = os.path.join(dataset_path,folder,"annotations",mode)
+                if not os.path.exists(ann_folder): continue
+                lines += [f"{link}/{mode}/{name[:-4]}" for name in sorted(os.listdir(ann_folder)) if name.endswith(".png")]
+            split_path = os.path.join(dataset_path,loc,"splits",mode + ".txt")
+            with open(split_path + ".tmp","w") as f:
+                f.write("".join(line + "\n" for line in lines))
+            os.replace(split_path + ".tmp",split_path)